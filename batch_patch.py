@@ -0,0 +1,206 @@
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+import zlib
+
+from build_patch import build, build_bps, copy_line, load_translations, read_program_from, unpack_bytecode
+from build_stats import BuildStats
+from d88 import D88Image
+
+# Patches any number of disk images, in any number of variants, in one go. The CSVs are read once and
+# each distinct image is parsed once; the per-variant patching, packing and writing is spread over a
+# process pool.
+
+# Each variant is the easy_mode setting it builds with, and the suffix for its output file.
+VARIANTS = {
+    'normal': (False, '_en'),
+    'easy': (True, '_en_easy'),
+}
+
+# A manifest is a text file with an image path or glob on each line, relative to the manifest. Blank
+# lines and lines starting with # are skipped.
+def read_manifest(filename):
+    patterns = []
+    with open(filename, encoding='utf8') as in_file:
+        for entry in in_file:
+            entry = entry.strip()
+            if len(entry) > 0 and not entry.startswith('#'):
+                patterns.append(os.path.join(os.path.dirname(filename), entry))
+    return patterns
+
+def expand_inputs(patterns):
+    inputs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            if match not in inputs:
+                inputs.append(match)
+    return inputs
+
+# The tag goes after the name, so images that would otherwise end up with the same output can be told
+# apart (see assign_outputs).
+def output_filename(out_dir, in_disk_image, variant, tag=None):
+    stem, extension = os.path.splitext(os.path.basename(in_disk_image))
+    if tag is not None:
+        stem += '_' + tag
+    return os.path.join(out_dir, stem + VARIANTS[variant][1] + (extension or '.d88'))
+
+def _output_key(filename):
+    return os.path.normcase(os.path.abspath(filename))
+
+# Works out the output for each (image, image_crc) pair. Images with the same name from different
+# directories would all write the same file, from different processes at once, so those get their
+# image's CRC added to the name. Returns {image: tag}, plus the images that still clash (the same
+# name and the same contents), which can't be built.
+def assign_outputs(out_dir, images, variants):
+    def clashes(tags):
+        outputs = {}
+        for in_disk_image, image_crc in images:
+            for variant in variants:
+                outputs.setdefault(_output_key(output_filename(out_dir, in_disk_image, variant, tags[in_disk_image])), []).append(in_disk_image)
+        return [names for names in outputs.values() if len(names) > 1]
+
+    tags = {in_disk_image: None for in_disk_image, _ in images}
+    crcs = dict(images)
+    for names in clashes(tags):
+        for in_disk_image in names:
+            tags[in_disk_image] = '{0:08x}'.format(crcs[in_disk_image])
+
+    unbuildable = {}
+    for names in clashes(tags):
+        for in_disk_image in names[1:]:
+            unbuildable[in_disk_image] = names[0]
+
+    return tags, unbuildable
+
+# Set up once in each worker process, so the translations and parsed programs are only sent over once.
+_worker_translations = None
+_worker_programs = None
+
+def _init_worker(translations, programs):
+    global _worker_translations, _worker_programs
+    _worker_translations = translations
+    _worker_programs = programs
+
+# Builds one variant of one image. Each build patches its own copy of the shared program.
+def _build_variant(task):
+    in_disk_image, image_crc, variant, out_disk_image, emit_bps, optimize = task
+    summary = {'image': in_disk_image, 'variant': variant, 'output': out_disk_image, 'error': None}
+
+    start = time.perf_counter()
+    try:
+        entry, next_block_table, directory_table, orig_size, lines = _worker_programs[image_crc]
+        program = (bytearray(next_block_table), bytearray(directory_table), orig_size, [copy_line(line) for line in lines])
+
+        with D88Image.open(in_disk_image) as image:
+            stats = BuildStats()
+            result = build(image, _worker_translations, VARIANTS[variant][0], stats=stats, optimize=optimize, program=program, entry=entry)
+            result['writer'].save(out_disk_image)
+            if emit_bps:
+                with open(os.path.splitext(out_disk_image)[0] + '.bps', 'wb') as out_file:
+                    out_file.write(build_bps(image, result['writer']))
+
+        summary['orig_size'] = orig_size
+        summary['patched_size'] = len(result['output'])
+        summary['free_blocks'] = stats.details['blocks']['free']
+    except Exception as error:
+        summary['error'] = '{0}: {1}'.format(type(error).__name__, error)
+
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+# If program_entry isn't given, the program is searched for on each image.
+def run(inputs, variants, out_dir, jobs=None, emit_bps=False, optimize=False, program_entry=None):
+    translations = load_translations()
+
+    summaries = []
+    programs = {}
+    images = []
+    for in_disk_image in inputs:
+        try:
+            with D88Image.open(in_disk_image) as image:
+                image_crc = zlib.crc32(image.data)
+                if image_crc not in programs:
+                    entry, next_block_table, directory_table, buf = read_program_from(image, program_entry)
+                    programs[image_crc] = (entry, next_block_table, directory_table, len(buf), unpack_bytecode(buf))
+        except Exception as error:
+            for variant in variants:
+                summaries.append({'image': in_disk_image, 'variant': variant, 'output': None, 'seconds': 0.0,
+                                  'error': 'Could not read the program: {0}: {1}'.format(type(error).__name__, error)})
+            continue
+
+        images.append((in_disk_image, image_crc))
+
+    # Sort out every output name before anything is built, so no two builds write the same file.
+    tags, unbuildable = assign_outputs(out_dir, images, variants)
+    tasks = []
+    for in_disk_image, image_crc in images:
+        for variant in variants:
+            if in_disk_image in unbuildable:
+                summaries.append({'image': in_disk_image, 'variant': variant, 'output': None, 'seconds': 0.0,
+                                  'error': 'Same name and contents as {0}, so it would overwrite its output.'.format(unbuildable[in_disk_image])})
+            else:
+                tasks.append((in_disk_image, image_crc, variant, output_filename(out_dir, in_disk_image, variant, tags[in_disk_image]), emit_bps, optimize))
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    if jobs == 1:
+        _init_worker(translations, programs)
+        summaries += [_build_variant(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(translations, programs)) as executor:
+            summaries += executor.map(_build_variant, tasks)
+
+    # Report in the order the images were given, whether or not they got as far as building.
+    summaries.sort(key=lambda summary: (inputs.index(summary['image']), variants.index(summary['variant'])))
+    return summaries
+
+def print_summary(summaries, out_file=sys.stdout):
+    for summary in summaries:
+        if summary['error'] is None:
+            status = 'ok    Orig {0}, result {1}, {2} block(s) free -> {3}'.format(
+                summary['orig_size'], summary['patched_size'], summary['free_blocks'], summary['output'])
+        else:
+            status = 'FAIL  {0}'.format(summary['error'])
+        print('{0}  {1:<6}  {2:7.1f} ms  {3}'.format(summary['image'], summary['variant'], summary['seconds'] * 1000, status), file=out_file)
+
+    failures = sum(1 for summary in summaries if summary['error'] is not None)
+    print('{0} build(s), {1} failed.'.format(len(summaries), failures), file=out_file)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Batch patch build for Dragon & Princess, over many disk images and variants')
+    parser.add_argument('in_disk_images', help='Disk images (or globs) to patch.', nargs='*')
+    parser.add_argument('--manifest', help='Text file listing disk images (or globs) to patch, one per line.', action='append', default=[])
+    parser.add_argument('--variants', help='Comma-separated build variants: {0}.'.format(', '.join(VARIANTS)), default='normal')
+    parser.add_argument('--out-dir', help='Directory for the patched images.', default='out')
+    parser.add_argument('--jobs', help='How many builds to run at once. Defaults to the number of CPUs.', type=int)
+    parser.add_argument('--emit-bps', help='Also write a BPS patch next to each patched image.', action='store_true')
+    parser.add_argument('--optimize', help='Run the size optimizer on each build.', action='store_true')
+    parser.add_argument('--program-entry', help='Directory entry of the Dragon & Princess program on every image. Found automatically if not given.', type=int)
+
+    args = parser.parse_args()
+
+    # A variant named twice would build the same output twice, so it's only built once.
+    variants = []
+    for variant in args.variants.split(','):
+        variant = variant.strip()
+        if len(variant) > 0 and variant not in variants:
+            if variant not in VARIANTS:
+                parser.error('Unknown variant "{0}".'.format(variant))
+            variants.append(variant)
+
+    patterns = list(args.in_disk_images)
+    for manifest in args.manifest:
+        patterns += read_manifest(manifest)
+    inputs = expand_inputs(patterns)
+    if len(inputs) == 0:
+        parser.error('No disk images to patch.')
+
+    summaries = run(inputs, variants, args.out_dir, args.jobs, args.emit_bps, args.optimize, args.program_entry)
+    print_summary(summaries)
+
+    sys.exit(1 if any(summary['error'] is not None for summary in summaries) else 0)
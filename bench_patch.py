@@ -0,0 +1,287 @@
+import argparse
+import gc
+import io
+import random
+import statistics
+import time
+
+import build_patch
+from build_patch import RANDOM_STRING_1650, RANDOM_STRING_LINES, pack_bytecode, unpack_bytecode
+from build_stats import write_json
+from d88 import D88Image
+from nbasic import parse_listing
+
+# Benchmarks for the tokenizer, packer, translation pass and full build, run entirely over synthetic
+# programs and disk images generated in memory, so no copy of the original disk is needed. Everything
+# is seeded, so results are comparable between runs and between commits.
+
+# The generated lines start after the synthetic versions of the lines the build patches.
+FIRST_LINE_NUMBER = 30001
+LINE_NUMBER_STEP = 3
+
+# Program sizes to benchmark. Every program starts with the patched lines, which take up about 2KB. A
+# single N-BASIC program can't go past 64KB, so the bigger sizes are made of batches of programs instead.
+PROGRAM_SIZES = [0x1000, 0x2000, 0x8000, 0xe000]
+BATCH_SIZES = [0x100000, 0x400000]
+
+def random_katakana(rnd, min_length, max_length):
+    # Half-width katakana, with the occasional space.
+    return bytes(0x20 if rnd.random() < 0.1 else rnd.randrange(0xa6, 0xde) for _ in range(rnd.randrange(min_length, max_length)))
+
+def random_english(rnd, length):
+    words = [b'the', b'king', b'dragon', b'princess', b'sword', b'castle', b'gold', b'you', b'found', b'a', b'road', b'magic']
+    text = b''
+    while len(text) < length:
+        text += rnd.choice(words) + b' '
+    return text.strip()
+
+def make_vocabulary(seed, size=400):
+    rnd = random.Random(seed)
+    game_translations = {}
+    misc_translations = {}
+    for _ in range(size):
+        text = random_katakana(rnd, 3, 40)
+        game_translations[text] = random_english(rnd, len(text))
+        field = random_katakana(rnd, 2, 10)
+        misc_translations[field] = random_english(rnd, len(field))
+
+    return game_translations, misc_translations
+
+def pack_line(line_data, line_number, output):
+    link_addr = len(output) + 4 + len(line_data) + 1 + 1
+    output += int.to_bytes(link_addr, 2, byteorder='little')
+    output += int.to_bytes(line_number, 2, byteorder='little')
+    output += line_data
+    output += b'\x00'
+
+# Statements that do nothing much, count tokens' worth, for putting something at a given token index.
+def filler(count):
+    return 'A=1:' * (count // 4) + ':' * (count % 4)
+
+# Listing lines standing in for every line the build patches, laid out so each patch finds the tokens it
+# expects at the indices it uses: the strings, constants and lengths the structural patches move or
+# rewrite, the packed random strings and their lengths, and the title screen's GOSUBs to line 18500.
+def make_patched_lines(rnd, game_texts):
+    def text():
+        return str(rnd.choice(game_texts), 'pc8801')
+
+    def packed(count, length):
+        return ''.join(str(bytes(rnd.randrange(0xa6, 0xde) for _ in range(length)), 'pc8801') for _ in range(count))
+
+    title_call = 'X={0}:Y=Y+{1}:M$="{2}":GOSUB18500'
+    sources = {
+        160: 'DIMN$(MN),S(MN)',
+        303: 'FORI=0TOMN:PRINT"{0}";:{1}N$(I)=MID$("{2}",I*3+1,3):NEXT'.format(text(), filler(49), packed(5, 3)),
+        360: 'PRINTTAB(20)"{0}";'.format(text()),
+        1640: filler(12) + 'I=INT(RND(1)*{0})*12+1:PRINTI:K=INT(RND(1)*{0})*12+1'.format(RANDOM_STRING_1650[1]),
+        1650: 'PRINTMID$("{0}",I,12)'.format(packed(RANDOM_STRING_1650[1], 12)),
+        2640: 'PRINT"{0}";:IFPR=1THENPRINT"{1}";"{2}";:PRINT"{3}";"{4}":PRINT"{5}";"{6}":PRINT"{7}";"{8}";"{9}";"{10}"'.format(*(text() for _ in range(11))),
+        2641: 'A=1:PRINT"{0}"'.format(text()),
+        5510: 'IFRND(1)<.1THENGOSUB18500',
+        18020: 'CONSOLE0,25:' + ':'.join(title_call.format(12, 2, text()) for _ in range(4)),
+        # The first three strings are joined into one line, centred by a single digit X.
+        18050: ':'.join(title_call.format(12, 2, str(random_katakana(rnd, 8, 9), 'pc8801') if index < 3 else text()) for index in range(5)),
+        18500: 'COLOR7:PRINTM$;:RETURN',
+        20160: 'DATA ' + ','.join(str(rnd.randrange(1, 100)) for _ in range(25)),
+    }
+    for line_number in (2840, 2841, 2842):
+        sources[line_number] = 'IFS(1)THENPRINT"{0}";"{1}"'.format(text(), text())
+    for line_number in (1040, 6050, 6115, 6920):
+        sources[line_number] = 'PRINT"{0}"'.format(text())
+    for line_number, pack in RANDOM_STRING_LINES.items():
+        string_index, string_count = pack[:2]
+        sources[line_number] = filler(string_index - 4) + 'PRINTMID$("{0}",INT(RND(1)*{1})*12+1,12)'.format(packed(string_count, 12), string_count)
+
+    return ['{0} {1}'.format(line_number, sources[line_number]) for line_number in sorted(sources)]
+
+# Builds a tokenized program of roughly the given size: the patched lines, then a mix of PRINT
+# statements, DATA lines, constants of every width, GOSUBs and REMs.
+def make_program(size, game_texts, misc_texts, seed):
+    rnd = random.Random(seed)
+    output = pack_bytecode(parse_listing(make_patched_lines(rnd, game_texts)))
+    del output[-3:]
+    line_number = FIRST_LINE_NUMBER
+
+    while len(output) < size - 3 and line_number <= 0xfff0:
+        kind = rnd.randrange(6)
+        if kind == 0:
+            line_data = b'\x91"' + rnd.choice(game_texts) + b'":A\xf1\x0f' + bytes([rnd.randrange(256)])
+        elif kind == 1:
+            fields = [rnd.choice(misc_texts) if rnd.random() < 0.6 else str(rnd.randrange(300)).encode() for _ in range(rnd.randrange(1, 8))]
+            line_data = b'\x84 ' + b','.join(fields)
+        elif kind == 2:
+            line_data = b'X\xf1\x1c' + bytes([rnd.randrange(256), rnd.randrange(256)]) + b':\x8d\x0eDH:\x8f ' + random_katakana(rnd, 0, 20)
+        elif kind == 3:
+            line_data = b'\x91"' + rnd.choice(game_texts) + b'";"' + rnd.choice(game_texts) + b'"\x1d' + bytes(rnd.randrange(256) for _ in range(4))
+        elif kind == 4:
+            line_data = b'\x8b A\xf1\x0c\x00\xff \x89\x0e' + int.to_bytes(line_number, 2, byteorder='little') + b':\x84 1,2,3:Z\xf1\x12'
+        else:
+            # An unterminated string runs to the end of the line.
+            line_data = b'M$\xf1"' + rnd.choice(game_texts)
+
+        pack_line(line_data, line_number, output)
+        line_number += LINE_NUMBER_STEP
+
+    output += b'\x00\x00\x00'
+    return bytes(output)
+
+# Builds a 2D disk image laid out like the original: the loader's next-block table in track 0 sector 5,
+# its directory in sectors 6-9, the program as directory entry 11 with its chain ending at block 0x5c,
+# and a three-entry file at block 0x83 for the build to reclaim.
+def make_image(program):
+    track_count = 84
+    header_size = 0x2b0
+    sector_size = 0x100
+
+    image = bytearray(header_size + track_count * 16 * (0x10 + sector_size))
+    image[0:9] = b'SYNTHETIC'
+    image[0x1c:0x20] = len(image).to_bytes(4, byteorder='little')
+
+    for track in range(track_count):
+        track_address = header_size + track * 16 * (0x10 + sector_size)
+        image[0x20 + track * 4:0x24 + track * 4] = track_address.to_bytes(4, byteorder='little')
+        for sector in range(16):
+            address = track_address + sector * (0x10 + sector_size)
+            image[address:address + 4] = bytes([track // 2, track % 2, sector + 1, 1])
+            image[address + 0x4:address + 0x6] = (16).to_bytes(2, byteorder='little')
+            image[address + 0xe:address + 0x10] = sector_size.to_bytes(2, byteorder='little')
+
+    def sector_address(track, sector):
+        return header_size + (track * 16 + sector) * (0x10 + sector_size) + 0x10
+
+    block_count = -(-len(program) // (8 * sector_size))
+    chain = list(range(0x5d - block_count, 0x5d))
+
+    next_block_table = bytearray(b'\xff' * 0x100)
+    for block, next_block in zip(chain, chain[1:]):
+        next_block_table[block] = next_block
+    next_block_table[chain[-1]] = 0xc1
+    for block in range(0x83, 0x88):
+        next_block_table[block] = block + 1 if block < 0x87 else 0xc8
+
+    directory_table = bytearray(b'\xff' * 0x400)
+    for entry in range(20):
+        record = bytearray(('FILE{0:02d}'.format(entry)).encode().ljust(0x20, b' '))
+        record[0x1f] = 0x83 if entry >= 17 else 0x01
+        directory_table[entry * 0x20:(entry + 1) * 0x20] = record
+    directory_table[(11 * 0x20) + 0x1b:(11 * 0x20) + 0x1d] = len(program).to_bytes(2, byteorder='big')
+    directory_table[(11 * 0x20) + 0x1f] = chain[0]
+
+    image[sector_address(0, 5):sector_address(0, 5) + sector_size] = next_block_table
+    for i in range(4):
+        image[sector_address(0, 6 + i):sector_address(0, 6 + i) + sector_size] = directory_table[i * sector_size:(i + 1) * sector_size]
+
+    pos = 0
+    for block in chain:
+        for sector in range(8):
+            chunk = program[pos:pos + sector_size]
+            address = sector_address(block // 2, (block % 2) * 8 + sector)
+            image[address:address + len(chunk)] = chunk
+            pos += sector_size
+
+    return bytes(image)
+
+# If setup is given, its result is passed to the function and isn't included in the timing. Like timeit,
+# the garbage collector is kept out of the measurements so they stay comparable between runs.
+def time_it(function, repeats, setup=None):
+    times = []
+    for _ in range(repeats):
+        argument = setup() if setup is not None else None
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function() if setup is None else function(argument)
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return {'min': min(times), 'median': statistics.median(times)}
+
+def translate(lines, game_translations, misc_translations):
+    for line in lines:
+        build_patch.translate_line(line, game_translations, misc_translations)
+
+def full_build(image_data, translations):
+    image = D88Image(image_data)
+    # The generated programs are only the lines the build touches, so they'd never pass for the real
+    # thing; point the build straight at them.
+    result = build_patch.build(image, translations, entry=build_patch.PROGRAM_ENTRY)
+    with io.BytesIO() as out_file:
+        result['writer'].save(out_file)
+    image.close()
+
+def run(repeats, seed):
+    game_translations, misc_translations = make_vocabulary(seed)
+    game_texts = list(game_translations)
+    misc_texts = list(misc_translations)
+    translations = {
+        'game_text_lookup': {text: [translation.decode('ascii')] for text, translation in game_translations.items()},
+        'game_translations': game_translations,
+        'misc_text_lookup': {text: [translation.decode('ascii')] for text, translation in misc_translations.items()},
+        'misc_translations': misc_translations,
+    }
+
+    results = []
+
+    for size in PROGRAM_SIZES:
+        program = make_program(size, game_texts, misc_texts, seed + size)
+        lines = unpack_bytecode(program)
+        if bytes(pack_bytecode(lines)) != program:
+            raise Exception('unpack->pack round trip is not byte-identical for the {0}-byte program.'.format(len(program)))
+
+        image_data = make_image(program)
+        results.append({
+            'name': 'program_{0}'.format(size),
+            'bytes': len(program),
+            'lines': len(lines),
+            'tokens': sum(len(line['tokens']) for line in lines),
+            'unpack_bytecode': time_it(lambda: unpack_bytecode(program), repeats),
+            'pack_bytecode': time_it(lambda: pack_bytecode(lines), repeats),
+            'translation': time_it(lambda lines: translate(lines, game_translations, misc_translations), repeats, lambda: unpack_bytecode(program)),
+            'full_build': time_it(lambda: full_build(image_data, translations), repeats),
+        })
+
+    for size in BATCH_SIZES:
+        programs = []
+        total = 0
+        while total < size:
+            programs.append(make_program(PROGRAM_SIZES[-1], game_texts, misc_texts, seed + total))
+            total += len(programs[-1])
+
+        batch_lines = [unpack_bytecode(program) for program in programs]
+        for program, lines in zip(programs, batch_lines):
+            if bytes(pack_bytecode(lines)) != program:
+                raise Exception('unpack->pack round trip is not byte-identical in the {0}-byte batch.'.format(size))
+
+        results.append({
+            'name': 'batch_{0}'.format(size),
+            'bytes': total,
+            'programs': len(programs),
+            'tokens': sum(len(line['tokens']) for lines in batch_lines for line in lines),
+            'unpack_bytecode': time_it(lambda: [unpack_bytecode(program) for program in programs], repeats),
+            'pack_bytecode': time_it(lambda: [pack_bytecode(lines) for lines in batch_lines], repeats),
+        })
+
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Benchmarks for the Dragon & Princess patch build, over synthetic data')
+    parser.add_argument('--repeats', help='How many times to run each benchmark. The minimum and median are reported.', type=int, default=5)
+    parser.add_argument('--seed', help='Seed for the synthetic programs.', type=int, default=1982)
+    parser.add_argument('--json', help='Write the results as JSON to this file, or to stdout if no file is given.', nargs='?', const='-', metavar='JSON_FILE')
+
+    args = parser.parse_args()
+
+    results = run(args.repeats, args.seed)
+
+    if args.json:
+        write_json({'seed': args.seed, 'repeats': args.repeats, 'results': results}, args.json)
+    else:
+        for result in results:
+            print('{0} ({1} bytes)'.format(result['name'], result['bytes']))
+            for name in ('unpack_bytecode', 'pack_bytecode', 'translation', 'full_build'):
+                if name in result:
+                    timing = result[name]
+                    print('    {0:<16} min {1:8.2f} ms   median {2:8.2f} ms   {3:8.1f} MB/s'.format(
+                        name, timing['min'] * 1000, timing['median'] * 1000, result['bytes'] / timing['min'] / 1e6))
@@ -0,0 +1,257 @@
+import zlib
+
+SOURCE_READ = 0
+TARGET_READ = 1
+SOURCE_COPY = 2
+TARGET_COPY = 3
+
+# Matches shorter than this aren't worth a copy action; they go out as literal bytes instead.
+# It's also the stride we index the source at, so any match at least twice this long is found.
+MIN_MATCH = 8
+
+# How many earlier positions to remember for each indexed chunk.
+MAX_CANDIDATES = 8
+
+def encode_number(value):
+    output = bytearray()
+    while True:
+        x = value & 0x7f
+        value >>= 7
+        if value == 0:
+            output.append(0x80 | x)
+            break
+        output.append(x)
+        value -= 1
+    return output
+
+def decode_number(data, pos):
+    value = 0
+    shift = 1
+    while True:
+        x = data[pos]
+        pos += 1
+        value += (x & 0x7f) * shift
+        if x & 0x80:
+            break
+        shift <<= 7
+        value += shift
+    return value, pos
+
+def match_length(a, a_pos, b, b_pos, limit):
+    length = 0
+
+    # Compare in big chunks first, then finish off byte by byte.
+    chunk = 64
+    while length + chunk <= limit and a[a_pos + length:a_pos + length + chunk] == b[b_pos + length:b_pos + length + chunk]:
+        length += chunk
+    while length < limit and a[a_pos + length] == b[b_pos + length]:
+        length += 1
+
+    return length
+
+# Indexes every MIN_MATCH-aligned chunk starting in [start, end) that fits inside data.
+def index_chunks(data, start, end, index):
+    for pos in range(-(-start // MIN_MATCH) * MIN_MATCH, min(end, len(data) - MIN_MATCH + 1), MIN_MATCH):
+        candidates = index.setdefault(bytes(data[pos:pos + MIN_MATCH]), [])
+        if len(candidates) >= MAX_CANDIDATES:
+            del candidates[0]
+        candidates.append(pos)
+
+class _PatchWriter:
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.output = bytearray()
+        self.output_offset = 0
+        self.source_relative_offset = 0
+        self.target_relative_offset = 0
+        self.literal_start = None
+
+    def _action(self, action, length):
+        self.output += encode_number(((length - 1) << 2) | action)
+
+    def _relative(self, offset):
+        self.output += encode_number((abs(offset) << 1) | (1 if offset < 0 else 0))
+
+    def literal(self, pos):
+        if self.literal_start is None:
+            self.literal_start = pos
+
+    def flush(self, pos):
+        if self.literal_start is not None and pos > self.literal_start:
+            self._action(TARGET_READ, pos - self.literal_start)
+            self.output += self.target[self.literal_start:pos]
+            self.output_offset = pos
+        self.literal_start = None
+
+    def source_read(self, pos, length):
+        self.flush(pos)
+        self._action(SOURCE_READ, length)
+        self.output_offset = pos + length
+
+    def source_copy(self, pos, source_pos, length):
+        self.flush(pos)
+        self._action(SOURCE_COPY, length)
+        self._relative(source_pos - self.source_relative_offset)
+        self.source_relative_offset = source_pos + length
+        self.output_offset = pos + length
+
+    def target_copy(self, pos, target_pos, length):
+        self.flush(pos)
+        self._action(TARGET_COPY, length)
+        self._relative(target_pos - self.target_relative_offset)
+        self.target_relative_offset = target_pos + length
+        self.output_offset = pos + length
+
+# Builds a BPS patch that turns source into target. If the caller already knows which ranges of the
+# target it changed, it can pass them as dirty_ranges; everything outside them is taken to be identical
+# to the source and is emitted as a plain SourceRead without being compared at all.
+def create_patch(source, target, dirty_ranges=None, metadata=b''):
+    source = memoryview(source)
+    target = memoryview(target)
+
+    if dirty_ranges is None:
+        dirty_ranges = [(0, len(target))]
+
+    # Anything past the end of the source can't be a SourceRead, so it's always dirty.
+    regions = []
+    for start, end in sorted(dirty_ranges) + [(len(source), len(target))]:
+        start = max(0, start)
+        end = min(end, len(target))
+        if start >= end:
+            continue
+        if len(regions) > 0 and start <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+
+    writer = _PatchWriter(source, target)
+    writer.output += b'BPS1'
+    writer.output += encode_number(len(source))
+    writer.output += encode_number(len(target))
+    writer.output += encode_number(len(metadata))
+    writer.output += metadata
+
+    source_index = {}
+    index_chunks(source, 0, len(source), source_index)
+    target_index = {}
+
+    for region_start, region_end in regions:
+        # A copy from the previous region may have already run past the start of this one.
+        if region_end <= writer.output_offset:
+            continue
+        if region_start > writer.output_offset:
+            writer.source_read(writer.output_offset, region_start - writer.output_offset)
+
+        pos = writer.output_offset
+        indexed = pos
+        while pos < region_end:
+            # Anything already written can be the source of a TargetCopy.
+            if pos - indexed >= MIN_MATCH:
+                index_chunks(target, indexed, pos, target_index)
+                indexed = pos
+
+            remaining = len(target) - pos
+
+            # Cheapest case: the bytes at the same offset haven't changed.
+            if pos < len(source):
+                length = match_length(source, pos, target, pos, min(remaining, len(source) - pos))
+                if length >= MIN_MATCH or (length > 0 and pos + length >= region_end):
+                    writer.source_read(pos, length)
+                    pos += length
+                    continue
+
+            best_action = None
+            best_pos = 0
+            best_length = 0
+            if remaining >= MIN_MATCH:
+                chunk = bytes(target[pos:pos + MIN_MATCH])
+                for candidate in reversed(source_index.get(chunk, ())):
+                    length = match_length(source, candidate, target, pos, min(remaining, len(source) - candidate))
+                    if length > best_length:
+                        best_action, best_pos, best_length = SOURCE_COPY, candidate, length
+                for candidate in reversed(target_index.get(chunk, ())):
+                    length = match_length(target, candidate, target, pos, remaining)
+                    if length > best_length:
+                        best_action, best_pos, best_length = TARGET_COPY, candidate, length
+
+            if best_length < MIN_MATCH:
+                writer.literal(pos)
+                pos += 1
+                continue
+
+            # Pull the match backwards over any literal bytes it also covers.
+            reference = source if best_action == SOURCE_COPY else target
+            while writer.literal_start is not None and pos > writer.literal_start and best_pos > 0 and reference[best_pos - 1] == target[pos - 1]:
+                pos -= 1
+                best_pos -= 1
+                best_length += 1
+
+            if best_action == SOURCE_COPY:
+                writer.source_copy(pos, best_pos, best_length)
+            else:
+                writer.target_copy(pos, best_pos, best_length)
+
+            pos += best_length
+
+        writer.flush(pos)
+        index_chunks(target, indexed, pos, target_index)
+
+    if writer.output_offset < len(target):
+        writer.source_read(writer.output_offset, len(target) - writer.output_offset)
+
+    output = writer.output
+    output += zlib.crc32(source).to_bytes(4, byteorder='little')
+    output += zlib.crc32(target).to_bytes(4, byteorder='little')
+    output += zlib.crc32(output).to_bytes(4, byteorder='little')
+
+    return bytes(output)
+
+def apply_patch(source, patch):
+    patch = memoryview(patch)
+    if patch[:4] != b'BPS1':
+        raise ValueError('Not a BPS patch.')
+    if zlib.crc32(patch[:-4]) != int.from_bytes(patch[-4:], byteorder='little'):
+        raise ValueError('Patch checksum mismatch.')
+
+    pos = 4
+    source_size, pos = decode_number(patch, pos)
+    target_size, pos = decode_number(patch, pos)
+    metadata_size, pos = decode_number(patch, pos)
+    pos += metadata_size
+
+    if len(source) != source_size or zlib.crc32(source) != int.from_bytes(patch[-12:-8], byteorder='little'):
+        raise ValueError('Source checksum mismatch.')
+
+    target = bytearray()
+    source_relative_offset = 0
+    target_relative_offset = 0
+
+    while pos < len(patch) - 12:
+        data, pos = decode_number(patch, pos)
+        action = data & 3
+        length = (data >> 2) + 1
+
+        if action == SOURCE_READ:
+            target += source[len(target):len(target) + length]
+        elif action == TARGET_READ:
+            target += patch[pos:pos + length]
+            pos += length
+        else:
+            data, pos = decode_number(patch, pos)
+            offset = -(data >> 1) if data & 1 else data >> 1
+            if action == SOURCE_COPY:
+                source_relative_offset += offset
+                target += source[source_relative_offset:source_relative_offset + length]
+                source_relative_offset += length
+            else:
+                target_relative_offset += offset
+                # Target copies can overlap the bytes they're producing, so go a byte at a time.
+                for _ in range(length):
+                    target.append(target[target_relative_offset])
+                    target_relative_offset += 1
+
+    if len(target) != target_size or zlib.crc32(target) != int.from_bytes(patch[-8:-4], byteorder='little'):
+        raise ValueError('Target checksum mismatch.')
+
+    return target
@@ -0,0 +1,87 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+CACHE_FORMAT_VERSION = 2
+
+# Every module whose code decides what ends up in the cache: the build script, the tokenizer and
+# packer, the text encoding, the patch pipeline, the cross reference index, and the disk and loader
+# readers the program and its location come out of.
+CACHED_MODULES = ('build_patch.py', 'nbasic.py', 'pc88codec.py', 'patch_registry.py', 'cross_reference.py', 'd88.py', 'loader_fs.py', 'locator.py')
+
+# The cached results are only as good as the code that produced them, so everything is salted
+# with a hash of the modules that produced it.
+def script_hash():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.blake2b(digest_size=16)
+    for module in CACHED_MODULES:
+        with open(os.path.join(script_dir, module), 'rb') as in_file:
+            data = in_file.read()
+        digest.update(module.encode('ascii'))
+        digest.update(len(data).to_bytes(8, byteorder='little'))
+        digest.update(data)
+    return digest.digest()
+
+class BuildCache:
+    def __init__(self, directory, salt):
+        self.directory = directory
+        self.salt = salt
+
+    def _path(self, kind, image_crc, variant=None):
+        name = '{0}-{1:08x}'.format(kind, image_crc)
+        if variant is not None:
+            name += '-' + variant
+        return os.path.join(self.directory, name + '.pickle')
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as in_file:
+                version, salt, payload = pickle.load(in_file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # A damaged cache file is just a cache miss.
+            return None
+
+        if version != CACHE_FORMAT_VERSION or salt != self.salt:
+            return None
+
+        return payload
+
+    def _store(self, path, payload):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write to a temp file first, so an interrupted build never leaves a half-written cache behind.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                pickle.dump((CACHE_FORMAT_VERSION, self.salt, payload), out_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    # The tokenized program (plus the loader tables it came with), keyed by the CRC32 of the input image
+    # and the directory entry it was read from.
+    def load_program(self, image_crc, entry):
+        return self._load(self._path('program', image_crc, 'entry{0}'.format(entry)))
+
+    def store_program(self, image_crc, entry, program):
+        self._store(self._path('program', image_crc, 'entry{0}'.format(entry)), program)
+
+    # Per-line results of the translation passes, as (packed bytes, counters), keyed by a hash of each line
+    # and the CSV rows it uses.
+    def load_lines(self, image_crc, variant):
+        lookup = self._load(self._path('lines', image_crc, variant))
+        return lookup if lookup is not None else {}
+
+    def store_lines(self, image_crc, variant, lookup):
+        self._store(self._path('lines', image_crc, variant), lookup)
+
+    # Where a program was found on the input image, keyed by its CRC32 and the name of the signature.
+    def load_location(self, image_crc, name):
+        return self._load(self._path('location', image_crc, name))
+
+    def store_location(self, image_crc, name, location):
+        self._store(self._path('location', image_crc, name), location)
@@ -1,546 +1,1125 @@
 import argparse
+import collections
 import csv
+import hashlib
 import io
 import os
+import re
 import shutil
 import sys
+import tempfile
 import textwrap
+import time
+import zlib
+
+import bps
+from build_cache import BuildCache, script_hash
+from build_stats import BuildStats, write_json
+from cross_reference import CrossReferenceIndex
+from d88 import D88Image, ImageWriter
+from layout import check_layout, format_issue, layout_summary
+from loader_fs import BLOCK_SIZE, FREE_BLOCK, LoaderFileSystem, block_chain, extend_chain, free_block_count, write_chain, write_tables
+from locator import Signature, locate
+from nbasic import Token, list_program, pack_bytecode, pack_tokens, tokenize, unpack_bytecode
+from file_watch import FileWatcher
+from patch_registry import PatchRegistry, ProgramIndex
+import pc88codec # Registers the pc8801 text encoding.
+
+# Anything Python's float() would accept, more or less. DATA fields that look like numbers are never
+# treated as text.
+NUMBER_PATTERN = re.compile(rb'\s*[+-]?(?:(?:\d(?:_?\d)*(?:\.(?:\d(?:_?\d)*)?)?|\.\d(?:_?\d)*)(?:[eE][+-]?\d(?:_?\d)*)?|inf(?:inity)?|nan)\s*', re.IGNORECASE)
+
+def is_number(raw):
+    return NUMBER_PATTERN.fullmatch(raw) is not None
+
+# Yields (token, field_index, string_index) for every piece of text in a line that the CSVs cover,
+# numbered the way they are in the CSVs. Strings (field_index None) go in gametext.csv, and DATA fields
+# that aren't numbers go in misctext.csv; each has its own string_index count.
+def line_texts(line):
+    string_index = 0
+    field_string_index = 0
+    for token in line['tokens']:
+        if token.op == 0x22:
+            yield token, None, string_index
+            string_index += 1
+        elif token.op == 0x84:
+            for field_index, field in enumerate(token.fields):
+                if not is_number(field):
+                    yield token, field_index, field_string_index
+                    field_string_index += 1
+
+# The CSV rows are numbered on the program as it is on the disk, but the structural patches move and
+# delete strings. So before they run, each text token notes the index its text had: the string's index,
+# or for DATA, a dict from field index to the field's. Text a patch added has none.
+def number_texts(lines):
+    for line in lines:
+        for token, field_index, string_index in line_texts(line):
+            if field_index is None:
+                token.text_index = string_index
+            else:
+                if token.text_index is None:
+                    token.text_index = {}
+                token.text_index[field_index] = string_index
 
-def import_csv(filename):
+def original_text_index(token, field_index):
+    if field_index is None or token.text_index is None:
+        return token.text_index
+    return token.text_index.get(field_index)
+
+# Returns the line number and string index a CSV row is for, or None if they aren't numbers.
+def csv_position(row):
+    try:
+        return int(row[0]), int(row[1])
+    except ValueError:
+        return None
+
+# Returns the CSV rows keyed by the original bytes of the text they translate, along with
+# a compiled index from those same bytes to the encoded translation, ready to drop into a token.
+# Where rows for the same text disagree, the last one's translation is the one the text gets, and the
+# others are also indexed by (line_number, string_index, text) so those occurrences keep their own.
+def import_csv(filename, skip_numbers=False):
     lookup = {}
+    translations = {}
+    occurrences = []
     try:
         with open(filename, encoding='utf8') as in_file:
             reader = csv.reader(in_file, lineterminator='\n')
 
-            for row in reader:
+            for row_number, row in enumerate(reader, 1):
                 if (len(row) > 2):
-                    lookup[row[2]] = row[3:] if len(row) > 3 else []
-    except FileNotFoundError:
-        pass
-
-    return lookup
-
-def unpack_operations(op_string):
-    op_list = []
-    for c in op_string:
-        op_list.append({'op': c})
-    return op_list
-
-def unpack_bytecode(data):
-    lines = []
-
-    while True:
-        link_addr = int.from_bytes(data.read(2), byteorder='little')
-        line_number = int.from_bytes(data.read(2), byteorder='little')
-
-        tokens = []
-
-        if link_addr == 0:
-            break
-
-        while True:
-            c = data.read(1)
-
-            if len(c) == 0 or c[0] == 0:
-                break
-
-            op = c[0]
-            current_token = {'op': c[0]}
-            force_step_back = False
-
-
-            if op == 0xc or op == 0xe or op == 0x1c: # Hex constant, decimal constant, also decimal constant; 2 bytes
-                current_token['content'] = data.read(2)
-            elif op == 0xf: # One-byte decimal constant
-                current_token['content'] = data.read(1)
-            elif op == 0x1d: # Single precision float
-                current_token['content'] = data.read(4)
-            elif op == 0x22: # Start quote
-                current_token['content'] = bytearray()
-                current_token['terminator'] = op
-                while True:
-                    c = data.read(1)
-                    if len(c) == 0 or c[0] == 0:
-                        force_step_back = True
-                        break
-
-                    if c[0] == 0x22:
-                        break
-                    else:
-                        current_token['content'] += c
-
-
-            elif op == 0x84: # Data
-                content = data.read(1) # Space after DATA is required, I think; store it as content.
-                fields = [bytearray()]
-                while True:
-                    c = data.read(1)
-                    if len(c) == 0 or c[0] == 0:
-                        force_step_back = True
-                        break
-                    elif c[0] == 0x2c: # Comma
-                        fields.append(bytearray())
-                    elif c[0] == 0x3a: # Colon
-                        force_step_back = True
-                        break
-                    else:
-                        fields[-1] += c
-                current_token['fields'] = fields
-            elif op == 0x8f: # Remark
-                current_token['content'] = bytearray()
-                while True:
-                    c = data.read(1)
-                    if len(c) == 0 or c[0] == 0:
-                        force_step_back = True
-                        break
-                    current_token['content'] += c
-
-            tokens.append(current_token)
-
-            if force_step_back:
-                data.seek(data.tell() - 1)
-
-        lines.append({'line_number': line_number, 'orig_addr': link_addr, 'tokens': tokens})
-
-        data.seek(link_addr - 1)
-
-    return lines
-
-def pack_bytecode(lines):
-    output = bytearray()
-    for line in lines:
-        line_data = bytearray()
-        for token in line['tokens']:
-            line_data += bytes([token['op']])
-            if 'content' in token:
-                line_data += token['content']
-            if 'fields' in token:
-                fields_data = bytearray()
-                for field in token['fields']:
-                    if len(fields_data) > 0:
-                        fields_data += b','
-                    fields_data += field
-                line_data += fields_data
-
-            if 'terminator' in token:
-                line_data += bytes([token['terminator']])
-
-        # Current pos + 4 for line/pointer + length of line + 1 for terminator + 1 for weird offset
-        link_addr = len(output) + 4 + len(line_data) + 1 + 1
-
-        output += int.to_bytes(link_addr, 2, byteorder='little')
-        output += int.to_bytes(line['line_number'], 2, byteorder='little')
-        output += line_data
-        output += b'\x00'
-
-    # Terminator
-    output += b'\x00\x00\x00'
-
-    return output
-
-
-def update_random_string(line, string_index, string_count, length_index_1, length_index_2):
-    string_length = len(line['tokens'][string_index]['content'])
-    line['tokens'][length_index_1]['content'] = int.to_bytes(string_length // string_count, 1, byteorder='big')
-    line['tokens'][length_index_2]['content'] = line['tokens'][length_index_1]['content']
-
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser('Main patch build for Dragon & Princess')
-    parser.add_argument('in_disk_image', help='Disk image to scan for original text.')
-    parser.add_argument('out_disk_image', help='Output disk image. Will be overwritten if already present.')
-
-    parser.add_argument('--update-csv', help='Whether the CSV files should be created/updated with the strings found in the scan. Will not overwrite old entries.', action='store_true')
-    parser.add_argument('--easy-mode', help='Whether the game data should be modified to make the game easier (for testing!)', action='store_true')
-
-    args = parser.parse_args()
+                    try:
+                        key = row[2].encode('pc8801')
+                    except UnicodeEncodeError:
+                        print("Original text \"{0}\" ({1}, row {2}) could not be encoded.".format(row[2], filename, row_number))
+                        continue
 
-    # Load the current CSVs
-    game_text_lookup = import_csv('csv/gametext.csv')
-    misc_text_lookup = import_csv('csv/misctext.csv')
-
-    # Read the sectors of the disk that matter to us.
-    buf = bytearray()
-
-    track_start_address_list = []
-
-    next_block_table = bytearray()
-    directory_table = bytearray()
-
-    with open(args.in_disk_image, 'rb') as in_file:
-        # First, read the table from the D88 header that gives the start
-        # address in the disk image of each track.
-        MAX_TRACKS = 164
-        in_file.seek(0x20)
-        for _ in range(MAX_TRACKS):
-            track_start_address_list.append(int.from_bytes(in_file.read(4), byteorder='little'))
-
-        # Now, the loader specific to this disk. It seems to organize its files in "blocks"
-        # that appear to be 8 sectors, or half a track, each. It has a table that says what
-        # the next block should be after each block. Values greater than 0xc0 appear to be
-        # terminators; I'm not sure what exactly they mean.
-        in_file.seek(0x800 + 0x10)
-        next_block_table += in_file.read(0x100)
-
-        # Then, the loader's directory table is a sequence of 32-byte records spanning 4 sectors.
-        in_file.seek(0x910)
-        for _ in range(4):
-            in_file.seek(0x10, os.SEEK_CUR)
-            directory_table += in_file.read(0x100)
-
-        # I know that the main Dragon & Princess BASIC code file is entry 11 in this table.
-        # I also know that the last byte in the record (0x1f) is the first block of the file.
-        # And the file size, at least in our case, is a 16-bit value at offset 0x1b.
-        dnp_directory_entry = directory_table[(11 * 0x20):(12 * 0x20)]
-        current_block = dnp_directory_entry[0x1f]
-        file_size = int.from_bytes(dnp_directory_entry[0x1b:0x1d], byteorder='big')
-
-        # Given that, we can just follow the blocks in the table and grab the whole file.
-        # Again, each block spans 8 sectors.
-        while current_block < 0xc0:
-            track_index = current_block // 2
-            sector_index = (current_block % 2) * 8
-            address = track_start_address_list[track_index] + sector_index * 0x110
-
-            in_file.seek(address)
-            for _ in range(8):
-                in_file.seek(0x10, os.SEEK_CUR)
-                buf += in_file.read(0x100)
-
-            current_block = next_block_table[current_block]
-
-        buf = buf[:file_size]
-
-    lines = []
-    with io.BytesIO(buf) as data:
-        lines = unpack_bytecode(data)
+                    lookup[key] = row[3:] if len(row) > 3 else []
 
-    # Build the CSVs if we need to.
-    if args.update_csv:
-        with open('csv/gametext.csv', 'w+', encoding='utf8') as out_file:
-            writer = csv.writer(out_file, lineterminator='\n')
-
-            for line in lines:
-                string_index = 0
-                for token in line['tokens']:
-                    if token['op'] == 0x22:
+                    # Later rows for the same text win, just like in the lookup.
+                    translations.pop(key, None)
+                    if len(row) > 3 and len(row[3]) > 0 and not (skip_numbers and is_number(key)):
                         try:
-                            text = token['content'].decode('shift_jis')
-                            row = [line['line_number'], string_index, text]
-
-                            if text in game_text_lookup:
-                                row += game_text_lookup[text]
-
-                            writer.writerow(row)
-                        except UnicodeDecodeError:
-                            pass
-                        string_index += 1
-
-        with open('csv/misctext.csv', 'w+', encoding='utf8') as out_file:
-            writer = csv.writer(out_file, lineterminator='\n')
-
-            for line in lines:
-                string_index = 0
-                for token in line['tokens']:
-                    if token['op'] == 0x84:
-                        for field in token['fields']:
-                            try:
-                                text = field.decode('shift_jis')
-
-                                # Ugly hack, because Python
-                                is_number = True
-                                try:
-                                    float(text)
-                                except ValueError:
-                                    is_number = False
-
-                                if not is_number:
-                                    row = [line['line_number'], string_index, text]
-
-                                    if text in misc_text_lookup:
-                                        row += misc_text_lookup[text]
+                            translations[key] = row[3].encode('pc8801')
+                        except UnicodeEncodeError:
+                            print("Translated text \"{0}\" ({1}, row {2}) could not be encoded.".format(row[3], filename, row_number))
+                            continue
 
-                                    writer.writerow(row)
+                        position = csv_position(row)
+                        if position is not None:
+                            occurrences.append((position + (key,), translations[key]))
+    except FileNotFoundError:
+        pass
 
-                                    string_index += 1
-                            except UnicodeDecodeError:
-                                string_index += 1
+    for occurrence, translation in occurrences:
+        if translations.get(occurrence[2]) != translation:
+            translations[occurrence] = translation
 
+    return lookup, translations
 
-    # These are changes that happen before the translations are added.
+def update_random_string(line, string_index, string_count, length_index_1, length_index_2):
+    string_length = len(line['tokens'][string_index].content)
+    line['tokens'][length_index_1].content = int.to_bytes(string_length // string_count, 1, byteorder='big')
+    line['tokens'][length_index_2].content = line['tokens'][length_index_1].content
+
+# The main Dragon & Princess BASIC code file is entry 11 in the loader's directory on the one known
+# disk. Other dumps are searched for it (see locate_program).
+PROGRAM_ENTRY = 11
+
+def read_program(image, entry=PROGRAM_ENTRY):
+    # The loader specific to this disk has a table that says what the next block should be
+    # after each block, and a directory saying where each file starts and how big it is.
+    # See loader_fs for the details.
+    file_system = LoaderFileSystem(image)
+    return file_system.next_block_table, file_system.directory_table, file_system.file(entry).read()
+
+# Reads the program from the given directory entry, or from wherever locate_program finds it if there
+# isn't one. Returns the entry along with everything read_program does.
+def read_program_from(image, entry=None, cache=None):
+    if entry is None:
+        entry = locate_program(image, cache)
+    return (entry,) + read_program(image, entry)
+
+# The text each CSV covers, as ((line_number, string_index), original bytes) in program order.
+def scanned_texts(lines, data_fields=False):
     for line in lines:
-        line_number = line['line_number']
-
-        # These two changes allocate the default name array, and use the default name array to assign names.
-        if line_number == 160:
-            line['tokens'] += unpack_operations(b',DN$(MN)')
-        elif line_number == 303:
-            line['tokens'][67:80] = unpack_operations(b'DN$(I)')
-
-        # There's a line in the throne room constructed conditionally based on whether the
-        # princess is supposed to be present. Shift things around so it just has two
-        # whole separate strings to simplify English grammar.
-        elif line_number == 2640:
-            temp_ops = line['tokens'][12:17]
-            line['tokens'][15:18] = []
-            line['tokens'][30:31] = []
-            line['tokens'] += temp_ops
-        elif line_number == 2641:
-            line['tokens'][0:3] = []
-
-        # These lines print the names of shops present in the location in town... they contain a prefix
-        # string that isn't necessary in English. Remove it.
-        elif line_number == 2840 or line_number == 2841 or line_number == 2842:
-            del line['tokens'][7]
-
-        # As part of easy mode, this disables the check for random encounters.
-        elif line_number == 5510:
-            if args.easy_mode:
-                line['tokens'] = [{'op': 0x8f, 'content': b'Encounters disabled!'}]
-
-        # These changes all pertain to the title screen. Moving around a bunch of coordinates to make room for
-        # patch-specific credits.
-        elif line_number == 18020:
-            # This one just nudges one line up.
-            line['tokens'][49]['op'] = 0x13
-        elif line_number == 18050:
-
-            # This is the complicated one. First, there's a 'presented by' string that's split across three lines
-            # in the original. Join those up, adjust the spacing accordingly, and delete the extra commands.
-            combined_string = line['tokens'][13]['content'] + b' ' + line['tokens'][31]['content'] + b' ' + line['tokens'][49]['content']
-
-            line['tokens'][2]['op'] = ((40 - len(combined_string)) // 2) + 0x11
-            del line['tokens'][2]['content']
-            line['tokens'][8]['op'] = 0x12
-            line['tokens'][13]['content'] = combined_string
-
-            line['tokens'][18:54] = []
-
-            # Now insert commands for the lines we're injecting.
-            ops_to_insert = []
-            new_credit_lines = [(3, b'EN translation patch 1.01'), (1, b'by Laszlo Benyi & NLeseul')]
-            if args.easy_mode:
-                new_credit_lines.append((1, b'EASY MODE!!'))
-
-            for y_spacing, new_credit_line in new_credit_lines:
-                x_coord = ((40 - len(new_credit_line)) // 2)
-                ops_to_insert += unpack_operations(b'X\xf1')                   # X=
-                if x_coord <= 10:
-                    ops_to_insert.append({'op': x_coord + 0x11})
-                else:
-                    ops_to_insert.append({'op': 0xf, 'content': bytes([x_coord])})
-                ops_to_insert += unpack_operations(b':Y\xf1Y\xf3')             # :Y=Y+
-                ops_to_insert.append({'op': y_spacing + 0x11})
-                ops_to_insert += unpack_operations(b':M$\xf1')                 # :M$=
-                ops_to_insert.append({'op': 0x22, 'terminator': 0x22, 'content': new_credit_line})
-                ops_to_insert += unpack_operations(b':\x8d\x0eDH:')            # :GOSUB18500:
-
-            line['tokens'][36:36] = ops_to_insert
-
-            # Finally, if we haven't added the extra "easy mode" line, nudge down the final line ('press any key').
-            if not args.easy_mode:
-                line['tokens'][84]['op'] = 0x15
-
-        # This line contains the initial stats of the characters. The change fills them in with high values
-        # for easy mode if necessary.
-        elif line_number == 20160:
-            if args.easy_mode:
-                line['tokens'][0]['fields'] = [
-                    b'127', b'127', b'100', b'127', b'2.0',
-                    b'127', b'127', b'100', b'127', b'2.0',
-                    b'127', b'127', b'100', b'127', b'2.0',
-                    b'127', b'127', b'100', b'127', b'2.0',
-                    b'127', b'127', b'100', b'127', b'2.0',
-                ]
-
+        for token, field_index, string_index in line_texts(line):
+            if (field_index is not None) == data_fields:
+                yield (line['line_number'], string_index), token.content if field_index is None else token.fields[field_index]
+
+# Rows without a usable position sort after every real one, so they never match anything.
+UNPLACED = (0x10000, 0)
+
+# Brings one CSV up to date with the text scanned out of the program, in a single merge of the existing
+# rows and the scan, both in (line_number, string_index) order. Rows whose text is still where it was
+# are left exactly as they are. Text that's turned up somewhere new takes over the row it had before if
+# it moved, and otherwise starts with whatever the other rows for the same text have. Rows for text
+# that's gone are dropped. Returns what was added, removed and moved, and whether the file changed.
+def update_csv(filename, scanned, lookup):
+    try:
+        with open(filename, encoding='utf8', newline='') as in_file:
+            original = in_file.read()
+    except FileNotFoundError:
+        original = ''
+
+    old_rows = [(csv_position(row) or UNPLACED, row) for row in csv.reader(io.StringIO(original), lineterminator='\n') if len(row) > 2]
+    # The file is written in order, so this costs a single pass unless someone has re-sorted it by hand.
+    old_rows.sort(key=lambda item: item[0])
+
+    rows = []
+    added = []
+    removed = []
+    next_old = 0
+    for position, text in scanned:
+        while next_old < len(old_rows) and old_rows[next_old][0] < position:
+            removed.append(old_rows[next_old])
+            next_old += 1
+
+        text_string = str(text, 'pc8801')
+        if next_old < len(old_rows) and old_rows[next_old][0] == position:
+            old_row = old_rows[next_old][1]
+            next_old += 1
+            if old_row[2] == text_string:
+                rows.append(old_row)
+                continue
+            removed.append((position, old_row))
+
+        row = [position[0], position[1], text_string]
+        rows.append(row)
+        added.append((position, text, row))
+    removed += old_rows[next_old:]
+
+    # Pair up new text with removed rows for the same text, in order, to tell moves from additions.
+    removed_by_text = {}
+    for position, old_row in removed:
+        removed_by_text.setdefault(old_row[2], collections.deque()).append((position, old_row))
+
+    report = {'added': [], 'removed': [], 'moved': []}
+    for position, text, row in added:
+        candidates = removed_by_text.get(row[2])
+        if candidates:
+            old_position, old_row = candidates.popleft()
+            row += old_row[3:]
+            report['moved'].append({'from': old_position if old_position != UNPLACED else None, 'to': position, 'text': row[2]})
+        else:
+            row += lookup.get(text, [])
+            report['added'].append({'position': position, 'text': row[2]})
+
+    for position, old_row in sorted((item for candidates in removed_by_text.values() for item in candidates), key=lambda item: item[0]):
+        report['removed'].append({'position': position if position != UNPLACED else None, 'text': old_row[2]})
+
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerows(rows)
+    report['written'] = output.getvalue() != original
+
+    # Go through a temp file, so an interrupted build never leaves a half-written CSV behind.
+    if report['written']:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf8', newline='') as out_file:
+                out_file.write(output.getvalue())
+            # The temp file is only readable by its owner; give it the permissions the CSV had, or
+            # the ones a newly created file would get.
+            if os.path.exists(filename):
+                shutil.copymode(filename, temp_path)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp_path, 0o666 & ~umask)
+            os.replace(temp_path, filename)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    return report
+
+def update_csvs(lines, game_text_lookup, misc_text_lookup, game_csv='csv/gametext.csv', misc_csv='csv/misctext.csv'):
+    return {
+        'gametext': update_csv(game_csv, scanned_texts(lines), game_text_lookup),
+        'misctext': update_csv(misc_csv, scanned_texts(lines, data_fields=True), misc_text_lookup),
+    }
+
+# Every fixup to the program is registered here against the line numbers it applies to. Structural
+# patches happen before the translations are added; the other phases run per line, in order, as each
+# line goes through the build.
+PATCHES = PatchRegistry(pipeline=('translate', 'fixup', 'wrap'))
+
+# Counts something a handler did, both in the build stats and on the line itself. The build cache keeps
+# each line's counts with its result, so a build that takes lines from the cache still counts them.
+def count_for_line(line, context, name, amount):
+    context['stats'].count(name, amount)
+    counts = line.setdefault('counts', {})
+    counts[name] = counts.get(name, 0) + amount
+
+# What each pipeline phase's time is reported as in the build stats.
+PIPELINE_STAGES = {'translate': 'translation', 'fixup': 'random_string_fixups', 'wrap': 'textwrap'}
+
+# These two changes allocate the default name array, and use the default name array to assign names.
+@PATCHES.register('structural', 160)
+def allocate_default_names(line, context):
+    line['tokens'] += tokenize(',DN$(MN)')
+
+@PATCHES.register('structural', 303)
+def assign_default_names(line, context):
+    line['tokens'][67:80] = tokenize('DN$(I)')
+
+# There's a line in the throne room constructed conditionally based on whether the
+# princess is supposed to be present. Shift things around so it just has two
+# whole separate strings to simplify English grammar.
+@PATCHES.register('structural', 2640)
+def split_throne_room_text(line, context):
+    temp_ops = line['tokens'][12:17]
+    line['tokens'][15:18] = []
+    line['tokens'][30:31] = []
+    line['tokens'] += temp_ops
+
+@PATCHES.register('structural', 2641)
+def split_throne_room_text_2(line, context):
+    line['tokens'][0:3] = []
+
+# These lines print the names of shops present in the location in town... they contain a prefix
+# string that isn't necessary in English. Remove it.
+@PATCHES.register('structural', 2840, 2841, 2842)
+def remove_shop_prefix(line, context):
+    del line['tokens'][7]
+
+# As part of easy mode, this disables the check for random encounters.
+@PATCHES.register('structural', 5510)
+def disable_encounters(line, context):
+    if context['easy_mode']:
+        line['tokens'] = [Token(0x8f, content=b'Encounters disabled!')]
+
+# These changes all pertain to the title screen. Moving around a bunch of coordinates to make room for
+# patch-specific credits.
+@PATCHES.register('structural', 18020)
+def nudge_title_line(line, context):
+    # This one just nudges one line up.
+    line['tokens'][49].op = 0x13
+
+@PATCHES.register('structural', 18050)
+def add_title_credits(line, context):
+    easy_mode = context['easy_mode']
+
+    # This is the complicated one. First, there's a 'presented by' string that's split across three lines
+    # in the original. Join those up, adjust the spacing accordingly, and delete the extra commands.
+    combined_string = b' '.join((line['tokens'][13].content, line['tokens'][31].content, line['tokens'][49].content))
+
+    line['tokens'][2].op = ((40 - len(combined_string)) // 2) + 0x11
+    line['tokens'][2].content = None
+    line['tokens'][8].op = 0x12
+    line['tokens'][13].content = combined_string
+
+    line['tokens'][18:54] = []
+
+    # If we aren't adding the extra "easy mode" line, nudge down the final line ('press any key').
+    if not easy_mode:
+        line['tokens'][44].op = 0x15
+
+    # Now insert commands for the lines we're injecting.
+    new_credit_lines = [(3, 'EN translation patch 1.01'), (1, 'by Laszlo Benyi & NLeseul')]
+    if easy_mode:
+        new_credit_lines.append((1, 'EASY MODE!!'))
+
+    source = ''
+    for y_spacing, new_credit_line in new_credit_lines:
+        x_coord = ((40 - len(new_credit_line)) // 2)
+        source += 'X={0}:Y=Y+{1}:M$="{2}":GOSUB18500:'.format(x_coord, y_spacing, new_credit_line)
+
+    line['tokens'][36:36] = tokenize(source)
+
+# This line contains the initial stats of the characters. The change fills them in with high values
+# for easy mode if necessary.
+@PATCHES.register('structural', 20160)
+def max_initial_stats(line, context):
+    if context['easy_mode']:
+        line['tokens'][0].fields = [
+            b'127', b'127', b'100', b'127', b'2.0',
+            b'127', b'127', b'100', b'127', b'2.0',
+            b'127', b'127', b'100', b'127', b'2.0',
+            b'127', b'127', b'100', b'127', b'2.0',
+            b'127', b'127', b'100', b'127', b'2.0',
+        ]
 
+def apply_structural_patches(lines, easy_mode):
+    number_texts(lines)
+    index = ProgramIndex(lines)
+    PATCHES.apply('structural', index, {'easy_mode': easy_mode})
 
     # Add a line containing the data for the default names array, and a line to read it in on initialization.
-    lines.append({
-        'line_number': 20165,
-        'tokens': [
-            {'op': 0x84, 'content': b' ', 'fields': [b'Gombe', b'Jirosaku', b'Tarosaku', b'Yosaku', b'Goemon']}
-        ]
-    })
-    lines.append({
-        'line_number': 221,
-        'tokens':
-            # FOR I=0 TO MN:
-            unpack_operations(b'\x82I\xf1\x11 \xdc MN:') +
-
-            # READDN$(I):
-            unpack_operations(b'\x87DN$(I):') +
+    index.insert({'line_number': 20165, 'tokens': tokenize('DATA Gombe,Jirosaku,Tarosaku,Yosaku,Goemon')})
+    index.insert({'line_number': 221, 'tokens': tokenize('FORI=0 TO MN:READDN$(I):NEXT')})
+
+# Makes sure the structural patches haven't left anything jumping to a line that isn't there. Some
+# programs have dangling references to begin with, so only new ones count.
+def check_references(lines, unresolved_before=()):
+    unresolved = CrossReferenceIndex.from_lines(lines).unresolved(lines) - set(unresolved_before)
+    if len(unresolved) > 0:
+        raise Exception('Lines {0} are referenced but don\'t exist after patching.'.format(', '.join(str(line_number) for line_number in sorted(unresolved))))
+
+# Looks up the translation for one occurrence of some text, preferring one made for that exact spot. The
+# string index is the one in the CSV (see number_texts), or None for text that has no row of its own.
+def find_translation(translations, line_number, string_index, text):
+    translation = translations.get((line_number, string_index, text)) if string_index is not None else None
+    return translation if translation is not None else translations.get(text)
+
+# Returns how many strings and DATA fields were translated.
+def translate_line(line, game_translations, misc_translations):
+    translated = 0
+    for token, field_index, _ in line_texts(line):
+        string_index = original_text_index(token, field_index)
+        if field_index is None:
+            translation = find_translation(game_translations, line['line_number'], string_index, token.content)
+            if translation is not None:
+                token.content = translation
+                translated += 1
+        else:
+            translation = find_translation(misc_translations, line['line_number'], string_index, token.fields[field_index])
+            if translation is not None:
+                token.fields[field_index] = translation
+                translated += 1
+
+    return translated
+
+@PATCHES.default('translate')
+def translate_phase(line, context):
+    count_for_line(line, context, 'strings_translated', translate_line(line, context['game_translations'], context['misc_translations']))
+
+# These lines contain multiple lines of text packed into one string, with a random selection of one substring.
+# The syntax is always something like MID$("String1String2String3", INT(RND(3)+1)*7, 7).
+# We need to adjust the length that it uses for the substrings.
+RANDOM_STRING_LINES = {
+    570: (4, 5, 18, 22),
+    1395: (17, 2, 31, 35),
+    1610: (13, 5, 27, 31),
+    1620: (25, 2, 39, 43),
+    1630: (13, 2, 27, 31),
+    1760: (7, 2, 21, 25),
+    2105: (56, 2, 70, 74),
+    2200: (38, 2, 52, 56),
+    5250: (4, 3, 18, 22),
+}
+
+@PATCHES.register('fixup', *RANDOM_STRING_LINES)
+def fix_random_string(line, context):
+    update_random_string(line, *RANDOM_STRING_LINES[line['line_number']])
+
+# This is a slightly strange case. They compute the string index
+# on 1640 and then use it in 1650. We need to check the length of the
+# new string here and then put it back in 1640. The packed string is token 4, with six substrings.
+RANDOM_STRING_1650 = (4, 6)
+
+@PATCHES.register('fixup', 1650, depends_on=(1640,))
+def fix_random_string_1650(line, context):
+    string_index, string_count = RANDOM_STRING_1650
+    string_length_bytes = int.to_bytes(len(line['tokens'][string_index].content) // string_count, 1, byteorder='big')
+    line['tokens'][8].content = string_length_bytes
+
+    line_1640 = context['index'].find(1640)
+    if line_1640 is not None:
+        line_1640['tokens'][26].content = string_length_bytes
+        line_1640['tokens'][47].content = string_length_bytes
+
+# Split up text that's too long to fit in 40 characters. We can do this by breaking it up into multiple
+# strings and putting semicolons between them; the BASIC parser seems smart enough to line break if the
+# next string would force a word wrap. Returns how many strings had to be split. max_lengths can give a
+# different limit for particular tokens.
+def wrap_line(line, max_lengths=None):
+    new_tokens = []
+    split_count = 0
+
+    for token_index, token in enumerate(line['tokens']):
+        if token.op == 0x22:
+            text = str(token.content, 'pc8801')
+            max_length = max_lengths.get(token_index, 40) if max_lengths is not None else 40
+            if len(text) > max_length:
+                split_count += 1
+                for split_text_index, split_text in enumerate(textwrap.wrap(text, max_length, drop_whitespace=False)):
+                    if split_text_index > 0:
+                        new_tokens.append(Token(0x3b))
+                    new_tokens.append(Token(0x22, content=split_text.encode('pc8801'), terminator=0x22))
+            else:
+                new_tokens.append(token)
+        else:
+            new_tokens.append(token)
+
+    line['tokens'] = new_tokens
+
+    return split_count
+
+@PATCHES.default('wrap')
+def wrap_phase(line, context):
+    count_for_line(line, context, 'strings_split', wrap_line(line))
+
+# This prompt only has half the screen to work with, so for checking the layout it starts halfway across.
+TEXT_MARGINS = {360: 20}
+
+@PATCHES.register('wrap', 360)
+def wrap_line_360(line, context):
+    count_for_line(line, context, 'strings_split', wrap_line(line, {4: 20}))
+
+# Skip special text... either multiple strings packed together, or combat text.
+SPECIAL_TEXT_LINES = (570, 1040, 1395, 1610, 1620, 1630, 1650, 1760, 2105, 2200, 5250, 6050, 6115, 6920)
+
+@PATCHES.register('wrap', *SPECIAL_TEXT_LINES)
+def skip_wrap(line, context):
+    pass
+
+# A line's translated result only depends on its tokens after the structural patches and on the
+# translations of the text it contains, so that's what the cache key covers.
+def line_cache_key(line, game_translations, misc_translations):
+    key = hashlib.blake2b(digest_size=16)
+    key.update(int.to_bytes(line['line_number'], 2, byteorder='little'))
+
+    body = bytearray()
+    pack_tokens(line['tokens'], body)
+    key.update(int.to_bytes(len(body), 4, byteorder='little'))
+    key.update(body)
+
+    for token, field_index, _ in line_texts(line):
+        string_index = original_text_index(token, field_index)
+        if field_index is None:
+            translation = find_translation(game_translations, line['line_number'], string_index, token.content)
+        else:
+            translation = find_translation(misc_translations, line['line_number'], string_index, token.fields[field_index])
+
+        if translation is None:
+            key.update(b'\xff\xff\xff\xff')
+        else:
+            key.update(int.to_bytes(len(translation), 4, byteorder='little'))
+            key.update(translation)
+
+    return key.digest()
+
+def translate_program(lines, game_translations, misc_translations, cache_lookup=None, stats=None):
+    if stats is None:
+        stats = BuildStats()
+
+    keys = {}
+    if cache_lookup is not None:
+        for line in lines:
+            keys[line['line_number']] = line_cache_key(line, game_translations, misc_translations)
+
+        # Fold dependencies into the keys, so a change to one line invalidates the lines that rely on it.
+        for line_number, dependencies in PATCHES.dependencies.items():
+            if line_number in keys:
+                key = hashlib.blake2b(keys[line_number], digest_size=16)
+                for dependency in sorted(dependencies):
+                    key.update(keys.get(dependency, b''))
+                keys[line_number] = key.digest()
+
+        stale = PATCHES.related(line_number for line_number, key in keys.items() if key not in cache_lookup)
+
+        dirty_lines = []
+        for line in lines:
+            if line['line_number'] in stale:
+                dirty_lines.append(line)
+            else:
+                line['packed'], line['counts'] = cache_lookup[keys[line['line_number']]]
+                for name, amount in line['counts'].items():
+                    stats.count(name, amount)
+    else:
+        dirty_lines = lines
+
+    stats.count('lines_rebuilt', len(dirty_lines))
+    stats.count('lines_from_cache', len(lines) - len(dirty_lines))
+
+    # Each line goes through translation, fixups and wrapping in one pass, with each phase timed on its
+    # own as well.
+    phase_timings = {}
+    with stats.stage('pipeline'):
+        PATCHES.run_pipeline(dirty_lines, {'game_translations': game_translations, 'misc_translations': misc_translations, 'stats': stats}, phase_timings)
+    for phase, seconds in phase_timings.items():
+        stats.add_time(PIPELINE_STAGES[phase], seconds)
+
+    # Hand back the results for every line in this build, so the caller can cache them.
+    results = {}
+    if cache_lookup is not None:
+        for line in dirty_lines:
+            packed = bytearray()
+            pack_tokens(line['tokens'], packed)
+            line['packed'] = bytes(packed)
+
+        for line in lines:
+            results[keys[line['line_number']]] = (line['packed'], line.get('counts', {}))
+
+    return results
+
+# Everything from here to optimize_program is the optional size optimizer. None of it changes what the
+# program does; it only drops bytes the interpreter doesn't need.
+
+def packed_size(tokens):
+    output = bytearray()
+    pack_tokens(tokens, output)
+    return len(output)
+
+# Drops REM statements, along with the colon before them. A line that's nothing but a remark goes
+# away entirely unless something jumps to it, in which case it keeps an empty REM. The references
+# are a CrossReferenceIndex over the lines, here and below.
+def strip_remarks(lines, references):
+    saved = 0
+    kept_lines = []
+    for line in lines:
+        tokens = line['tokens']
+        for index, token in enumerate(tokens):
+            # Only a REM that starts a statement; "THEN REM" has to stay as it is.
+            if token.op == 0x8f and (index == 0 or tokens[index - 1].op == 0x3a):
+                if index == 0 and line['line_number'] not in references:
+                    saved += 4 + packed_size(tokens) + 1
+                    tokens = None
+                elif index == 0:
+                    saved += packed_size(tokens) - 1
+                    line['tokens'] = [Token(0x8f, content=b'')]
+                else:
+                    saved += packed_size(tokens[index - 1:])
+                    del tokens[index - 1:]
+                break
 
-            # NEXT
-            unpack_operations(b'\x83')
-    })
+        if tokens is not None:
+            kept_lines.append(line)
 
-    lines.sort(key=lambda line: line['line_number'])
+    lines[:] = kept_lines
+    return saved
 
-    # Now scan through and patch in translations as needed.
+# The interpreter skips spaces between tokens, so outside of strings, remarks and DATA (which all keep
+# their own content) they're just taking up room.
+def strip_spaces(lines):
+    saved = 0
     for line in lines:
+        tokens = []
+        previous_op = None
         for token in line['tokens']:
-            if token['op'] == 0x22:
-                try:
-                    text = token['content'].decode('shift_jis')
-                except UnicodeDecodeError:
-                    continue
-
-                if text in game_text_lookup:
-                    row = game_text_lookup[text]
-
-                    if len(row) > 0 and len(row[0]) > 0:
-                        try:
-                            token['content'] = row[0].encode('shift_jis')
-                        except UnicodeEncodeError:
-                            print("Translated text \"{0}\" (in line {1}) could not be encoded.".format(row[0], line['line_number']))
-            elif token['op'] == 0x84:
-                for index, field in enumerate(token['fields']):
-                    try:
-                        text = field.decode('shift_jis')
-
-                        # Ugly hack, because Python
-                        is_number = True
-                        try:
-                            float(text)
-                        except ValueError:
-                            is_number = False
-
-                        if not is_number and text in misc_text_lookup:
-                            row = misc_text_lookup[text]
-                            if len(row) > 0 and len(row[0]) > 0:
-                                token['fields'][index] = row[0].encode('shift_jis')
-                    except UnicodeDecodeError:
-                        pass
-
-
-    # These are changes that happen after the translations are added.
-    cached_line_1640 = None
+            if token.op == 0x20 and previous_op != 0xff:
+                saved += 1
+            else:
+                tokens.append(token)
+            previous_op = token.op
+        line['tokens'] = tokens
+    return saved
+
+# Re-encodes integer constants in the smallest form that holds them: 0x11-0x1a for 0-9, 0x0f for one
+# byte, 0x1c for two. Hex constants (0x0c) are integers too, so they're fair game. Values with the top
+# bit set would come out negative as an 0x1c, so those are left alone, as are floats.
+def shrink_constants(lines):
+    saved = 0
     for line in lines:
-        line_number = line['line_number']
-
-        # These lines contain multiple lines of text packed into one string, with a random selection of one substring.
-        # The syntax is always something like MID$("String1String2String3", INT(RND(3)+1)*7, 7).
-        # We need to adjust the length that it uses for the substrings.
-        if line_number == 570:
-            update_random_string(line, 4, 5, 18, 22)
-        elif line_number == 1395:
-            update_random_string(line, 17, 2, 31, 35)
-        elif line_number == 1610:
-            update_random_string(line, 13, 5, 27, 31)
-        elif line_number == 1620:
-            update_random_string(line, 25, 2, 39, 43)
-        elif line_number == 1630:
-            update_random_string(line, 13, 2, 27, 31)
-        elif line_number == 1640:
-            cached_line_1640 = line
-        elif line_number == 1650:
-            # This is a slightly strange case. They compute the string index
-            # on 1640 and then use it in 1650. We need to check the length of the
-            # new string here and then put it back in 1640.
-            string_length_bytes = int.to_bytes(len(line['tokens'][4]['content']) // 6, 1, byteorder='big')
-            line['tokens'][8]['content'] = string_length_bytes
-            cached_line_1640['tokens'][26]['content'] = string_length_bytes
-            cached_line_1640['tokens'][47]['content'] = string_length_bytes
-        elif line_number == 1760:
-            update_random_string(line, 7, 2, 21, 25)
-        elif line_number == 2105:
-            update_random_string(line, 56, 2, 70, 74)
-        elif line_number == 2200:
-            update_random_string(line, 38, 2, 52, 56)
-        elif line_number == 5250:
-            update_random_string(line, 4, 3, 18, 22)
-
-    # Another pass through all the data... split up text that's too long to
-    # fit in 40 characters. We can do this by breaking it up into multiple strings
-    # and putting semicolons between them; the BASIC parser seems smart enough to
-    # line break if the next string would force a word wrap.
+        previous_op = None
+        for token in line['tokens']:
+            if previous_op != 0xff and token.op in (0xc, 0xf, 0x1c):
+                value = int.from_bytes(token.content, byteorder='little')
+                old_size = 1 + len(token.content)
+                if value < 10:
+                    new_op, new_content = 0x11 + value, None
+                elif value < 0x100:
+                    new_op, new_content = 0xf, bytes([value])
+                elif value < 0x8000:
+                    new_op, new_content = 0x1c, bytes(token.content)
+                else:
+                    new_op = None
+
+                if new_op is not None and 1 + (len(new_content) if new_content is not None else 0) < old_size:
+                    saved += old_size - 1 - (len(new_content) if new_content is not None else 0)
+                    token.op = new_op
+                    token.content = new_content
+            previous_op = token.op
+    return saved
+
+# N-BASIC can't edit a line longer than its 255-byte input buffer, so joined lines stay within that.
+MAX_JOINED_LINE = 0xff
+
+# Whether another line could be tacked onto the end of this one with a colon. Not after an IF, since
+# that would make the new statements conditional; not after a REM, which would swallow them; and not
+# after a string with no closing quote, which would too.
+def can_continue(tokens):
+    if len(tokens) == 0 or (tokens[-1].op == 0x22 and tokens[-1].terminator is None):
+        return False
+
+    previous_op = None
+    for token in tokens:
+        if previous_op != 0xff and token.op in (0x8b, 0x8f):
+            return False
+        previous_op = token.op
+    return True
+
+# Folds each line into the one before it when nothing jumps to it, saving the line header and
+# terminator. Control only ever reached the line by falling through from the one before, so it still
+# runs at exactly the same points.
+def join_lines(lines, references):
+    saved = 0
+    joined_lines = []
     for line in lines:
-
-        # Skip special text... either multiple strings packed together, or combat text.
-        if line['line_number'] in (570,1040,1395,1610,1620,1630,1650,1760,2105,2200,5250,6050,6115,6920):
-            continue
-
-        new_tokens = []
-
-        for token_index, token in enumerate(line['tokens']):
-            if token['op'] == 0x22:
-                try:
-                    text = token['content'].decode('shift-jis')
-                    max_length = 20 if line['line_number'] == 360 and token_index == 4 else 40
-                    if len(text) > max_length:
-                        for split_text_index, split_text in enumerate(textwrap.wrap(text, max_length, drop_whitespace=False)):
-                            if split_text_index > 0:
-                                new_tokens.append({'op': 0x3b})
-                            new_tokens.append({'op': 0x22, 'terminator': 0x22, 'content': split_text.encode('shift-jis')})
-                        #print(line['line_number'], token_index, )
-                    else:
-                        new_tokens.append(token)
-                except UnicodeDecodeError:
-                    new_tokens.append(token)
-            else:
-                new_tokens.append(token)
-
-        #if len(new_tokens) != len(line['tokens']):
-            #print(line['tokens'], new_tokens)
-        line['tokens'] = new_tokens
-
-    output = pack_bytecode(lines)
-
-    print('Orig {0}, result {1}'.format(len(buf), len(output)))
-
+        if len(joined_lines) > 0 and line['line_number'] not in references and len(line['tokens']) > 0:
+            previous = joined_lines[-1]
+            if can_continue(previous['tokens']) and packed_size(previous['tokens']) + 1 + packed_size(line['tokens']) <= MAX_JOINED_LINE:
+                previous['tokens'] = previous['tokens'] + [Token(0x3a)] + line['tokens']
+                references.merge_lines(previous, line)
+                saved += 4
+                continue
+        joined_lines.append(line)
+
+    lines[:] = joined_lines
+    return saved
+
+# Repeated string literals can't safely be shared in N-BASIC (it would mean introducing variables the
+# program might clobber), so these are only reported, as a hint for shortening translations.
+def duplicate_string_bytes(lines):
+    counts = {}
+    for line in lines:
+        for token in line['tokens']:
+            if token.op == 0x22 and len(token.content) >= 4:
+                counts[bytes(token.content)] = counts.get(bytes(token.content), 0) + 1
+    return sum(len(text) * (count - 1) for text, count in counts.items() if count > 1)
+
+# Runs every transform over the lines in place and returns how many bytes each one saved.
+def optimize_program(lines, references=None):
+    if references is None:
+        references = CrossReferenceIndex.from_lines(lines)
+
+    report = {}
+    report['remarks'] = strip_remarks(lines, references)
+    report['spaces'] = strip_spaces(lines)
+    report['constants'] = shrink_constants(lines)
+    report['joined_lines'] = join_lines(lines, references)
+    report['total'] = sum(report.values())
+    report['duplicate_string_bytes'] = duplicate_string_bytes(lines)
+
+    return report
+
+# Directory entries for "Donkey Gorilla", which takes up three entries starting at index 17 on the known
+# disk, all of them in blocks 0x83-0x87. On any other layout there's no telling what's there, so nothing
+# gets reclaimed.
+RECLAIMED_ENTRIES = range(17, 20)
+RECLAIMED_BLOCKS = range(0x83, 0x88)
+
+def patch_directory(directory_table, next_block_table, output_size, image=None, entry=PROGRAM_ENTRY):
     # Surgery on the directory table.
     # First, patch in the new size of the output bytecode.
-    directory_table[(11 * 0x20) + 0x1b:(11 * 0x20) + 0x1d] = len(output).to_bytes(2, byteorder='big')
+    directory_table[(entry * 0x20) + 0x1b:(entry * 0x20) + 0x1d] = output_size.to_bytes(2, byteorder='big')
 
     # Amend the name of the file a little.
-    directory_table[(11 * 0x20) + 0x12:(11 * 0x20) + 0x14] = b'EN'
+    directory_table[(entry * 0x20) + 0x12:(entry * 0x20) + 0x14] = b'EN'
+
+    # Now, there's a game called "Donkey Gorilla" that takes up three entries in the directory.
+    # This game doesn't seem to boot, so we're just going to get rid of it and free up its blocks.
+    # Even with the program where it should be, a re-dump could have other files in those entries, so
+    # they're only reclaimed if their blocks are where Donkey Gorilla's are.
+    if entry == PROGRAM_ENTRY:
+        chains = [block_chain(next_block_table, directory_table[(reclaimed_entry * 0x20) + 0x1f]) for reclaimed_entry in RECLAIMED_ENTRIES]
+        if any(len(chain) == 0 or any(block not in RECLAIMED_BLOCKS for block in chain) for chain in chains):
+            raise Exception('Directory entries {0}-{1} aren\'t Donkey Gorilla on this disk, so there\'s no room to reclaim.'.format(RECLAIMED_ENTRIES[0], RECLAIMED_ENTRIES[-1]))
+        for chain in chains:
+            for block in chain:
+                next_block_table[block] = FREE_BLOCK
+        directory_table[(RECLAIMED_ENTRIES[0] * 0x20):(RECLAIMED_ENTRIES[-1] + 1) * 0x20] = b''
+
+        # And pad it out to compensate.
+        directory_table[:] = directory_table.ljust(0x400, b'\xff')
+
+    # Then make the program's chain long enough to hold the new bytecode. This fails before anything has
+    # been written if there isn't room.
+    return extend_chain(next_block_table, directory_table[(entry * 0x20) + 0x1f], -(-output_size // BLOCK_SIZE), image)
+
+# Works out every sector that has to change in the output image.
+def plan_sector_writes(image, next_block_table, directory_table, output, entry=PROGRAM_ENTRY):
+    writer = ImageWriter(image)
+    write_tables(writer, next_block_table, directory_table)
+    write_chain(writer, next_block_table, directory_table[(entry * 0x20) + 0x1f], output)
+    return writer
+
+# What Dragon & Princess looks like, for finding it wherever it is on a disk: every line the build
+# patches has to be there, the title screen line has its three GOSUB 18500s, and the line with the
+# characters' starting stats has all 25 values.
+DNP_SIGNATURE = Signature(
+    'dragon_and_princess',
+    {line_number for phase, line_number in PATCHES.handlers} | {18500},
+    {
+        18050: rb'(?:.*?\x8d\x0eDH){3}',
+        20160: rb'\x84[^,:\x00]*(?:,[^,:\x00]*){24}',
+    })
+
+def locate_program(image, cache=None):
+    location = locate(image, DNP_SIGNATURE, cache)
+    if location is None:
+        raise Exception('Could not find Dragon & Princess on this disk. If it is there, give its directory entry with --program-entry.')
+    return location['entry']
+
+def build_bps(image, writer):
+    with io.BytesIO() as target:
+        writer.save(target)
+
+        # We know exactly which sectors we touched, so there's no need to diff the rest of the disk.
+        return bps.create_patch(image.data, target.getbuffer(), writer.dirty_ranges())
+
+def load_translations(game_csv='csv/gametext.csv', misc_csv='csv/misctext.csv'):
+    game_text_lookup, game_translations = import_csv(game_csv)
+    misc_text_lookup, misc_translations = import_csv(misc_csv, skip_numbers=True)
+
+    return {
+        'game_text_lookup': game_text_lookup,
+        'game_translations': game_translations,
+        'misc_text_lookup': misc_text_lookup,
+        'misc_translations': misc_translations,
+    }
+
+def untranslated_rows(translations):
+    return {
+        'gametext': sum(1 for key in translations['game_text_lookup'] if key not in translations['game_translations']),
+        'misctext': sum(1 for key in translations['misc_text_lookup'] if key not in translations['misc_translations'] and not is_number(key)),
+    }
+
+def capacity_report(next_block_table, directory_table, output, image=None, entry=PROGRAM_ENTRY):
+    used_blocks = block_chain(next_block_table, directory_table[(entry * 0x20) + 0x1f])
+    return {
+        'patched_size': len(output),
+        'capacity': len(used_blocks) * 8 * 0x100,
+        'used_blocks': len(used_blocks),
+        'free_blocks': free_block_count(next_block_table, image),
+    }
+
+# Runs the whole patch over an open image and works out what needs writing, without writing anything.
+# The program can also be passed in already parsed, as a (next_block_table, directory_table, size, lines)
+# tuple like the cache keeps, in which case it's patched in place.
+def build(image, translations, easy_mode=False, update_csv=False, cache=None, stats=None, optimize=False, program=None, entry=None):
+    if stats is None:
+        stats = BuildStats()
+
+    if entry is None:
+        with stats.stage('locate'):
+            entry = locate_program(image, cache)
+
+    cache_variant = 'easy' if easy_mode else 'normal'
+
+    # Read the sectors of the disk that matter to us. If we've seen this exact image before,
+    # the cache already has the tokenized program.
+    with stats.stage('program_read'):
+        image_crc = zlib.crc32(image.data) if cache is not None else None
+
+        if program is None and cache is not None:
+            program = cache.load_program(image_crc, entry)
+        if program is None:
+            next_block_table, directory_table, buf = read_program(image, entry)
+            orig_size = len(buf)
+
+    if program is None:
+        with stats.stage('unpack_bytecode'):
+            lines = unpack_bytecode(buf)
+        if cache is not None:
+            cache.store_program(image_crc, entry, (next_block_table, directory_table, len(buf), lines))
+    else:
+        next_block_table, directory_table, orig_size, lines = program
+
+    stats.count('lines', len(lines))
+    stats.count('tokens', sum(len(line['tokens']) for line in lines))
 
-    # Now, there's a game called "Donkey Gorilla" that takes up three entries in the directory
-    # starting at index 17. This game doesn't seem to boot, so we're just going to get rid of it.
-    directory_table[(17 * 0x20):(20 * 0x20)] = b''
+    # Build the CSVs if we need to.
+    if update_csv:
+        with stats.stage('update_csv'):
+            csv_changes = update_csvs(lines, translations['game_text_lookup'], translations['misc_text_lookup'])
+        stats.set('update_csv', csv_changes)
+
+    with stats.stage('structural_patches'):
+        unresolved = CrossReferenceIndex.from_lines(lines).unresolved(lines)
+        apply_structural_patches(lines, easy_mode)
+        check_references(lines, unresolved)
+
+    # Now patch in translations and everything that depends on them, reusing whatever lines the cache
+    # already has results for.
+    cache_lookup = cache.load_lines(image_crc, cache_variant) if cache is not None else None
+    results = translate_program(lines, translations['game_translations'], translations['misc_translations'], cache_lookup, stats)
+    if cache_lookup is not None and results.keys() != cache_lookup.keys():
+        cache.store_lines(image_crc, cache_variant, results)
+
+    # See where all the text ends up on screen. Lines that came out of the cache are only there as packed
+    # bytes, so this (and the optimizer) works on a fresh tokenization of the translated program.
+    with stats.stage('layout'):
+        layout = check_layout(lines if cache_lookup is None else unpack_bytecode(pack_bytecode(lines)), skip_lines=SPECIAL_TEXT_LINES, margins=TEXT_MARGINS)
+    stats.set('layout', layout_summary(layout))
+
+    if optimize:
+        with stats.stage('optimize'):
+            references = CrossReferenceIndex()
+            lines = unpack_bytecode(pack_bytecode(lines), references)
+            stats.set('optimizer', optimize_program(lines, references))
+
+    line_sizes = {}
+    with stats.stage('pack_bytecode'):
+        output = pack_bytecode(lines, line_sizes)
+
+    with stats.stage('sector_plan'):
+        added_blocks = patch_directory(directory_table, next_block_table, len(output), image, entry)
+        writer = plan_sector_writes(image, next_block_table, directory_table, output, entry)
+
+    capacity = capacity_report(next_block_table, directory_table, output, image, entry)
+    stats.set('program', {'original_size': orig_size, 'patched_size': len(output), 'capacity': capacity['capacity']})
+    stats.set('blocks', {'used': capacity['used_blocks'], 'free': capacity['free_blocks'], 'added': added_blocks})
+    stats.set('bytes_per_line', line_sizes)
+
+    return {
+        'entry': entry,
+        'lines': lines,
+        'orig_size': orig_size,
+        'output': output,
+        'writer': writer,
+        'layout': layout,
+    }
+
+def copy_token(token):
+    copy = Token(token.op, token.content, list(token.fields) if token.fields is not None else None, token.terminator)
+    copy.text_index = token.text_index
+    return copy
+
+def copy_line(line):
+    copy = dict(line)
+    copy['tokens'] = [copy_token(token) for token in line['tokens']]
+    return copy
+
+def changed_translations(old, new):
+    return {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+# The lines a translation key affects: every line with the text in it, or just the one line for a
+# translation of a single occurrence.
+def text_lines(lines_by_text, key):
+    return {key[0]} if isinstance(key, tuple) else lines_by_text.get(key, set())
+
+# Keeps the tokenized program resident between builds, so that when the CSVs change only the lines
+# containing text whose translation changed (and the lines that depend on them) are redone. This is
+# what --watch runs on.
+class WatchSession:
+    def __init__(self, image, easy_mode=False, optimize=False, entry=None):
+        self.image = image
+        self.optimize = optimize
+        self.optimizer_report = None
+
+        self.entry, self.next_block_table, self.directory_table, buf = read_program_from(image, entry)
+        self.orig_size = len(buf)
+
+        # These stay as they are after the structural patches; every rebuild translates fresh copies.
+        references = CrossReferenceIndex()
+        self.lines = unpack_bytecode(buf, references)
+        unresolved = references.unresolved(self.lines)
+        apply_structural_patches(self.lines, easy_mode)
+        check_references(self.lines, unresolved)
+
+        # Which lines each piece of original text turns up in.
+        self.game_text_lines = {}
+        self.misc_text_lines = {}
+        for line in self.lines:
+            for token in line['tokens']:
+                if token.op == 0x22:
+                    self.game_text_lines.setdefault(token.content, set()).add(line['line_number'])
+                elif token.op == 0x84:
+                    for field in token.fields:
+                        self.misc_text_lines.setdefault(field, set()).add(line['line_number'])
+
+        self.game_translations = None
+        self.misc_translations = None
+        self.packed = {}
+        self.text = {}
+
+        self.writer = None
+        self.saved_writer = None
+        self.capacity = None
+
+    # Returns a list of (line_number, old_size, new_size, text) for every line whose bytecode changed.
+    # The old size is None for the first build.
+    def rebuild(self, translations):
+        game_translations = translations['game_translations']
+        misc_translations = translations['misc_translations']
+
+        # Anything that hasn't been built yet, because this is the first build or an earlier one failed
+        # partway through, has to be done regardless.
+        stale = {line['line_number'] for line in self.lines if line['line_number'] not in self.packed}
+        if self.game_translations is not None:
+            for key in changed_translations(self.game_translations, game_translations):
+                stale |= text_lines(self.game_text_lines, key)
+            for key in changed_translations(self.misc_translations, misc_translations):
+                stale |= text_lines(self.misc_text_lines, key)
+        stale = PATCHES.related(stale)
+
+        dirty_lines = [copy_line(line) for line in self.lines if line['line_number'] in stale]
+        PATCHES.run_pipeline(dirty_lines, {'game_translations': game_translations, 'misc_translations': misc_translations, 'stats': BuildStats()})
+
+        changes = []
+        for line in dirty_lines:
+            packed = bytearray()
+            pack_tokens(line['tokens'], packed)
+            packed = bytes(packed)
+
+            old_packed = self.packed.get(line['line_number'])
+            if packed != old_packed:
+                parts = []
+                for token in line['tokens']:
+                    if token.op == 0x22:
+                        parts.append('"{0}"'.format(str(token.content, 'pc8801')))
+                    elif token.op == 0x84:
+                        parts.append(','.join(str(field, 'pc8801') for field in token.fields))
+                text = ' '.join(parts)
+                changes.append((line['line_number'], len(old_packed) if old_packed is not None else None, len(packed), text))
+            self.packed[line['line_number']] = packed
+
+        self.game_translations = game_translations
+        self.misc_translations = misc_translations
+
+        output = pack_bytecode([{'line_number': line['line_number'], 'packed': self.packed[line['line_number']]} for line in self.lines])
+        if self.optimize:
+            references = CrossReferenceIndex()
+            optimized_lines = unpack_bytecode(output, references)
+            self.optimizer_report = optimize_program(optimized_lines, references)
+            output = pack_bytecode(optimized_lines)
+
+        next_block_table = bytearray(self.next_block_table)
+        directory_table = bytearray(self.directory_table)
+        patch_directory(directory_table, next_block_table, len(output), self.image, self.entry)
+
+        self.capacity = capacity_report(next_block_table, directory_table, output, self.image, self.entry)
+        self.writer = plan_sector_writes(self.image, next_block_table, directory_table, output, self.entry)
+
+        return changes
+
+    # Once the output image has been written in full, later saves only rewrite the sectors that changed.
+    def save(self, target):
+        if self.saved_writer is not None and os.path.exists(target):
+            written = self.writer.save_changes(target, self.saved_writer)
+        else:
+            self.writer.save(target)
+            written = len(self.image.data)
+
+        self.saved_writer = self.writer
+        return written
+
+def print_watch_report(changes, capacity, elapsed):
+    for line_number, old_size, new_size, text in changes:
+        if len(text) > 50:
+            text = text[:47] + '...'
+        print('  {0:5d}: {1:>4} -> {2:4d} bytes  {3}'.format(line_number, old_size, new_size, text))
+
+    print('{0} line(s) changed in {1:.1f} ms. Program is {2} of {3} bytes, {4} block(s) free.'.format(
+        len(changes), elapsed * 1000, capacity['patched_size'], capacity['capacity'], capacity['free_blocks']))
+
+def watch(image, out_disk_image, easy_mode=False, emit_bps=None, optimize=False, entry=None, game_csv='csv/gametext.csv', misc_csv='csv/misctext.csv'):
+    session = WatchSession(image, easy_mode, optimize, entry)
+
+    with FileWatcher([game_csv, misc_csv]) as watcher:
+        first = True
+        while True:
+            start = time.perf_counter()
+            try:
+                changes = session.rebuild(load_translations(game_csv, misc_csv))
+                session.save(out_disk_image)
+                if emit_bps:
+                    with open(emit_bps, 'wb') as out_file:
+                        out_file.write(build_bps(image, session.writer))
+            except Exception as error:
+                # Keep watching; the next save of the CSVs may well fix it.
+                print('Build failed: {0}'.format(error))
+            else:
+                elapsed = time.perf_counter() - start
+                if first:
+                    print('Orig {0}, result {1}'.format(session.orig_size, session.capacity['patched_size']))
+                    print('Built in {0:.1f} ms. Program is {1} of {2} bytes, {3} block(s) free.'.format(
+                        elapsed * 1000, session.capacity['patched_size'], session.capacity['capacity'], session.capacity['free_blocks']))
+                else:
+                    print_watch_report(changes, session.capacity, elapsed)
+            first = False
+
+            print('Watching {0} and {1} for changes ({2})...'.format(game_csv, misc_csv, watcher.method))
+            sys.stdout.flush()
+            watcher.wait()
+
+if __name__ == '__main__':
 
-    # And pad it out to compensate.
-    directory_table = directory_table.ljust(0x400, b'\xff')
+    parser = argparse.ArgumentParser('Main patch build for Dragon & Princess')
+    parser.add_argument('in_disk_image', help='Disk image to scan for original text.')
+    parser.add_argument('out_disk_image', help='Output disk image, or - for stdout. Will be overwritten if already present.')
 
-    # Deleting that frees up blocks 0x83 through 0x87. Let's just use 0x83~0x84 for overflow for now. Update
-    # the next-block table accordingly.
-    orig_terminator = next_block_table[0x5c]
-    next_block_table[0x5c] = 0x83
-    next_block_table[0x83] = 0x84
-    next_block_table[0x84] = orig_terminator
+    parser.add_argument('--update-csv', help='Whether the CSV files should be created/updated with the strings found in the scan. Rows whose text hasn\'t moved are left as they are, and the files are only rewritten if something changed.', action='store_true')
+    parser.add_argument('--easy-mode', help='Whether the game data should be modified to make the game easier (for testing!)', action='store_true')
+    parser.add_argument('--cache-dir', help='Directory for the incremental build cache.', default='.build_cache')
+    parser.add_argument('--no-cache', help='Rebuild everything from scratch without reading or writing the build cache.', action='store_true')
+    parser.add_argument('--stats', help='Write timings and counters for each build stage as JSON to this file, or to stdout if no file is given.', nargs='?', const='-', metavar='JSON_FILE')
+    parser.add_argument('--profile', help='Run the hot stages under cProfile and dump the results to this file.', metavar='PROFILE_FILE')
+    parser.add_argument('--profile-stage', help='Stage to include in --profile (can be repeated). Defaults to the tokenizer, the translation pipeline and the packing stage.', action='append', dest='profile_stages')
+    parser.add_argument('--emit-bps', help='Also write a BPS patch from the input image to the output image at this path.', metavar='BPS_FILE')
+    parser.add_argument('--layout', help='List every string that doesn\'t fit on screen, breaks a word or overlaps other text, to this file or to stdout if no file is given.', nargs='?', const='-', metavar='LAYOUT_FILE')
+    parser.add_argument('--listing', help='Also write a BASIC listing of the patched program to this file, for diffing between builds.', metavar='LISTING_FILE')
+
+    parser.add_argument('--optimize', help='Shrink the patched program: strip remarks and spaces, use the smallest constant encodings and join lines nothing jumps to.', action='store_true')
+    parser.add_argument('--program-entry', help='Directory entry of the Dragon & Princess program on the disk. Found automatically if not given.', type=int)
+    parser.add_argument('--watch', help='Stay running, and rebuild the output image whenever the CSV files change.', action='store_true')
 
+    args = parser.parse_args()
 
-    # Make a new copy of the input image at the output file name.
-    shutil.copyfile(args.in_disk_image, args.out_disk_image)
+    if args.watch:
+        if args.out_disk_image == '-':
+            parser.error('--watch needs an output file, not stdout.')
+        if args.update_csv:
+            parser.error('--update-csv can\'t be combined with --watch, since it rewrites the files being watched.')
 
-    # Then overwrite the important sectors in the output file with chunks from the local buffer.
-    with open(args.out_disk_image, 'r+b') as out_file, io.BytesIO(output) as data:
+        with D88Image.open(args.in_disk_image) as image:
+            try:
+                watch(image, args.out_disk_image, args.easy_mode, args.emit_bps, args.optimize, args.program_entry)
+            except KeyboardInterrupt:
+                pass
+        sys.exit(0)
 
-        out_file.seek(0x800 + 0x10)
-        out_file.write(next_block_table)
+    profile_stages = ()
+    if args.profile:
+        profile_stages = args.profile_stages or ('unpack_bytecode', 'pipeline', 'pack_bytecode')
+    stats = BuildStats(profile_stages)
 
-        out_file.seek(0x910)
-        with io.BytesIO(directory_table) as dir_data:
-            for _ in range(4):
-                out_file.seek(0x10, os.SEEK_CUR)
-                out_file.write(dir_data.read(0x100))
+    # Load the current CSVs
+    with stats.stage('csv_import'):
+        translations = load_translations()
+    stats.set('untranslated_rows', untranslated_rows(translations))
 
-        current_block = directory_table[(11 * 0x20) + 0x1f]
-        while current_block < 0xc0:
-            track_index = current_block // 2
-            sector_index = (current_block % 2) * 8
-            address = track_start_address_list[track_index] + sector_index * 0x110
+    cache = None if args.no_cache else BuildCache(args.cache_dir, script_hash())
 
-            out_file.seek(address)
-            for _ in range(8):
-                out_file.seek(0x10, os.SEEK_CUR)
+    with stats.stage('image_open'):
+        image = D88Image.open(args.in_disk_image)
 
-                sector = data.read(0x100).ljust(0x100, b'\xff')
-                out_file.write(sector)
+    result = build(image, translations, args.easy_mode, args.update_csv, cache, stats, args.optimize, entry=args.program_entry)
 
-            current_block = next_block_table[current_block]
+    # Keep stdout clean if the image itself is going there.
+    report_file = sys.stderr if args.out_disk_image == '-' else sys.stdout
+    print('Orig {0}, result {1}'.format(result['orig_size'], len(result['output'])), file=report_file)
+    if args.optimize:
+        report = stats.details['optimizer']
+        print('Optimizer saved {0} bytes: remarks {1}, spaces {2}, constants {3}, joined lines {4}. {5} bytes are in repeated strings.'.format(
+            report['total'], report['remarks'], report['spaces'], report['constants'], report['joined_lines'], report['duplicate_string_bytes']), file=report_file)
 
-        leftover_data = data.read()
-        if len(leftover_data) > 0:
-            raise Exception('Ran out of space! {0} bytes were not written.'.format(len(leftover_data)))
+    if args.update_csv:
+        for name, changes in stats.details['update_csv'].items():
+            print('{0}.csv: {1} added, {2} removed, {3} moved{4}.'.format(
+                name, len(changes['added']), len(changes['removed']), len(changes['moved']), '' if changes['written'] else ' (unchanged)'), file=report_file)
+
+    summary = stats.details['layout']
+    if any(count > 0 for count in summary.values()):
+        print('Layout: {overflow} overflow(s), {bad_break} bad break(s), {overlap} overlap(s), {off_screen} off screen.'.format(**summary), file=report_file)
+    if args.layout:
+        if args.layout == '-':
+            for issue in result['layout']:
+                print(format_issue(issue), file=report_file)
+        else:
+            with open(args.layout, 'w', encoding='utf8') as out_file:
+                for issue in result['layout']:
+                    out_file.write(format_issue(issue) + '\n')
+
+    with stats.stage('sector_write'):
+        result['writer'].save(args.out_disk_image)
+
+    if args.emit_bps:
+        with stats.stage('bps'):
+            with open(args.emit_bps, 'wb') as out_file:
+                out_file.write(build_bps(image, result['writer']))
+
+    if args.listing:
+        with stats.stage('listing'):
+            with open(args.listing, 'w', encoding='utf8') as out_file:
+                for text in list_program(unpack_bytecode(result['output'])):
+                    out_file.write(text + '\n')
+
+    image.close()
+
+    if args.stats:
+        write_json(stats.report(), args.stats, report_file, sort_keys=True)
+
+    if args.profile:
+        stats.dump_profile(args.profile)
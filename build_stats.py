@@ -0,0 +1,64 @@
+import contextlib
+import cProfile
+import json
+import sys
+import time
+
+# Writes a JSON report to a file, or to stdout (or whatever stream is given) if the target is '-', which
+# is how every --json and --stats option takes it. Any other keyword arguments go to json.dumps.
+def write_json(report, target, stdout=None, **options):
+    text = json.dumps(report, indent=2, **options)
+    if target == '-':
+        print(text, file=stdout if stdout is not None else sys.stdout)
+    else:
+        with open(target, 'w', encoding='utf8') as out_file:
+            out_file.write(text)
+
+class BuildStats:
+    def __init__(self, profile_stages=()):
+        self.timings = {}
+        self.counters = {}
+        self.details = {}
+
+        # Stages listed here also run under cProfile, so their hot spots can be dumped afterwards.
+        self.profile_stages = set(profile_stages)
+        self.profiler = cProfile.Profile() if len(self.profile_stages) > 0 else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiling = self.profiler is not None and name in self.profile_stages
+        if profiling:
+            self.profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start)
+            if profiling:
+                self.profiler.disable()
+
+    # For time measured some other way than stage(), like the pipeline's phases, which interleave.
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        self.details[name] = value
+
+    def report(self):
+        report = {
+            'timings': {name: round(seconds, 6) for name, seconds in self.timings.items()},
+            'counters': self.counters,
+        }
+        report.update(self.details)
+        return report
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2, sort_keys=True)
+
+    def dump_profile(self, filename):
+        if self.profiler is not None:
+            self.profiler.dump_stats(filename)
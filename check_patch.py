@@ -0,0 +1,282 @@
+import argparse
+import csv
+import io
+import os
+import tempfile
+
+import build_patch
+from bench_patch import FIRST_LINE_NUMBER, make_image, make_program, make_vocabulary
+from build_patch import RANDOM_STRING_1650, RANDOM_STRING_LINES, optimize_program, pack_bytecode, scanned_texts, unpack_bytecode, update_csv
+from cross_reference import CrossReferenceIndex, referencing_tokens, target
+from d88 import D88Image
+from nbasic import SMALL_INTEGER, SMALL_INTEGER_MAX, Token
+
+# Correctness checks for the build, run over the same synthetic programs and disk images as the
+# benchmarks (see bench_patch.py), so they don't need the original disk either. Each check raises an
+# exception as soon as something's wrong.
+
+PROGRAM_SIZES = [0x1000, 0x8000]
+
+# Builds the program's image in both variants, finding the program on it the way a real build would,
+# and checks that the patches all landed: the added lines are there, the packed random strings' lengths
+# match their translated strings, the title screen has its credits, and easy mode has its changes.
+def check_build(program, translations):
+    packs = dict(RANDOM_STRING_LINES)
+    # Line 1650 has its substring length just once, at token 8.
+    packs[1650] = RANDOM_STRING_1650 + (8, 8)
+
+    # The packed strings aren't in the vocabulary; give them translations of a different length, so
+    # leaving any of the lengths alone shows.
+    original_lines = {line['line_number']: line for line in unpack_bytecode(program)}
+    game_translations = dict(translations['game_translations'])
+    for line_number, (string_index, string_count, _, _) in packs.items():
+        game_translations[bytes(original_lines[line_number]['tokens'][string_index].content)] = b'ABCDEFGHIJKLMNOP' * string_count
+    translations = dict(translations, game_translations=game_translations)
+
+    for easy_mode in (False, True):
+        image = D88Image(make_image(program))
+        result = build_patch.build(image, translations, easy_mode)
+        with io.BytesIO() as out_file:
+            result['writer'].save(out_file)
+        image.close()
+
+        lines = {line['line_number']: line for line in unpack_bytecode(result['output'])}
+        for line_number in (221, 20165):
+            if line_number not in lines:
+                raise Exception('The build didn\'t add line {0}.'.format(line_number))
+
+        for line_number, (string_index, string_count, length_index_1, length_index_2) in packs.items():
+            tokens = lines[line_number]['tokens']
+            length = len(tokens[string_index].content) // string_count
+            if tokens[length_index_1].content[0] != length or tokens[length_index_2].content[0] != length:
+                raise Exception('Line {0}\'s substring length wasn\'t updated to {1}.'.format(line_number, length))
+        if lines[1640]['tokens'][26].content[0] != lines[1650]['tokens'][8].content[0]:
+            raise Exception('Line 1640 doesn\'t use the substring length from line 1650.')
+
+        credits = [bytes(token.content) for token in lines[18050]['tokens'] if token.op == 0x22]
+        if b'EN translation patch 1.01' not in credits or (b'EASY MODE!!' in credits) != easy_mode:
+            raise Exception('The title screen credits are wrong for the {0} variant.'.format('easy' if easy_mode else 'normal'))
+        if easy_mode and (lines[5510]['tokens'][0].op != 0x8f or lines[20160]['tokens'][0].fields[0] != b'127'):
+            raise Exception('The easy mode changes didn\'t land.')
+
+def index_entries(references):
+    return {line_number: sorted((id(line), id(token)) for line, token in entries) for line_number, entries in references.references.items() if len(entries) > 0}
+
+# Checks that an index kept up to date through edits is the one a fresh scan would build, that the lines
+# are still in order, and that every reference still goes to the line it went to before.
+def check_index(references, lines, owners, what):
+    if index_entries(references) != index_entries(CrossReferenceIndex.from_lines(lines)):
+        raise Exception('The cross-reference index is out of date after {0}.'.format(what))
+    if any(line['line_number'] >= next_line['line_number'] for line, next_line in zip(lines, lines[1:])):
+        raise Exception('The lines are out of order after {0}.'.format(what))
+    for token, line in owners:
+        if line is not None and target(token) != line['line_number']:
+            raise Exception('A reference to line {0} goes to {1} after {2}.'.format(line['line_number'], target(token), what))
+    for line_number in references.targets():
+        if any(target(token) != line_number or token not in line['tokens'] for line, token in references.references_to(line_number)):
+            raise Exception('references_to({0}) gives the wrong tokens after {1}.'.format(line_number, what))
+
+# Checks the cross-reference index and the edits made through it: the index built while unpacking, and
+# renumbering, inserting and removing lines, which have to keep every reference pointing at the line it
+# pointed at. Renumbering that would reorder the lines has to be refused without changing anything.
+def check_cross_references(program):
+    references = CrossReferenceIndex()
+    lines = unpack_bytecode(program, references)
+    by_number = {line['line_number']: line for line in lines}
+    owners = [(token, by_number.get(target(token))) for line in lines for token in referencing_tokens(line['tokens'])]
+    check_index(references, lines, owners, 'unpacking')
+
+    before = pack_bytecode(lines)
+    for mapping in ({lines[0]['line_number']: lines[-1]['line_number'] + 1}, {lines[1]['line_number']: lines[0]['line_number']}):
+        try:
+            references.renumber(lines, mapping)
+        except ValueError:
+            pass
+        else:
+            raise Exception('Renumbering with {0} was allowed.'.format(mapping))
+        if pack_bytecode(lines) != before:
+            raise Exception('A refused renumbering changed the program.')
+
+    # Close up the generated lines so there are no gaps, which makes inserting move the lines after.
+    references.renumber_from(lines, FIRST_LINE_NUMBER, FIRST_LINE_NUMBER, 1)
+    check_index(references, lines, owners, 'renumbering')
+
+    for line in lines[len(lines) // 2::7]:
+        line_number = references.insert_after(lines, line['line_number'], [Token(0x8d), Token(0xe, content=line['line_number'].to_bytes(2, byteorder='little'))])
+        inserted = lines[lines.index(line) + 1]
+        if inserted['line_number'] != line_number or line_number <= line['line_number']:
+            raise Exception('Line {0} was inserted in the wrong place.'.format(line_number))
+        owners.append((inserted['tokens'][1], line))
+    check_index(references, lines, owners, 'inserting lines')
+
+    for line in [line for line in lines if next(referencing_tokens(line['tokens']), None) is not None and line['line_number'] not in references][::2]:
+        references.remove_line(line)
+        lines.remove(line)
+    kept = {id(token) for line in lines for token in line['tokens']}
+    owners = [(token, line) for token, line in owners if id(token) in kept]
+    check_index(references, lines, owners, 'removing lines')
+
+# The lines whose strings the structural patches move, delete or add to.
+REARRANGED_LINES = (303, 2640, 2641, 2840, 2841, 2842, 18050)
+
+# Checks that translations made for one spot in the CSV still land on that spot after the structural
+# patches have moved strings around. Every string on the rearranged lines is given the same text, with a
+# row for each occurrence translated differently, so any occurrence looked up at the wrong index gets
+# somebody else's translation.
+def check_translation_positions(program):
+    text = 'ﾃｷｽﾄ'.encode('pc8801')
+    lines = unpack_bytecode(program)
+    for line in lines:
+        if line['line_number'] in REARRANGED_LINES:
+            for token in line['tokens']:
+                if token.op == 0x22:
+                    token.content = text
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'gametext.csv')
+        with open(filename, 'w', encoding='utf8', newline='') as out_file:
+            writer = csv.writer(out_file, lineterminator='\n')
+            for (line_number, string_index), scanned_text in scanned_texts(lines):
+                writer.writerow([line_number, string_index, str(scanned_text, 'pc8801'), '{0}/{1}'.format(line_number, string_index)])
+        game_translations = build_patch.import_csv(filename)[1]
+
+    # Keyed by id(), holding on to the tokens so the ids of ones the patches drop aren't reused.
+    expected = {}
+    for line in lines:
+        for token, field_index, string_index in build_patch.line_texts(line):
+            if field_index is None:
+                expected[id(token)] = (token, '{0}/{1}'.format(line['line_number'], string_index).encode('pc8801'))
+
+    build_patch.apply_structural_patches(lines, False)
+    # Only strings the patches kept as they were still have their own row.
+    kept = [(line, token) for line in lines for token in line['tokens'] if id(token) in expected and bytes(token.content) == text]
+    build_patch.translate_program(lines, game_translations, {})
+
+    for line, token in kept:
+        translation = expected[id(token)][1]
+        if bytes(token.content) != translation:
+            raise Exception('Line {0} got the translation for {1} instead of {2}.'.format(
+                line['line_number'], str(bytes(token.content), 'pc8801'), str(translation, 'pc8801')))
+
+# What a line does, for comparing programs before and after optimize_program(): its statements, minus
+# remarks and the spaces between tokens, with integer constants reduced to their values.
+def line_statements(line):
+    statements = [[]]
+    previous_op = None
+    for token in line['tokens']:
+        if previous_op == 0xff:
+            statements[-1].append((token.op, None))
+        elif token.op == 0x3a:
+            statements.append([])
+        elif token.op in (0xc, 0xf, 0x1c):
+            statements[-1].append(('int', int.from_bytes(token.content, byteorder='little')))
+        elif SMALL_INTEGER <= token.op <= SMALL_INTEGER + SMALL_INTEGER_MAX:
+            statements[-1].append(('int', token.op - SMALL_INTEGER))
+        elif token.op != 0x20:
+            content = bytes(token.content) if token.content is not None else None
+            fields = [bytes(field) for field in token.fields] if token.fields is not None else None
+            statements[-1].append((token.op, content, fields, token.terminator))
+        previous_op = token.op
+    return [statement for statement in statements if len(statement) > 0 and statement[0][0] != 0x8f]
+
+# Whether statements can follow the line's own: not if it has an IF, or ends in an unterminated string.
+def can_be_continued(line):
+    statements = line_statements(line)
+    if any(item[0] == 0x8b for statement in statements for item in statement):
+        return False
+    return len(statements) == 0 or statements[-1][-1][0] != 0x22 or statements[-1][-1][3] is not None
+
+# Checks that optimize_program() kept the program doing the same thing: every line it kept was in the
+# original, each one runs exactly the statements of the original lines folded into it, nothing was
+# folded onto the end of an IF or an unterminated string, every reference still has somewhere to go,
+# and the bytes it says it saved are the bytes that are gone.
+def check_optimizer(program):
+    original_lines = unpack_bytecode(program)
+    references = CrossReferenceIndex()
+    lines = unpack_bytecode(program, references)
+    report = optimize_program(lines, references)
+    output = bytes(pack_bytecode(lines))
+
+    if bytes(pack_bytecode(unpack_bytecode(output))) != output:
+        raise Exception('The optimized {0}-byte program doesn\'t survive an unpack->pack round trip.'.format(len(program)))
+    if len(output) != len(program) - report['total']:
+        raise Exception('The optimizer reported saving {0} bytes of the {1}-byte program, but saved {2}.'.format(report['total'], len(program), len(program) - len(output)))
+
+    original_numbers = [line['line_number'] for line in original_lines]
+    for index, line in enumerate(lines):
+        if line['line_number'] not in original_numbers:
+            raise Exception('The optimizer made up line {0}.'.format(line['line_number']))
+
+        end = lines[index + 1]['line_number'] if index + 1 < len(lines) else 0x10000
+        group = [original for original in original_lines if line['line_number'] <= original['line_number'] < end]
+        if line_statements(line) != [statement for original in group for statement in line_statements(original)]:
+            raise Exception('Optimized line {0} doesn\'t do what the original lines {1} did.'.format(line['line_number'], [original['line_number'] for original in group]))
+
+        for original in [original for original in group if len(line_statements(original)) > 0][:-1]:
+            if not can_be_continued(original):
+                raise Exception('The optimizer joined more onto line {0} of optimized line {1}, which can\'t be continued.'.format(original['line_number'], line['line_number']))
+
+    if not CrossReferenceIndex.from_lines(lines).unresolved(lines) <= CrossReferenceIndex.from_lines(original_lines).unresolved(original_lines):
+        raise Exception('The optimizer dropped a line that something in the {0}-byte program jumps to.'.format(len(program)))
+
+    return report
+
+def read_rows(filename):
+    with open(filename, encoding='utf8', newline='') as in_file:
+        return list(csv.reader(in_file, lineterminator='\n'))
+
+# Checks update_csv() against a program's text: a fresh CSV gets a row for every string, running it
+# again changes nothing, hand edits survive, and text on a renumbered line keeps its row.
+def check_update_csv(program, lookup):
+    lines = unpack_bytecode(program)
+    scanned = list(scanned_texts(lines))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'gametext.csv')
+        report = update_csv(filename, scanned, lookup)
+        if len(report['added']) != len(scanned) or len(read_rows(filename)) != len(scanned):
+            raise Exception('update_csv() wrote {0} rows for {1} strings.'.format(len(read_rows(filename)), len(scanned)))
+
+        rows = read_rows(filename)
+        rows[0][3:] = ['hand-edited translation', 'a note']
+        with open(filename, 'w', encoding='utf8', newline='') as out_file:
+            csv.writer(out_file, lineterminator='\n').writerows(rows)
+
+        report = update_csv(filename, scanned, lookup)
+        if report['written'] or report['added'] or report['removed'] or report['moved'] or read_rows(filename) != rows:
+            raise Exception('update_csv() changed a CSV the program\'s text still matches.')
+
+        # Renumbering the first line with text moves it; the line numbers step by more than one.
+        moved_line = next(line for line in lines if line['line_number'] == int(rows[0][0]))
+        moved_line['line_number'] += 1
+        report = update_csv(filename, scanned_texts(lines), lookup)
+        moved_rows = [row for row in read_rows(filename) if row[0] == str(moved_line['line_number'])]
+        if report['added'] or report['removed'] or len(report['moved']) != len(moved_rows) or moved_rows[0][2:] != rows[0][2:]:
+            raise Exception('update_csv() didn\'t carry line {0}\'s rows over to its new number.'.format(rows[0][0]))
+
+def run(seed):
+    game_translations, misc_translations = make_vocabulary(seed)
+    translations = {
+        'game_text_lookup': {text: [translation.decode('ascii')] for text, translation in game_translations.items()},
+        'game_translations': game_translations,
+        'misc_text_lookup': {text: [translation.decode('ascii')] for text, translation in misc_translations.items()},
+        'misc_translations': misc_translations,
+    }
+
+    for size in PROGRAM_SIZES:
+        program = make_program(size, list(game_translations), list(misc_translations), seed + size)
+        check_build(program, translations)
+        check_cross_references(program)
+        check_optimizer(program)
+        check_update_csv(program, translations['game_text_lookup'])
+        check_translation_positions(program)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Correctness checks for the Dragon & Princess patch build, over synthetic data')
+    parser.add_argument('--seed', help='Seed for the synthetic programs.', type=int, default=1982)
+
+    args = parser.parse_args()
+
+    run(args.seed)
+    print('All checks passed.')
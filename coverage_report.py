@@ -0,0 +1,173 @@
+import argparse
+import sys
+
+import build_patch
+from build_patch import RANDOM_STRING_1650, RANDOM_STRING_LINES, copy_line, find_translation, line_texts, original_text_index
+from build_stats import BuildStats, write_json
+from d88 import D88Image
+from loader_fs import BLOCK_SIZE, DIRECTORY_ENTRY_SIZE, FIRST_BLOCK_OFFSET, block_chain
+from nbasic import pack_bytecode, unpack_bytecode
+import pc88codec # Registers the pc8801 text encodings.
+
+# How far the translation has got and where the program's bytes go, without building a disk. The
+# program is put through the same structural patches and translation pipeline as a real build, and then
+# every line is accounted for in one pass: its size before and after, where it starts in the block
+# chain, and whether each piece of its text is translated, untranslated, or not text at all (bytes that
+# don't decode as anything but control codes, which can't have a CSV row).
+#
+# The lines that pick a random substring out of one long string (see RANDOM_STRING_LINES) are checked
+# too. The build divides the translated string's length by the number of substrings, so a translation
+# whose length isn't a multiple of it has pieces that spill into their neighbours.
+
+# Where each random-string line's packed string is, and how many substrings it holds.
+RANDOM_STRING_PACKS = {line_number: pack[:2] for line_number, pack in RANDOM_STRING_LINES.items()}
+RANDOM_STRING_PACKS[1650] = RANDOM_STRING_1650
+
+def text_status(text, translation):
+    try:
+        str(text, 'pc8801-strict')
+    except UnicodeDecodeError:
+        return 'undecodable'
+    return 'untranslated' if translation is None else 'translated'
+
+def check_pack(line, original_lengths):
+    token_index, string_count = RANDOM_STRING_PACKS[line['line_number']]
+    length = len(line['tokens'][token_index].content)
+    return {
+        'line_number': line['line_number'],
+        'string_index': sum(1 for token in line['tokens'][:token_index] if token.op == 0x22),
+        'original_length': original_lengths.get(line['line_number']),
+        'length': length,
+        'substrings': string_count,
+        'remainder': length % string_count,
+    }
+
+# Returns the report for a program read from a disk, given its loader tables and the translations from
+# load_translations().
+def analyze(next_block_table, directory_table, buf, translations, entry=build_patch.PROGRAM_ENTRY, easy_mode=False):
+    lines = unpack_bytecode(buf)
+    original_lines = {line['line_number']: line for line in lines}
+    chain = block_chain(next_block_table, directory_table[entry * DIRECTORY_ENTRY_SIZE + FIRST_BLOCK_OFFSET])
+
+    build_patch.apply_structural_patches(lines, easy_mode)
+
+    # Everything that depends on the original text has to be looked at before it's translated.
+    records = []
+    translated_lines = []
+    original_lengths = {}
+    previous_addr = 1
+    for line in lines:
+        line_number = line['line_number']
+        record = {'line_number': line_number, 'original_size': 0, 'strings': []}
+
+        # The link address is one past the end of the line, so sizes fall out of consecutive ones. Lines
+        # the structural patches added weren't there before.
+        if line is original_lines.get(line_number):
+            record['original_size'] = line['orig_addr'] - previous_addr
+            previous_addr = line['orig_addr']
+
+        for token, field_index, _ in line_texts(line):
+            # The CSVs number text as it was before the structural patches.
+            string_index = original_text_index(token, field_index)
+            if field_index is None:
+                text = token.content
+                translation = find_translation(translations['game_translations'], line_number, string_index, text)
+            else:
+                text = token.fields[field_index]
+                translation = find_translation(translations['misc_translations'], line_number, string_index, text)
+
+            record['strings'].append({
+                'csv': 'gametext' if field_index is None else 'misctext',
+                'string_index': string_index,
+                'status': text_status(text, translation),
+                'text': str(text, 'pc8801'),
+            })
+
+        if line_number in RANDOM_STRING_PACKS:
+            original_lengths[line_number] = len(line['tokens'][RANDOM_STRING_PACKS[line_number][0]].content)
+
+        records.append(record)
+        translated_lines.append(copy_line(line))
+
+    build_patch.PATCHES.run_pipeline(translated_lines, {'game_translations': translations['game_translations'], 'misc_translations': translations['misc_translations'], 'stats': BuildStats()})
+
+    line_sizes = {}
+    output = pack_bytecode(translated_lines, line_sizes)
+
+    capacity = len(chain) * BLOCK_SIZE
+    offset = 0
+    counts = {'translated': 0, 'untranslated': 0, 'undecodable': 0}
+    packs = []
+    for record, line in zip(records, translated_lines):
+        record['translated_size'] = line_sizes[record['line_number']]
+        record['growth'] = record['translated_size'] - record['original_size']
+        record['offset'] = offset
+        record['block'] = chain[offset // BLOCK_SIZE] if offset // BLOCK_SIZE < len(chain) else None
+        offset += record['translated_size']
+        record['past_original_blocks'] = offset > capacity
+
+        for string in record['strings']:
+            counts[string['status']] += 1
+
+        if record['line_number'] in RANDOM_STRING_PACKS:
+            packs.append(check_pack(line, original_lengths))
+
+    return {
+        'summary': {
+            'lines': len(records),
+            'strings': counts,
+            'original_size': len(buf),
+            'translated_size': len(output),
+            'capacity': capacity,
+            'original_blocks': len(chain),
+            'blocks_needed': -(-len(output) // BLOCK_SIZE),
+        },
+        'lines': records,
+        'random_string_packs': packs,
+    }
+
+def top_growth(report, count):
+    return sorted(report['lines'], key=lambda record: (-record['growth'], record['line_number']))[:count]
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Reports translation coverage and where the bytes go in the translated Dragon & Princess program')
+    parser.add_argument('disk_image', help='Original disk image.')
+    parser.add_argument('--program-entry', help='Directory entry of the program. Found automatically if not given.', type=int)
+    parser.add_argument('--easy-mode', help='Apply the easy mode changes too, like the build would.', action='store_true')
+    parser.add_argument('--top', help='How many of the lines that grew the most to list.', type=int, default=20)
+    parser.add_argument('--json', help='Write the full report as JSON to this file, or to stdout if no file is given.', nargs='?', const='-', metavar='JSON_FILE')
+
+    args = parser.parse_args()
+
+    translations = build_patch.load_translations()
+    with D88Image.open(args.disk_image) as image:
+        entry, next_block_table, directory_table, buf = build_patch.read_program_from(image, args.program_entry)
+
+    report = analyze(next_block_table, directory_table, buf, translations, entry, args.easy_mode)
+    report['top_growth'] = [record['line_number'] for record in top_growth(report, args.top)]
+    misaligned = [pack for pack in report['random_string_packs'] if pack['remainder'] != 0]
+
+    if args.json:
+        write_json(report, args.json, ensure_ascii=False)
+    else:
+        summary = report['summary']
+        strings = summary['strings']
+        print('{0} strings: {1} translated, {2} untranslated, {3} undecodable.'.format(
+            sum(strings.values()), strings['translated'], strings['untranslated'], strings['undecodable']))
+        print('{0} bytes translated from {1}, in {2} blocks of the original {3} ({4} bytes).'.format(
+            summary['translated_size'], summary['original_size'], summary['blocks_needed'], summary['original_blocks'], summary['capacity']))
+
+        for pack in misaligned:
+            print('Line {0} string {1}: {2} characters don\'t split into {3} substrings ({4} left over).'.format(
+                pack['line_number'], pack['string_index'], pack['length'], pack['substrings'], pack['remainder']))
+
+        print()
+        print(' line   orig  trans  growth  offset  untranslated')
+        for record in top_growth(report, args.top):
+            untranslated = sum(1 for string in record['strings'] if string['status'] == 'untranslated')
+            print('{0:5d}  {1:5d}  {2:5d}  {3:+6d}  {4:6d}  {5:12d}{6}'.format(
+                record['line_number'], record['original_size'], record['translated_size'], record['growth'], record['offset'],
+                untranslated, '  past the original blocks' if record['past_original_blocks'] else ''))
+
+    sys.exit(1 if len(misaligned) > 0 else 0)
@@ -0,0 +1,132 @@
+import bisect
+
+# N-BASIC stores every line number argument (GOTO, GOSUB, THEN, ELSE, RESTORE, RUN...) as this constant,
+# followed by the line number as a little-endian word.
+LINE_NUMBER_CONSTANT = 0xe
+
+# The 0xff prefix marks a two-byte function token, so whatever follows it isn't a constant.
+FUNCTION_PREFIX = 0xff
+
+MAX_LINE_NUMBER = 65529
+
+# A line number token without content is one a patch is still building, so it doesn't refer to anything yet.
+def referencing_tokens(tokens):
+    previous_op = None
+    for token in tokens:
+        if token.op == LINE_NUMBER_CONSTANT and previous_op != FUNCTION_PREFIX and token.content is not None:
+            yield token
+        previous_op = token.op
+
+def target(token):
+    return int.from_bytes(token.content, byteorder='little')
+
+# Maps every line number that's referenced in a program to the (line, token) pairs that reference it,
+# so finding out what jumps to a line doesn't mean scanning the program. The tokens are the program's
+# own, so renumbering through the index rewrites the program in place.
+class CrossReferenceIndex:
+    def __init__(self):
+        self.references = {}
+
+    @classmethod
+    def from_lines(cls, lines):
+        index = cls()
+        for line in lines:
+            index.add_line(line)
+        return index
+
+    def add_reference(self, line, token):
+        self.references.setdefault(target(token), []).append((line, token))
+
+    def add_line(self, line):
+        for token in referencing_tokens(line['tokens']):
+            self.add_reference(line, token)
+
+    def remove_line(self, line):
+        for token in referencing_tokens(line['tokens']):
+            entries = self.references.get(target(token), [])
+            entries[:] = [entry for entry in entries if entry[1] is not token]
+            if len(entries) == 0:
+                self.references.pop(target(token), None)
+
+    # For when source_line's tokens have been moved onto the end of line.
+    def merge_lines(self, line, source_line):
+        moved = {id(token) for token in referencing_tokens(source_line['tokens'])}
+        for token in referencing_tokens(source_line['tokens']):
+            entries = self.references[target(token)]
+            entries[:] = [(line, entry_token) if id(entry_token) in moved else (entry_line, entry_token) for entry_line, entry_token in entries]
+
+    def references_to(self, line_number):
+        return self.references.get(line_number, [])
+
+    def __contains__(self, line_number):
+        return line_number in self.references
+
+    def targets(self):
+        return set(self.references)
+
+    # Referenced line numbers that aren't in the program.
+    def unresolved(self, lines):
+        return self.targets() - {line['line_number'] for line in lines}
+
+    # Renumbers lines according to mapping (old line number to new), rewriting every reference to them
+    # in the same pass. Like RENUM, it can't move lines past each other, since that would change which
+    # line falls through to which.
+    def renumber(self, lines, mapping):
+        if len(mapping) == 0:
+            return
+
+        line_numbers = [mapping.get(line['line_number'], line['line_number']) for line in lines]
+        if len(set(line_numbers)) != len(line_numbers):
+            raise ValueError('Renumbering would give two lines the same number.')
+        if any(line_number >= next_line_number for line_number, next_line_number in zip(line_numbers, line_numbers[1:])):
+            raise ValueError('Renumbering would change the order of the lines.')
+        if max(line_numbers) > MAX_LINE_NUMBER:
+            raise ValueError('Renumbering would go past line {0}.'.format(MAX_LINE_NUMBER))
+
+        moved = {}
+        for old_line_number, new_line_number in mapping.items():
+            entries = self.references.pop(old_line_number, None)
+            if entries is not None:
+                for line, token in entries:
+                    token.content = new_line_number.to_bytes(2, byteorder='little')
+                moved[new_line_number] = entries
+        for new_line_number, entries in moved.items():
+            self.references.setdefault(new_line_number, []).extend(entries)
+
+        for line in lines:
+            line['line_number'] = mapping.get(line['line_number'], line['line_number'])
+
+    # Renumbers every line from start_line_number on, starting at new_start and going up by step.
+    def renumber_from(self, lines, start_line_number, new_start, step=10):
+        following = [line['line_number'] for line in lines if line['line_number'] >= start_line_number]
+        self.renumber(lines, {old: new_start + i * step for i, old in enumerate(following)})
+
+    # Adds a new line with the given tokens straight after the line numbered after_line_number, and
+    # returns its line number. That's halfway to the next line if there's a gap; if there isn't, the
+    # lines that follow are moved up one at a time, as few of them as possible, to make one.
+    def insert_after(self, lines, after_line_number, tokens):
+        line_numbers = [line['line_number'] for line in lines]
+        position = bisect.bisect_right(line_numbers, after_line_number)
+        next_line_number = line_numbers[position] if position < len(line_numbers) else MAX_LINE_NUMBER + 1
+
+        if next_line_number - after_line_number > 1:
+            line_number = after_line_number + (next_line_number - after_line_number) // 2
+        else:
+            line_number = after_line_number + 1
+            mapping = {}
+            needed = line_number + 1
+            for old_line_number in line_numbers[position:]:
+                if old_line_number >= needed:
+                    break
+                mapping[old_line_number] = needed
+                needed += 1
+            self.renumber(lines, mapping)
+
+        if line_number > MAX_LINE_NUMBER:
+            raise ValueError('No room for a line after {0}.'.format(after_line_number))
+
+        line = {'line_number': line_number, 'tokens': tokens}
+        lines.insert(position, line)
+        self.add_line(line)
+
+        return line_number
@@ -0,0 +1,215 @@
+import io
+import mmap
+import os
+import sys
+
+MAX_TRACKS = 164
+SECTOR_HEADER_SIZE = 0x10
+
+# The loader on the disks we care about organizes files in "blocks" of 8 sectors,
+# or half a track, each.
+BLOCK_SECTORS = 8
+
+class D88Image:
+    def __init__(self, data, mapping=None, filename=None):
+        self._mapping = mapping
+        self.filename = filename
+        self.data = memoryview(data)
+
+        # The D88 header starts with a table giving the start address in the image of each track.
+        # Tracks that aren't present in the image have an address of zero.
+        self.track_offsets = []
+        for track in range(MAX_TRACKS):
+            entry = 0x20 + track * 4
+            self.track_offsets.append(int.from_bytes(self.data[entry:entry + 4], byteorder='little'))
+
+        # Each sector is preceded by a 16-byte header that says how many sectors are in the
+        # track and how big this one's data is. Walk those headers rather than assuming every
+        # sector is 0x100 bytes, and remember where each sector's data starts.
+        self.sector_index = {}
+        for track, address in enumerate(self.track_offsets):
+            if address == 0:
+                continue
+
+            sector = 0
+            sector_count = 1
+            while sector < sector_count and address + SECTOR_HEADER_SIZE <= len(self.data):
+                sector_count = int.from_bytes(self.data[address + 0x4:address + 0x6], byteorder='little')
+                data_size = int.from_bytes(self.data[address + 0xe:address + 0x10], byteorder='little')
+
+                self.sector_index[(track, sector)] = (address + SECTOR_HEADER_SIZE, data_size)
+
+                address += SECTOR_HEADER_SIZE + data_size
+                sector += 1
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, 'rb') as in_file:
+            mapping = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapping, mapping, filename)
+
+    def close(self):
+        self.data.release()
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                # Somebody is still holding on to a sector view; the mapping will go away
+                # along with the last of those.
+                pass
+            self._mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Sectors are numbered by their position within the track in the image, starting from 0.
+    def sector_offset(self, track, sector):
+        return self.sector_index[(track, sector)][0]
+
+    def sector(self, track, sector):
+        address, data_size = self.sector_index[(track, sector)]
+        return self.data[address:address + data_size]
+
+    def block_sectors(self, block):
+        track_index = block // 2
+        sector_index = (block % 2) * BLOCK_SECTORS
+        return [(track_index, sector_index + i) for i in range(BLOCK_SECTORS)]
+
+    def block(self, block):
+        return [self.sector(track, sector) for track, sector in self.block_sectors(block)]
+
+    def has_block(self, block):
+        return all(location in self.sector_index for location in self.block_sectors(block))
+
+# Dirty ranges closer together than this get merged into one write, filling the gap from the source.
+# That's enough to bridge the sector headers between consecutive sectors.
+MERGE_GAP = 0x100
+
+# Size of each chunk when unchanged data has to be copied through Python.
+COPY_CHUNK_SIZE = 0x40000
+
+class ImageWriter:
+    def __init__(self, image):
+        self.image = image
+        self.writes = []
+
+    def write(self, address, data):
+        if address < 0 or address + len(data) > len(self.image.data):
+            raise ValueError('Write of {0} bytes at 0x{1:x} is outside the image.'.format(len(data), address))
+        self.writes.append((address, data))
+
+    def write_sector(self, track, sector, data):
+        self.write(self.image.sector_offset(track, sector), data)
+
+    # Sorts and merges the writes into a list of (address, data) runs. Later writes win where they overlap.
+    def plan(self):
+        ranges = []
+        for order, (address, data) in sorted(enumerate(self.writes), key=lambda item: item[1][0]):
+            end = address + len(data)
+            if len(ranges) > 0 and address - ranges[-1][1] <= MERGE_GAP:
+                ranges[-1][1] = max(ranges[-1][1], end)
+                ranges[-1][2].append(order)
+            else:
+                ranges.append([address, end, [order]])
+
+        runs = []
+        for start, end, orders in ranges:
+            run = bytearray(self.image.data[start:end])
+            for order in sorted(orders):
+                address, data = self.writes[order]
+                run[address - start:address - start + len(data)] = data
+            runs.append((start, run))
+
+        return runs
+
+    def dirty_ranges(self):
+        return [(address, address + len(data)) for address, data in self.writes]
+
+    # Streams the whole output image in one sequential pass. The target can be a filename, '-' for
+    # stdout, or any binary file object (an io.BytesIO, say).
+    def save(self, target):
+        if target == '-':
+            sys.stdout.flush()
+            self._save_to(sys.stdout.buffer)
+        elif isinstance(target, (str, bytes, os.PathLike)):
+            if self.image.filename is not None and os.path.exists(target) and os.path.samefile(target, self.image.filename):
+                raise ValueError('Output image can\'t be the same file as the input image.')
+            with open(target, 'wb', buffering=0) as out_file:
+                self._save_to(out_file)
+        else:
+            self._save_to(target)
+
+    # Brings an image that previous was already saved to up to date with this writer, by writing only
+    # the sectors that differ between the two in place. Sectors the previous writer touched and this
+    # one doesn't go back to what the source image has. Returns how many bytes were written.
+    def save_changes(self, target, previous):
+        current = dict(self.writes)
+        old = dict(previous.writes)
+
+        changes = [(address, data) for address, data in current.items() if old.get(address) != data]
+        for address, data in old.items():
+            if address not in current:
+                changes.append((address, self.image.data[address:address + len(data)]))
+
+        written = 0
+        with open(target, 'r+b', buffering=0) as out_file:
+            for address, data in sorted(changes, key=lambda change: change[0]):
+                out_file.seek(address)
+                self._write(out_file, data)
+                written += len(data)
+
+        return written
+
+    def _save_to(self, out_file):
+        in_file = open(self.image.filename, 'rb', buffering=0) if self.image.filename is not None else None
+        try:
+            pos = 0
+            for start, run in self.plan():
+                in_file = self._copy(in_file, out_file, pos, start)
+                self._write(out_file, run)
+                pos = start + len(run)
+            in_file = self._copy(in_file, out_file, pos, len(self.image.data))
+        finally:
+            if in_file is not None:
+                in_file.close()
+
+        out_file.flush()
+
+    def _write(self, out_file, data):
+        # Unbuffered files are allowed to take less than we give them.
+        view = memoryview(data)
+        while len(view) > 0:
+            written = out_file.write(view)
+            view = view[written:]
+
+    # Copies an unchanged region of the source image. When both ends are real files we can let the
+    # kernel do it; otherwise it goes through the mapped source in big chunks. Returns the source file
+    # if it's still worth trying that.
+    def _copy(self, in_file, out_file, start, end):
+        if in_file is not None and start < end:
+            try:
+                out_fd = out_file.fileno()
+                out_file.flush()
+                while start < end:
+                    if hasattr(os, 'copy_file_range'):
+                        copied = os.copy_file_range(in_file.fileno(), out_fd, end - start, start)
+                    else:
+                        copied = os.sendfile(out_fd, in_file.fileno(), start, end - start)
+                    if copied == 0:
+                        break
+                    start += copied
+            except (OSError, AttributeError, io.UnsupportedOperation):
+                # Pipes, file systems that don't support it, in-memory targets... fall back to copying
+                # ourselves from wherever we got to.
+                in_file.close()
+                in_file = None
+
+        while start < end:
+            chunk_end = min(end, start + COPY_CHUNK_SIZE)
+            self._write(out_file, self.image.data[start:chunk_end])
+            start = chunk_end
+
+        return in_file
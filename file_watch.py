@@ -0,0 +1,142 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# Waits for files to change. On Linux this uses inotify on the directories holding the files, which
+# catches editors that save by writing a new file and renaming it over the old one. Everywhere else,
+# it falls back to polling the files' modification times and sizes.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+# Editors often touch a file more than once when saving it, so wait for things to go quiet for this
+# long before reporting a change.
+SETTLE_TIME = 0.05
+
+POLL_INTERVAL = 0.25
+
+def _load_inotify():
+    if not hasattr(os, 'uname') or os.uname().sysname != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class FileWatcher:
+    def __init__(self, filenames, use_inotify=True):
+        self.filenames = [os.path.abspath(filename) for filename in filenames]
+        self.fd = None
+
+        libc = _load_inotify() if use_inotify else None
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+                self.watches = {}
+                for directory in {os.path.dirname(filename) for filename in self.filenames}:
+                    wd = libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+                    if wd < 0:
+                        os.close(fd)
+                        self.fd = None
+                        break
+                    self.watches[wd] = directory
+
+        self.last_seen = {filename: self._stat(filename) for filename in self.filenames}
+
+    @property
+    def method(self):
+        return 'inotify' if self.fd is not None else 'polling'
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _stat(self, filename):
+        try:
+            stat = os.stat(filename)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _read_events(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 0x10000)
+            except BlockingIOError:
+                break
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(data, pos)
+                pos += INOTIFY_EVENT_HEADER.size
+                name = data[pos:pos + name_length].rstrip(b'\x00')
+                pos += name_length
+
+                filename = os.path.join(self.watches.get(wd, ''), os.fsdecode(name))
+                if filename in self.filenames:
+                    changed.add(filename)
+        return changed
+
+    def _poll(self):
+        changed = set()
+        for filename in self.filenames:
+            seen = self._stat(filename)
+            if seen != self.last_seen[filename]:
+                self.last_seen[filename] = seen
+                changed.add(filename)
+        return changed
+
+    # Blocks until at least one of the files has changed, and returns the set of the ones that did.
+    # Gives up and returns an empty set after timeout seconds, if a timeout is given.
+    def wait(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        changed = set()
+        while len(changed) == 0:
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return changed
+
+            if self.fd is not None:
+                ready, _, _ = select.select([self.fd], [], [], remaining)
+                if len(ready) > 0:
+                    changed = self._read_events()
+            else:
+                time.sleep(POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining))
+                changed = self._poll()
+
+        # Pick up anything else that arrives while the editor finishes up.
+        while True:
+            if self.fd is not None:
+                ready, _, _ = select.select([self.fd], [], [], SETTLE_TIME)
+                if len(ready) == 0:
+                    break
+                changed |= self._read_events()
+            else:
+                time.sleep(SETTLE_TIME)
+                more = self._poll()
+                if len(more) == 0:
+                    break
+                changed |= more
+
+        return changed
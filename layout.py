@@ -0,0 +1,288 @@
+import argparse
+import sys
+
+from cross_reference import LINE_NUMBER_CONSTANT
+from nbasic import SMALL_INTEGER, SMALL_INTEGER_MAX, unpack_bytecode
+import pc88codec # Registers the pc8801 text encoding.
+
+# Works out where the program's text lands on screen without running it, so wrapping problems show up
+# on every build rather than only when somebody boots the game and happens to reach the right screen.
+#
+# Two kinds of output are modelled. PRINT statements flow from the cursor, from one line to the next:
+# ';' keeps going, ',' moves to the next print zone, and a PRINT without a trailing separator starts a
+# new row. N-BASIC also moves a
+# string that won't fit on what's left of the row down to the next one before printing it. Then there's
+# the title screen's routine at line 18500, which prints M$ at column X, row Y; those positions are
+# followed through the X=, Y= and Y=Y+ assignments leading up to each GOSUB.
+#
+# Anything that can't be known without running the program (a variable's length, a computed position)
+# makes the cursor unknown until the next row starts, and only checks that don't need it are made.
+#
+# The problems reported are:
+#
+#   overflow    a string is longer than the room it has, so the screen wraps it wherever it hits the edge
+#   bad_break   a row break falls in the middle of a word that was split across two strings
+#   overlap     positioned text lands on top of other positioned text on the same screen
+#   off_screen  positioned text starts outside the screen
+
+SCREEN_ROWS = 25
+PRINT_ZONE = 14
+
+# The title screen's print-at-position subroutine.
+PRINT_AT_LINE = 18500
+
+STATEMENT_SEPARATORS = {0x3a, 0x9f, 0xdd} # ':', ELSE, THEN
+PRINT = 0x91
+LET = 0x88
+GOSUB = 0x8d
+EQUALS = 0xf1
+PLUS = 0xf3
+TAB = 0xde
+SPC = 0xe2
+
+def constant_value(token):
+    if token.content is None:
+        if SMALL_INTEGER <= token.op <= SMALL_INTEGER + SMALL_INTEGER_MAX:
+            return token.op - SMALL_INTEGER
+        return None
+    if token.op in (0xc, 0xf, 0x1c):
+        return int.from_bytes(token.content, byteorder='little')
+    return None
+
+def is_word_character(char):
+    return char.isascii() and char.isalnum()
+
+def statements(tokens):
+    statement = []
+    for token in tokens:
+        if token.op in STATEMENT_SEPARATORS and token.content is None:
+            yield statement
+            statement = []
+        else:
+            statement.append(token)
+    yield statement
+
+class Layout:
+    def __init__(self, width=40, skip_lines=(), margins=None):
+        self.width = width
+        self.skip_lines = set(skip_lines)
+        self.margins = margins or {}
+        self.issues = []
+
+    def report(self, kind, line_number, string_index, text, **details):
+        issue = {'kind': kind, 'line_number': line_number, 'string_index': string_index, 'text': text}
+        issue.update(details)
+        self.issues.append(issue)
+
+    def check(self, lines):
+        # State for the positioned text on the screen currently being put together: the values of X, Y
+        # and M$ (with where M$'s string came from), and what's been printed on each row.
+        variables = {}
+        placed = {}
+        # Where a PRINT ending in ';' or ',' left the cursor, and the text it ended with, so the next
+        # line's PRINT carries on from there. None when the last PRINT finished its row.
+        cursor = None
+
+        for line in lines:
+            line_number = line['line_number']
+            if line_number in self.skip_lines:
+                cursor = None
+                continue
+
+            strings = {}
+            for token in line['tokens']:
+                if token.op == 0x22:
+                    strings[id(token)] = len(strings)
+
+            positioned = False
+            margin = self.margins.get(line_number, 0)
+            column, previous_text = cursor or (margin, None)
+
+            for statement in statements(line['tokens']):
+                while len(statement) > 0 and statement[0].op in (LET, 0x20):
+                    statement = statement[1:]
+                if len(statement) == 0:
+                    continue
+
+                if statement[0].op == PRINT:
+                    cursor = self.print_statement(line_number, statement[1:], strings, margin, column, previous_text)
+                    column, previous_text = cursor or (margin, None)
+                elif statement[0].op == GOSUB:
+                    target = next((token for token in statement if token.op == LINE_NUMBER_CONSTANT), None)
+                    if target is not None and int.from_bytes(target.content, byteorder='little') == PRINT_AT_LINE:
+                        positioned = True
+                        self.print_at(line_number, variables, placed)
+                else:
+                    name = self.assignment(statement, variables, line_number, strings)
+                    if name in ('X', 'Y', 'M$'):
+                        positioned = True
+
+            # A line that has nothing to do with positioned text ends the screen.
+            if not positioned:
+                variables.clear()
+                placed.clear()
+
+        return self.issues
+
+    # Follows X=, Y=, Y=Y+ and M$= assignments. Returns the name assigned to, if it's one that matters.
+    def assignment(self, statement, variables, line_number, strings):
+        try:
+            equals = next(index for index, token in enumerate(statement) if token.op == EQUALS)
+        except StopIteration:
+            return None
+
+        name = bytes(token.op for token in statement[:equals] if token.op != 0x20).decode('ascii', errors='replace')
+        value = [token for token in statement[equals + 1:] if token.op != 0x20]
+
+        if name == 'M$':
+            if len(value) == 1 and value[0].op == 0x22:
+                variables[name] = (value[0].content, line_number, strings.get(id(value[0])))
+            else:
+                variables[name] = None
+        elif name in ('X', 'Y'):
+            if len(value) == 1:
+                variables[name] = constant_value(value[0])
+            elif len(value) == 3 and value[0].op == ord(name) and value[1].op == PLUS and variables.get(name) is not None:
+                increment = constant_value(value[2])
+                variables[name] = variables[name] + increment if increment is not None else None
+            else:
+                variables[name] = None
+        else:
+            return None
+
+        return name
+
+    def print_at(self, line_number, variables, placed):
+        x = variables.get('X')
+        y = variables.get('Y')
+        message = variables.get('M$')
+        if x is None or y is None or message is None:
+            return
+
+        content, string_line_number, string_index = message
+        text = str(content, 'pc8801')
+        if not (0 <= x < self.width and 0 <= y < SCREEN_ROWS):
+            self.report('off_screen', string_line_number, string_index, text, column=x, row=y, called_from=line_number)
+            return
+        if x + len(text) > self.width:
+            self.report('overflow', string_line_number, string_index, text, column=x, row=y, room=self.width - x, called_from=line_number)
+
+        # Only the visible part can cover anything up.
+        start = x + len(text) - len(text.lstrip(' '))
+        end = x + len(text.rstrip(' '))
+        for other_start, other_end, other_line_number, other_string_index in placed.get(y, ()):
+            if start < other_end and other_start < end:
+                self.report('overlap', string_line_number, string_index, text, column=x, row=y,
+                            overlaps={'line_number': other_line_number, 'string_index': other_string_index})
+        if start < end:
+            placed.setdefault(y, []).append((start, end, string_line_number, string_index))
+
+    # Lays out one PRINT statement from the given column (None if it isn't known), after previous_text if
+    # the last PRINT ended with it and a ';'. Returns where the cursor is left and the text this one
+    # ended with, or None if it finished the row.
+    def print_statement(self, line_number, tokens, strings, margin, column, previous_text=None):
+        room = self.width - margin
+
+        items = [[]]
+        separators = []
+        for token in tokens:
+            if token.op in (0x3b, 0x2c) and token.content is None:
+                separators.append(token.op)
+                items.append([])
+            else:
+                items[-1].append(token)
+
+        for index, item in enumerate(items):
+            item = [token for token in item if token.op != 0x20]
+            text = None
+
+            if len(item) == 1 and item[0].op == 0x22:
+                text = str(item[0].content, 'pc8801')
+                string_index = strings.get(id(item[0]))
+
+                if column is not None and column > margin and column + len(text) > self.width and len(text) <= room:
+                    # N-BASIC starts a new row rather than breaking the string.
+                    column = margin
+                    if previous_text and text and is_word_character(previous_text[-1]) and is_word_character(text[0]):
+                        self.report('bad_break', line_number, string_index, text, after=previous_text)
+
+                start = column if column is not None else margin
+                if start + len(text) > self.width:
+                    self.report('overflow', line_number, string_index, text, column=column, room=self.width - start)
+
+                if column is not None:
+                    column += len(text)
+                    if column >= self.width:
+                        column = margin + (column - self.width) % room
+            elif len(item) >= 2 and item[0].op in (TAB, SPC) and constant_value(item[1]) is not None and column is not None:
+                if item[0].op == TAB:
+                    column = max(column, constant_value(item[1]))
+                else:
+                    column += constant_value(item[1])
+                if column >= self.width:
+                    column = margin
+            elif len(item) > 0:
+                column = None
+
+            # The empty item after a trailing separator leaves what came before it for the next PRINT.
+            if index < len(separators):
+                previous_text = text if separators[index] == 0x3b else None
+
+            if index < len(separators) and separators[index] == 0x2c and column is not None:
+                column = (column // PRINT_ZONE + 1) * PRINT_ZONE
+                if column >= self.width:
+                    column = margin
+
+        # No separator at the end means a new row.
+        if len(separators) == 0 or len(items[-1]) > 0:
+            return None
+        return column, previous_text
+
+# Checks every line's text, returning a list of problems.
+def check_layout(lines, width=40, skip_lines=(), margins=None):
+    return Layout(width, skip_lines, margins).check(lines)
+
+def layout_summary(issues):
+    summary = {'overflow': 0, 'bad_break': 0, 'overlap': 0, 'off_screen': 0}
+    for issue in issues:
+        summary[issue['kind']] += 1
+    return summary
+
+def format_issue(issue):
+    text = '{0} {1}[{2}] {3!r}'.format(issue['kind'], issue['line_number'], issue['string_index'], issue['text'])
+    if issue['kind'] == 'overflow':
+        text += ': {0} characters with room for {1}'.format(len(issue['text']), issue['room'])
+    elif issue['kind'] == 'bad_break':
+        text += ': breaks a word after {0!r}'.format(issue['after'])
+    elif issue['kind'] == 'overlap':
+        text += ': covers {0}[{1}] on row {2}'.format(issue['overlaps']['line_number'], issue['overlaps']['string_index'], issue['row'])
+    elif issue['kind'] == 'off_screen':
+        text += ': at column {0}, row {1}'.format(issue['column'], issue['row'])
+    return text
+
+if __name__ == '__main__':
+    from build_stats import write_json
+    from d88 import D88Image
+    import build_patch
+
+    parser = argparse.ArgumentParser('Checks where the text of the N-BASIC program on a disk image ends up on screen')
+    parser.add_argument('disk_image', help='Disk image to check, patched or not. The program can\'t be found automatically on an --optimize build; give --program-entry for those.')
+    parser.add_argument('--width', help='Screen width in columns.', type=int, choices=(40, 80), default=40)
+    parser.add_argument('--program-entry', help='Directory entry of the program. Found automatically if not given.', type=int)
+    parser.add_argument('--json', help='Write the problems as JSON to this file, or to stdout if no file is given.', nargs='?', const='-', metavar='JSON_FILE')
+
+    args = parser.parse_args()
+
+    with D88Image.open(args.disk_image) as image:
+        buf = build_patch.read_program_from(image, args.program_entry)[3]
+
+    issues = check_layout(unpack_bytecode(buf), args.width, build_patch.SPECIAL_TEXT_LINES, build_patch.TEXT_MARGINS)
+
+    if args.json:
+        write_json({'summary': layout_summary(issues), 'issues': issues}, args.json, ensure_ascii=False)
+    else:
+        for issue in issues:
+            print(format_issue(issue))
+        print('{overflow} overflow(s), {bad_break} bad break(s), {overlap} overlap(s), {off_screen} off screen.'.format(**layout_summary(issues)))
+
+    sys.exit(1 if len(issues) > 0 else 0)
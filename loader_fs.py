@@ -0,0 +1,274 @@
+import argparse
+import concurrent.futures
+import os
+import re
+
+from d88 import BLOCK_SECTORS, D88Image, ImageWriter
+import pc88codec # Registers the pc8801 text encoding.
+
+# The file system of the loader on these disks. Track 0 holds a next-block table in sector 5, saying
+# which block follows each block of a file, and a directory of 32-byte records in sectors 6-9. Each
+# record has the file's name at the start, its size (big-endian) at 0x1b and its first block at 0x1f.
+#
+# Nothing is read until it's needed, and files are streamed a sector at a time straight out of the
+# image, so going through every file on a disk doesn't hold more than one of them in memory.
+
+NEXT_BLOCK_TABLE_SECTOR = (0, 5)
+DIRECTORY_SECTORS = [(0, 6 + i) for i in range(4)]
+DIRECTORY_ENTRY_SIZE = 0x20
+NAME_SIZE = 0x12
+SIZE_OFFSET = 0x1b
+FIRST_BLOCK_OFFSET = 0x1f
+
+SECTOR_SIZE = 0x100
+BLOCK_SIZE = BLOCK_SECTORS * SECTOR_SIZE
+
+# Values from here up in the next-block table end a chain.
+CHAIN_END = 0xc0
+
+# Unused entries in the next-block table seem to be 0xff, like in Disk BASIC's FAT. Track 0 holds the
+# loader's own tables, so its blocks are never up for grabs even if they look free. If an image is given,
+# blocks that aren't actually on the disk don't count either.
+FREE_BLOCK = 0xff
+SYSTEM_BLOCKS = (0, 1)
+
+def block_chain(next_block_table, first_block):
+    blocks = []
+    current_block = first_block
+    while current_block < CHAIN_END and current_block not in blocks:
+        blocks.append(current_block)
+        current_block = next_block_table[current_block]
+    return blocks
+
+def free_blocks(next_block_table, image=None):
+    return [block for block, next_block in enumerate(next_block_table)
+            if next_block == FREE_BLOCK and block not in SYSTEM_BLOCKS and (image is None or image.has_block(block))]
+
+def free_block_count(next_block_table, image=None):
+    return len(free_blocks(next_block_table, image))
+
+# Extends a file's chain in the next-block table until it's block_count blocks long, returning the
+# blocks it added. Each new block is the free one closest to the end of the chain: on the same cylinder
+# if possible (either side of the disk, so no seek at all), and otherwise as few cylinders away as it can
+# be, going forwards in preference to backwards. That keeps the file together so it still loads quickly.
+def extend_chain(next_block_table, first_block, block_count, image=None):
+    chain = block_chain(next_block_table, first_block)
+    needed = block_count - len(chain)
+    if needed <= 0:
+        return []
+
+    available = free_blocks(next_block_table, image)
+    if len(available) < needed:
+        raise Exception('Ran out of space! {0} more blocks are needed, but only {1} are free.'.format(needed, len(available)))
+
+    # Two blocks per track, two tracks (sides) per cylinder.
+    def distance(block):
+        return (abs(block // 4 - previous // 4), block < previous, abs(block - previous))
+
+    terminator = next_block_table[chain[-1]]
+    added = []
+    previous = chain[-1]
+    for _ in range(needed):
+        block = min(available, key=distance)
+        available.remove(block)
+
+        next_block_table[previous] = block
+        added.append(block)
+        previous = block
+
+    next_block_table[previous] = terminator
+
+    return added
+
+# Cuts a file's chain down to block_count blocks (never fewer than one), freeing the rest. Returns the
+# blocks it freed.
+def truncate_chain(next_block_table, first_block, block_count):
+    chain = block_chain(next_block_table, first_block)
+    block_count = max(block_count, 1)
+    if len(chain) <= block_count:
+        return []
+
+    next_block_table[chain[block_count - 1]] = next_block_table[chain[-1]]
+    for block in chain[block_count:]:
+        next_block_table[block] = FREE_BLOCK
+
+    return chain[block_count:]
+
+def write_tables(writer, next_block_table, directory_table):
+    writer.write_sector(*NEXT_BLOCK_TABLE_SECTOR, bytes(next_block_table))
+    for i, location in enumerate(DIRECTORY_SECTORS):
+        writer.write_sector(*location, bytes(directory_table[i * SECTOR_SIZE:(i + 1) * SECTOR_SIZE]))
+
+# Writes data over the sectors of a chain, padding whatever's left of the chain with 0xff.
+def write_chain(writer, next_block_table, first_block, data):
+    pos = 0
+    for block in block_chain(next_block_table, first_block):
+        for track_index, sector_index in writer.image.block_sectors(block):
+            writer.write_sector(track_index, sector_index, bytes(data[pos:pos + SECTOR_SIZE]).ljust(SECTOR_SIZE, b'\xff'))
+            pos += SECTOR_SIZE
+
+    if pos < len(data):
+        raise Exception('Ran out of space! {0} bytes were not written.'.format(len(data) - pos))
+
+class LoaderFile:
+    def __init__(self, file_system, entry):
+        self.file_system = file_system
+        self.entry = entry
+
+    @property
+    def record(self):
+        directory_table = self.file_system.directory_table
+        return directory_table[self.entry * DIRECTORY_ENTRY_SIZE:(self.entry + 1) * DIRECTORY_ENTRY_SIZE]
+
+    @property
+    def raw_name(self):
+        return bytes(self.record[:NAME_SIZE])
+
+    @property
+    def name(self):
+        return self.raw_name.decode('pc8801', errors='replace').rstrip()
+
+    @property
+    def size(self):
+        return int.from_bytes(self.record[SIZE_OFFSET:SIZE_OFFSET + 2], byteorder='big')
+
+    @property
+    def first_block(self):
+        return self.record[FIRST_BLOCK_OFFSET]
+
+    def blocks(self):
+        return block_chain(self.file_system.next_block_table, self.first_block)
+
+    # Yields the file's contents a sector at a time, as views into the image. If the chain ends before
+    # the size in the directory says it should, so does the file.
+    def chunks(self):
+        image = self.file_system.image
+        remaining = self.size
+        for block in self.blocks():
+            if not image.has_block(block):
+                raise Exception('Block 0x{0:02x} of "{1}" isn\'t on the disk.'.format(block, self.name))
+
+            for sector in image.block(block):
+                if remaining <= 0:
+                    return
+                yield sector[:remaining]
+                remaining -= len(sector)
+
+    def read(self):
+        return b''.join(self.chunks())
+
+    def extract(self, out_file):
+        for chunk in self.chunks():
+            out_file.write(chunk)
+
+class LoaderFileSystem:
+    def __init__(self, image):
+        self.image = image
+        self.writer = ImageWriter(image)
+        self._next_block_table = None
+        self._directory_table = None
+
+    # The tables are mutable copies. Changes made through replace() go into them and into the writer.
+    @property
+    def next_block_table(self):
+        if self._next_block_table is None:
+            self._next_block_table = bytearray(self.image.sector(*NEXT_BLOCK_TABLE_SECTOR))
+        return self._next_block_table
+
+    @property
+    def directory_table(self):
+        if self._directory_table is None:
+            self._directory_table = bytearray(b''.join(self.image.sector(*location) for location in DIRECTORY_SECTORS))
+        return self._directory_table
+
+    # Every file in the directory. Records starting with 0x00 or 0xff are unused.
+    def __iter__(self):
+        for entry in range(len(self.directory_table) // DIRECTORY_ENTRY_SIZE):
+            if self.directory_table[entry * DIRECTORY_ENTRY_SIZE] not in (0x00, 0xff):
+                yield LoaderFile(self, entry)
+
+    def file(self, entry):
+        if entry < 0 or entry >= len(self.directory_table) // DIRECTORY_ENTRY_SIZE:
+            raise ValueError('There is no directory entry {0}.'.format(entry))
+        if self.directory_table[entry * DIRECTORY_ENTRY_SIZE] in (0x00, 0xff):
+            raise ValueError('Directory entry {0} is unused.'.format(entry))
+        return LoaderFile(self, entry)
+
+    def find(self, name):
+        for loader_file in self:
+            if loader_file.name == name:
+                return loader_file
+        return None
+
+    # Replaces a file's contents, growing or shrinking its chain to fit. Nothing is written to the image;
+    # the changes are planned in the writer, which save() or flush() bring up to date.
+    def replace(self, entry, data):
+        loader_file = self.file(entry)
+        if len(data) > 0xffff:
+            raise ValueError('"{0}" can\'t be more than 65535 bytes.'.format(loader_file.name))
+
+        block_count = -(-len(data) // BLOCK_SIZE)
+        extend_chain(self.next_block_table, loader_file.first_block, block_count, self.image)
+        truncate_chain(self.next_block_table, loader_file.first_block, block_count)
+
+        offset = entry * DIRECTORY_ENTRY_SIZE + SIZE_OFFSET
+        self.directory_table[offset:offset + 2] = len(data).to_bytes(2, byteorder='big')
+
+        write_chain(self.writer, self.next_block_table, loader_file.first_block, data)
+
+    # Plans the writes for the tables as they are now, and returns the writer.
+    def flush(self):
+        if self._next_block_table is not None or self._directory_table is not None:
+            write_tables(self.writer, self.next_block_table, self.directory_table)
+        return self.writer
+
+    def save(self, target):
+        self.flush().save(target)
+
+    # Writes every file to out_dir, several at once. Returns the paths written, in directory order.
+    def extract_all(self, out_dir, jobs=None):
+        os.makedirs(out_dir, exist_ok=True)
+
+        def extract(loader_file):
+            path = os.path.join(out_dir, extracted_filename(loader_file))
+            with open(path, 'wb') as out_file:
+                loader_file.extract(out_file)
+            return path
+
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            return list(executor.map(extract, list(self)))
+
+# Names can have anything in them, and can repeat, so the entry number goes first.
+def extracted_filename(loader_file):
+    name = re.sub(r'[^\w.-]+', '_', loader_file.name).strip('_') or 'unnamed'
+    return '{0:02d}_{1}'.format(loader_file.entry, name)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Lists, extracts and replaces files on a disk using the Dragon & Princess loader')
+    parser.add_argument('disk_image', help='Disk image to read.')
+    parser.add_argument('--extract', help='Write every file to this directory.', metavar='OUT_DIR')
+    parser.add_argument('--jobs', help='How many files to extract at once.', type=int)
+    parser.add_argument('--replace', help='Replace the contents of a directory entry with a file. Can be given more than once.', nargs=2, action='append', default=[], metavar=('ENTRY', 'FILE'))
+    parser.add_argument('--out', help='Where to write the image after --replace.', metavar='OUT_DISK_IMAGE')
+
+    args = parser.parse_args()
+    if len(args.replace) > 0 and args.out is None:
+        parser.error('--replace needs --out.')
+
+    with D88Image.open(args.disk_image) as image:
+        file_system = LoaderFileSystem(image)
+
+        if args.extract is not None:
+            for path in file_system.extract_all(args.extract, args.jobs):
+                print(path)
+        elif len(args.replace) == 0:
+            for loader_file in file_system:
+                print('{0:3d}  {1:<18}  {2:6d} bytes  {3:2d} block(s) from 0x{4:02x}'.format(
+                    loader_file.entry, loader_file.name, loader_file.size, len(loader_file.blocks()), loader_file.first_block))
+
+        for entry, filename in args.replace:
+            with open(filename, 'rb') as in_file:
+                file_system.replace(int(entry, 0), in_file.read())
+        if len(args.replace) > 0:
+            file_system.save(args.out)
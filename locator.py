@@ -0,0 +1,145 @@
+import argparse
+import re
+import sys
+import zlib
+
+from d88 import D88Image
+from loader_fs import LoaderFileSystem
+
+# Finds a particular N-BASIC program on a disk that uses this loader, by looking at what's in each file
+# rather than trusting its position in the directory. Each file's line headers are walked (which doesn't
+# need the program tokenized) and checked against a signature: line numbers the program has to have, and
+# byte patterns some of those lines have to match.
+
+# How much of a signature a file has to match. A little slack lets slightly different releases through.
+MATCH_THRESHOLD = 0.9
+
+class Signature:
+    def __init__(self, name, required_lines, line_patterns):
+        self.name = name
+        self.required_lines = set(required_lines)
+        self.line_patterns = {line_number: re.compile(pattern, re.DOTALL) for line_number, pattern in line_patterns.items()}
+
+    # Returns the fraction of the signature the program's lines match, from 0 to 1.
+    def score(self, lines):
+        checks = len(self.required_lines) + len(self.line_patterns)
+        if checks == 0:
+            return 0.0
+
+        matched = sum(1 for line_number in self.required_lines if line_number in lines)
+        for line_number, pattern in self.line_patterns.items():
+            if line_number in lines and pattern.match(lines[line_number]) is not None:
+                matched += 1
+        return matched / checks
+
+# Walks the line headers of a tokenized program, returning {line_number: body}. Anything that doesn't
+# look like a program (line numbers going backwards, links pointing outside the file) just ends the walk.
+def program_lines(data):
+    lines = {}
+    pos = 0
+    previous_line_number = -1
+    while pos + 4 <= len(data):
+        link_addr = int.from_bytes(data[pos:pos + 2], byteorder='little')
+        line_number = int.from_bytes(data[pos + 2:pos + 4], byteorder='little')
+        if link_addr == 0 or line_number <= previous_line_number or link_addr - 1 <= pos + 4 or link_addr - 1 > len(data):
+            break
+
+        lines[line_number] = data[pos + 4:link_addr - 2]
+        previous_line_number = line_number
+        pos = link_addr - 1
+    return lines
+
+# In-process memo of locate() results, keyed by the image's CRC32 and the signature's name.
+_located = {}
+
+# Finds the file on the image that best matches the signature. Returns a dict describing it, or None if
+# nothing matches well enough. If a BuildCache is given, results are kept there between runs too.
+def locate(image, signature, cache=None, image_crc=None):
+    if image_crc is None:
+        image_crc = zlib.crc32(image.data)
+
+    key = (image_crc, signature.name)
+    if key in _located:
+        return _located[key]
+    if cache is not None:
+        cached = cache.load_location(image_crc, signature.name)
+        if cached is not None:
+            _located[key] = cached[0]
+            return cached[0]
+
+    best = None
+    try:
+        files = list(LoaderFileSystem(image))
+    except KeyError:
+        # No track 0 sectors where the loader keeps its tables.
+        files = []
+
+    for loader_file in files:
+        try:
+            data = loader_file.read()
+        except Exception:
+            # Chains running off the disk and the like; whatever it is, it isn't the program.
+            continue
+
+        score = signature.score(program_lines(data))
+        if score >= MATCH_THRESHOLD and (best is None or score > best['score']):
+            best = {
+                'entry': loader_file.entry,
+                'name': loader_file.name,
+                'first_block': loader_file.first_block,
+                'size': loader_file.size,
+                'score': score,
+                'program_crc': zlib.crc32(data),
+            }
+
+    _located[key] = best
+    if cache is not None:
+        cache.store_location(image_crc, signature.name, (best,))
+
+    return best
+
+# Locates the program on every image in a list, for sorting out a pile of dumps. Identical images are
+# only looked at once, and identical programs share a program_crc.
+def index_archive(filenames, signature, cache=None):
+    index = []
+    for filename in filenames:
+        result = {'image': filename}
+        try:
+            with D88Image.open(filename) as image:
+                result['image_crc'] = zlib.crc32(image.data)
+                result['location'] = locate(image, signature, cache, result['image_crc'])
+        except Exception as error:
+            result['error'] = '{0}: {1}'.format(type(error).__name__, error)
+        index.append(result)
+    return index
+
+if __name__ == '__main__':
+    import build_patch
+    from build_cache import BuildCache, script_hash
+    from build_stats import write_json
+
+    parser = argparse.ArgumentParser('Finds Dragon & Princess on a pile of disk images')
+    parser.add_argument('disk_images', help='Disk images to index.', nargs='+')
+    parser.add_argument('--json', help='Write the index as JSON to this file, or to stdout if no file is given.', nargs='?', const='-', metavar='JSON_FILE')
+    parser.add_argument('--cache-dir', help='Directory for the build cache, where results are kept by image CRC.', default='.build_cache')
+    parser.add_argument('--no-cache', help='Don\'t read or write the build cache.', action='store_true')
+
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else BuildCache(args.cache_dir, script_hash())
+    index = index_archive(args.disk_images, build_patch.DNP_SIGNATURE, cache)
+
+    if args.json:
+        write_json(index, args.json)
+    else:
+        for result in index:
+            if 'error' in result:
+                print('{0}: {1}'.format(result['image'], result['error']))
+            elif result['location'] is None:
+                print('{0}: not found'.format(result['image']))
+            else:
+                location = result['location']
+                print('{0}: entry {1} "{2}", {3} bytes from block 0x{4:02x} (match {5:.0%}, program CRC {6:08x})'.format(
+                    result['image'], location['entry'], location['name'], location['size'], location['first_block'], location['score'], location['program_crc']))
+
+    sys.exit(0 if all(result.get('location') is not None for result in index) else 1)
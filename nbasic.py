@@ -0,0 +1,521 @@
+import argparse
+import math
+import re
+import sys
+
+from cross_reference import FUNCTION_PREFIX, LINE_NUMBER_CONSTANT
+import pc88codec # Registers the pc8801 text encoding.
+
+# N-BASIC's tokenized program format: reading it into tokens and writing it back out, listing it as
+# text, and compiling text back into tokens.
+
+
+class Token:
+    __slots__ = ('op', 'content', 'fields', 'terminator', 'text_index')
+
+    # Tokens read out of a program keep their content and fields as memoryview slices of the
+    # original program buffer; they're only replaced with real bytes when a patch changes them.
+    #
+    # text_index is free for the build to note where the token's text was numbered before any patch
+    # moved it around; it's None otherwise, and isn't kept in the build cache.
+    def __init__(self, op, content=None, fields=None, terminator=None):
+        self.op = op
+        self.content = content
+        self.fields = fields
+        self.terminator = terminator
+        self.text_index = None
+
+    def __repr__(self):
+        parts = ['op=0x{0:02x}'.format(self.op)]
+        if self.content is not None:
+            parts.append('content={0!r}'.format(bytes(self.content)))
+        if self.fields is not None:
+            parts.append('fields={0!r}'.format([bytes(field) for field in self.fields]))
+        return 'Token({0})'.format(', '.join(parts))
+
+    # Views into the program buffer can't be pickled, so materialize them for the build cache.
+    def __reduce__(self):
+        content = bytes(self.content) if self.content is not None else None
+        fields = [bytes(field) for field in self.fields] if self.fields is not None else None
+        return (Token, (self.op, content, fields, self.terminator))
+
+# Hex constant, line number constant, decimal constant, one-byte decimal constant, single precision float.
+CONSTANT_SIZES = {0xc: 2, 0xe: 2, 0x1c: 2, 0xf: 1, 0x1d: 4}
+
+STRING_BODY = re.compile(rb'[^"\x00]*')
+DATA_FIELD = re.compile(rb'[^,:\x00]*')
+REMARK_BODY = re.compile(rb'[^\x00]*')
+
+# If references is given (a CrossReferenceIndex), every line number constant is added to it on the way.
+def unpack_bytecode(data, references=None):
+    # Read-only, so that token contents can be used directly as dictionary keys.
+    view = memoryview(data).toreadonly()
+    data_length = len(view)
+
+    lines = []
+    pos = 0
+
+    while True:
+        link_addr = int.from_bytes(view[pos:pos + 2], byteorder='little')
+        line_number = int.from_bytes(view[pos + 2:pos + 4], byteorder='little')
+        pos += 4
+
+        if link_addr == 0:
+            break
+
+        tokens = []
+        line = {'line_number': line_number, 'orig_addr': link_addr, 'tokens': tokens}
+
+        while pos < data_length:
+            op = view[pos]
+            pos += 1
+
+            if op == 0:
+                break
+
+            current_token = Token(op)
+
+            if op in CONSTANT_SIZES:
+                size = CONSTANT_SIZES[op]
+                current_token.content = view[pos:pos + size]
+                pos += size
+
+                if op == LINE_NUMBER_CONSTANT and references is not None and (len(tokens) == 0 or tokens[-1].op != FUNCTION_PREFIX):
+                    references.add_reference(line, current_token)
+            elif op == 0x22: # Start quote
+                end = STRING_BODY.match(view, pos).end()
+                current_token.content = view[pos:end]
+
+                # A string can run to the end of the line without a closing quote. Leave the
+                # end-of-line for the outer loop, and don't invent a quote when packing.
+                if end < data_length and view[end] == 0x22:
+                    current_token.terminator = op
+                    pos = end + 1
+                else:
+                    pos = end
+            elif op == 0x84: # Data
+                current_token.content = view[pos:pos + 1] # Space after DATA is required, I think; store it as content.
+                pos += 1
+
+                fields = []
+                while True:
+                    end = DATA_FIELD.match(view, pos).end()
+                    fields.append(view[pos:end])
+                    pos = end
+
+                    # Stop at a colon or end-of-line, and leave it for the outer loop.
+                    if pos >= data_length or view[pos] != 0x2c:
+                        break
+                    pos += 1
+
+                current_token.fields = fields
+            elif op == 0x8f: # Remark
+                end = REMARK_BODY.match(view, pos).end()
+                current_token.content = view[pos:end]
+                pos = end
+
+            tokens.append(current_token)
+
+        lines.append(line)
+
+        pos = link_addr - 1
+
+    return lines
+
+def pack_tokens(tokens, output):
+    for token in tokens:
+        output.append(token.op)
+        if token.content is not None:
+            output += token.content
+        if token.fields is not None:
+            for index, field in enumerate(token.fields):
+                if index > 0:
+                    output.append(0x2c)
+                output += field
+        if token.terminator is not None:
+            output.append(token.terminator)
+
+# If line_sizes is given, it's filled in with the packed size of each line.
+def pack_bytecode(lines, line_sizes=None):
+    output = bytearray()
+    for line in lines:
+        line_start = len(output)
+
+        # Leave room for the link address until we know where the line ends.
+        output += b'\x00\x00'
+        output += int.to_bytes(line['line_number'], 2, byteorder='little')
+
+        # Lines restored from the build cache come already packed.
+        if 'packed' in line:
+            output += line['packed']
+        else:
+            pack_tokens(line['tokens'], output)
+
+        output.append(0)
+
+        # Current pos + 1 for weird offset
+        output[line_start:line_start + 2] = int.to_bytes(len(output) + 1, 2, byteorder='little')
+
+        if line_sizes is not None:
+            line_sizes[line['line_number']] = len(output) - line_start
+
+    # Terminator
+    output += b'\x00\x00\x00'
+
+    return output
+
+# Keyword tokens. The ones the game's own code confirms are FOR, NEXT, DATA, READ, GOTO, IF, GOSUB, REM,
+# PRINT, TO, = and +; the rest follow the usual Microsoft ordering as far as N-BASIC is known to keep to
+# it. Anything that isn't in here is listed as an escape, so a wrong or missing name only makes the
+# listing harder to read, never wrong.
+KEYWORDS = {
+    0x81: 'END', 0x82: 'FOR', 0x83: 'NEXT', 0x84: 'DATA', 0x85: 'INPUT', 0x86: 'DIM', 0x87: 'READ', 0x88: 'LET',
+    0x89: 'GOTO', 0x8a: 'RUN', 0x8b: 'IF', 0x8c: 'RESTORE', 0x8d: 'GOSUB', 0x8e: 'RETURN', 0x8f: 'REM', 0x90: 'STOP',
+    0x91: 'PRINT', 0x92: 'CLEAR', 0x93: 'LIST', 0x94: 'NEW', 0x95: 'ON', 0x96: 'WAIT', 0x97: 'DEF', 0x98: 'POKE',
+    0x99: 'CONT', 0x9a: 'OUT', 0x9b: 'LPRINT', 0x9c: 'LLIST', 0x9d: 'CONSOLE', 0x9e: 'WIDTH', 0x9f: 'ELSE', 0xa0: 'TRON',
+    0xa1: 'TROFF', 0xa2: 'SWAP', 0xa3: 'ERASE', 0xa4: 'ERROR', 0xa5: 'RESUME', 0xa6: 'DELETE', 0xa7: 'AUTO', 0xa8: 'RENUM',
+    0xa9: 'DEFSTR', 0xaa: 'DEFINT', 0xab: 'DEFSNG', 0xac: 'DEFDBL', 0xad: 'LINE', 0xae: 'PRESET', 0xaf: 'PSET', 0xb0: 'BEEP',
+    0xb2: 'KEY', 0xb3: 'COLOR', 0xb4: 'TERM', 0xb5: 'MON', 0xb6: 'CMD', 0xb7: 'MOTOR',
+    0xdc: 'TO', 0xdd: 'THEN', 0xde: 'TAB(', 0xdf: 'STEP', 0xe0: 'USR', 0xe1: 'FN', 0xe2: 'SPC(', 0xe3: 'NOT',
+    0xe4: 'ERL', 0xe5: 'ERR', 0xe6: 'STRING$', 0xe7: 'USING', 0xe8: 'INSTR', 0xea: 'VARPTR', 0xeb: 'ATTR$',
+    0xf0: '>', 0xf1: '=', 0xf2: '<', 0xf3: '+', 0xf4: '-', 0xf5: '*', 0xf6: '/', 0xf7: '^',
+    0xf8: 'AND', 0xf9: 'OR', 0xfa: 'XOR', 0xfb: 'EQV', 0xfc: 'IMP', 0xfd: 'MOD', 0xfe: '\\',
+}
+
+# Function tokens, which come after FUNCTION_PREFIX.
+FUNCTIONS = {
+    0x81: 'LEFT$', 0x82: 'RIGHT$', 0x83: 'MID$', 0x84: 'SGN', 0x85: 'INT', 0x86: 'ABS', 0x87: 'SQR', 0x88: 'RND',
+    0x89: 'SIN', 0x8a: 'LOG', 0x8b: 'EXP', 0x8c: 'COS', 0x8d: 'TAN', 0x8e: 'ATN', 0x8f: 'FRE', 0x90: 'INP',
+    0x91: 'POS', 0x92: 'LEN', 0x93: 'STR$', 0x94: 'VAL', 0x95: 'ASC', 0x96: 'CHR$', 0x97: 'PEEK', 0x98: 'SPACE$',
+    0x99: 'OCT$', 0x9a: 'HEX$', 0x9b: 'LPOS', 0x9c: 'CINT', 0x9d: 'CSNG', 0x9e: 'CDBL', 0x9f: 'FIX',
+}
+
+# Keywords that a plain number after is a line number for, as are any more after commas (ON...GOTO).
+LINE_NUMBER_KEYWORDS = {'GOTO', 'GOSUB', 'THEN', 'ELSE', 'RESTORE', 'RUN', 'RESUME', 'LIST', 'LLIST', 'DELETE', 'RENUM', 'AUTO'}
+
+# The numbers 0 to 10 have one-byte tokens of their own.
+SMALL_INTEGER = 0x11
+SMALL_INTEGER_MAX = 10
+
+# Anything else in a listing can be written as {&Hxx}, which compiles to exactly that byte.
+ESCAPE = re.compile(r'\{&H([0-9A-F]{2})\}')
+CONTROL_CHARACTERS = re.compile('[\x00-\x1f\x7f]')
+
+NUMBER = re.compile(r'(?:\d+(?:\.\d*)?|\.\d+)(?:E[+-]?\d+)?!?')
+HEX_NUMBER = re.compile(r'&H([0-9A-F]{1,4})')
+LISTING_LINE = re.compile(r'\s*(\d+) ?(.*)')
+
+def _build_trie():
+    trie = {}
+    keywords = [(name, bytes([op])) for op, name in KEYWORDS.items()]
+    keywords += [(name, bytes([FUNCTION_PREFIX, op])) for op, name in FUNCTIONS.items()]
+    keywords.append(('?', bytes([0x91])))
+    for name, code in keywords:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[None] = (name, code)
+    return trie
+
+KEYWORD_TRIE = _build_trie()
+
+# Single precision constants are in Microsoft Binary Format: a 24-bit mantissa with the top bit standing
+# in for the sign, then an exponent biased by 128.
+def mbf_to_float(data):
+    if data[3] == 0:
+        return 0.0
+    mantissa = ((data[2] | 0x80) << 16) | (data[1] << 8) | data[0]
+    value = math.ldexp(mantissa, data[3] - 128 - 24)
+    return -value if data[2] & 0x80 else value
+
+def float_to_mbf(value):
+    if not math.isfinite(value):
+        raise ValueError('{0} is out of range for a single precision constant.'.format(value))
+    if value == 0:
+        return b'\x00\x00\x00\x00'
+    fraction, exponent = math.frexp(abs(value))
+    mantissa = round(fraction * (1 << 24))
+    if mantissa == 1 << 24:
+        mantissa >>= 1
+        exponent += 1
+    exponent += 128
+    if not 0 < exponent < 0x100:
+        raise ValueError('{0} is out of range for a single precision constant.'.format(value))
+    sign = 0x80 if value < 0 else 0
+    return bytes([mantissa & 0xff, (mantissa >> 8) & 0xff, ((mantissa >> 16) & 0x7f) | sign, exponent])
+
+def _format_float(data):
+    value = mbf_to_float(data)
+    for precision in range(1, 10):
+        text = '{0:.{1}G}'.format(value, precision)
+        if float_to_mbf(float(text)) == bytes(data):
+            break
+    if '.' not in text and 'E' not in text:
+        text += '!'
+    return text
+
+def _escape(data):
+    return ''.join('{{&H{0:02X}}}'.format(byte) for byte in data)
+
+def _decode_text(data):
+    return CONTROL_CHARACTERS.sub(lambda match: _escape(match.group().encode('pc8801')), str(data, 'pc8801'))
+
+def _encode_text(text, output):
+    pos = 0
+    for match in ESCAPE.finditer(text):
+        output += text[pos:match.start()].encode('pc8801')
+        output.append(int(match.group(1), 16))
+        pos = match.end()
+    output += text[pos:].encode('pc8801')
+
+def _render_token(token):
+    op = token.op
+    content = token.content
+    if op == 0x22:
+        return '"' + _decode_text(content) + ('"' if token.terminator is not None else '')
+    if op == 0x84:
+        return 'DATA' + _decode_text(bytes(content or b'') + b','.join(bytes(field) for field in token.fields or ()))
+    if op == 0x8f:
+        return 'REM' + _decode_text(content or b'')
+    if content is None:
+        if 0x20 <= op < 0x7f:
+            return chr(op)
+        if SMALL_INTEGER <= op <= SMALL_INTEGER + SMALL_INTEGER_MAX:
+            return str(op - SMALL_INTEGER)
+        if op in KEYWORDS:
+            return KEYWORDS[op]
+    elif op in (0xf, 0x1c, LINE_NUMBER_CONSTANT):
+        return str(int.from_bytes(content, byteorder='little'))
+    elif op == 0xc:
+        return '&H{0:X}'.format(int.from_bytes(content, byteorder='little'))
+    elif op == 0x1d:
+        return _format_float(content)
+    return None
+
+def _packed_token(token):
+    output = bytearray()
+    pack_tokens([token], output)
+    return output
+
+# Turns a line's tokens into listing text. Each token is rendered the obvious way first; the text is then
+# compiled back, and any token that doesn't come back as the same bytes (a hand-made token, a constant
+# where BASIC wouldn't have put one, a keyword missing from the table) is written as escapes instead.
+def detokenize(tokens):
+    expected = bytearray()
+    starts = []
+    for token in tokens:
+        starts.append(len(expected))
+        pack_tokens([token], expected)
+
+    raw = set()
+    while True:
+        pieces = []
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            text = None
+            if index not in raw:
+                if token.op == FUNCTION_PREFIX and index + 1 < len(tokens) and index + 1 not in raw:
+                    following = tokens[index + 1]
+                    if following.content is None and following.op in FUNCTIONS:
+                        pieces.append(FUNCTIONS[following.op])
+                        index += 2
+                        continue
+                else:
+                    text = _render_token(token)
+            pieces.append(text if text is not None else _escape(_packed_token(token)))
+            index += 1
+        text = ''.join(pieces)
+
+        # Text that doesn't compile at all (a run of constants rendered as one number too big for any
+        # constant, say) is a mismatch like any other.
+        compiled = bytearray()
+        try:
+            _compile(text, compiled)
+        except ValueError:
+            # Whatever compiled before the error is left in compiled, so the mismatch comes out where
+            # compiling stopped.
+            pass
+        else:
+            if compiled == expected:
+                return text
+
+        mismatch = next((i for i, (a, b) in enumerate(zip(compiled, expected)) if a != b), min(len(compiled), len(expected)))
+        position = max(i for i, start in enumerate(starts) if start <= mismatch) if mismatch < len(expected) else len(tokens) - 1
+        while position in raw and position > 0:
+            position -= 1
+        if position in raw:
+            return _escape(expected)
+        raw.add(position)
+        # A function name covers two tokens, so the prefix has to go raw along with what follows it.
+        if position > 0 and tokens[position - 1].op == FUNCTION_PREFIX:
+            raw.add(position - 1)
+
+# Streams a program out as listing text, one line at a time.
+def list_program(lines):
+    for line in lines:
+        yield '{0} {1}'.format(line['line_number'], detokenize(line['tokens']))
+
+# Compiles the text of one line into its tokenized bytes, the way N-BASIC does when a line is typed in:
+# keywords are found by longest match through KEYWORD_TRIE, numbers become the smallest constant that
+# holds them (or line number constants after GOTO and friends), and strings, DATA and REM are copied.
+def _compile(text, output):
+    pos = 0
+    length = len(text)
+    identifier = False
+    line_number_context = False
+
+    while pos < length:
+        char = text[pos]
+
+        if char == '{':
+            match = ESCAPE.match(text, pos)
+            if match is not None:
+                output.append(int(match.group(1), 16))
+                pos = match.end()
+                identifier = line_number_context = False
+                continue
+
+        if char == '"':
+            end = text.find('"', pos + 1)
+            output.append(0x22)
+            if end < 0:
+                _encode_text(text[pos + 1:], output)
+                pos = length
+            else:
+                _encode_text(text[pos + 1:end], output)
+                output.append(0x22)
+                pos = end + 1
+            identifier = line_number_context = False
+            continue
+
+        if not identifier and ('0' <= char <= '9' or char == '.'):
+            match = NUMBER.match(text, pos)
+            if match is not None:
+                number = match.group()
+                if number.isdigit() and line_number_context and int(number) <= 0xffff:
+                    output.append(LINE_NUMBER_CONSTANT)
+                    output += int(number).to_bytes(2, byteorder='little')
+                elif number.isdigit() and int(number) <= SMALL_INTEGER_MAX:
+                    output.append(SMALL_INTEGER + int(number))
+                    line_number_context = False
+                elif number.isdigit() and int(number) < 0x100:
+                    output += bytes([0xf, int(number)])
+                    line_number_context = False
+                elif number.isdigit() and int(number) < 0x8000:
+                    output.append(0x1c)
+                    output += int(number).to_bytes(2, byteorder='little')
+                    line_number_context = False
+                else:
+                    output.append(0x1d)
+                    output += float_to_mbf(float(number.rstrip('!')))
+                    line_number_context = False
+                pos = match.end()
+                continue
+
+        if char == '&':
+            match = HEX_NUMBER.match(text, pos)
+            if match is not None:
+                output.append(0xc)
+                output += int(match.group(1), 16).to_bytes(2, byteorder='little')
+                pos = match.end()
+                identifier = line_number_context = False
+                continue
+
+        node = KEYWORD_TRIE.get(char)
+        if node is not None:
+            keyword = None
+            end = pos + 1
+            while True:
+                if None in node:
+                    keyword = node[None]
+                    keyword_end = end
+                if end >= length or text[end] not in node:
+                    break
+                node = node[text[end]]
+                end += 1
+
+            if keyword is not None:
+                name, code = keyword
+                output += code
+                pos = keyword_end
+                identifier = False
+                line_number_context = name in LINE_NUMBER_KEYWORDS
+
+                if name == 'DATA':
+                    end = text.find(':', pos)
+                    if end < 0:
+                        end = length
+                    _encode_text(text[pos:end], output)
+                    pos = end
+                    line_number_context = False
+                elif name == 'REM':
+                    _encode_text(text[pos:], output)
+                    pos = length
+                continue
+
+        if char < '\x80':
+            output.append(ord(char))
+        else:
+            output += char.encode('pc8801')
+        identifier = char.isalpha() and char.isascii() or (identifier and ('0' <= char <= '9' or char == '.'))
+        line_number_context = line_number_context and char in ' ,'
+        pos += 1
+
+# Compiles a listing (any iterable of text lines, like a file) into program lines, ready for
+# pack_bytecode. Blank lines are skipped.
+def parse_listing(listing):
+    program = bytearray()
+    for number, text in enumerate(listing, start=1):
+        text = text.rstrip('\r\n')
+        if len(text.strip()) == 0:
+            continue
+
+        match = LISTING_LINE.fullmatch(text)
+        if match is None:
+            raise ValueError('Line {0} of the listing doesn\'t start with a line number.'.format(number))
+
+        line_start = len(program)
+        program += b'\x00\x00'
+        program += int(match.group(1)).to_bytes(2, byteorder='little')
+        _compile(match.group(2), program)
+        program.append(0)
+        program[line_start:line_start + 2] = (len(program) + 1).to_bytes(2, byteorder='little')
+
+    program += b'\x00\x00\x00'
+    return unpack_bytecode(bytes(program))
+
+# Compiles a piece of BASIC into tokens, for patches to splice into lines.
+def tokenize(text):
+    lines = parse_listing(['0 ' + text])
+    return lines[0]['tokens']
+
+if __name__ == '__main__':
+    from d88 import D88Image
+    import build_patch
+
+    parser = argparse.ArgumentParser('Lists the N-BASIC program on a disk image')
+    parser.add_argument('disk_image', help='Disk image to read.')
+    parser.add_argument('listing', help='File to write the listing to. Defaults to stdout.', nargs='?', default='-')
+    parser.add_argument('--program-entry', help='Directory entry of the program. Found automatically if not given.', type=int)
+    parser.add_argument('--check', help='Compile the listing back and make sure it gives the same program.', action='store_true')
+
+    args = parser.parse_args()
+
+    with D88Image.open(args.disk_image) as image:
+        buf = build_patch.read_program_from(image, args.program_entry)[3]
+
+    lines = unpack_bytecode(buf)
+    out_file = sys.stdout if args.listing == '-' else open(args.listing, 'w', encoding='utf8')
+    with out_file:
+        listing = []
+        for text in list_program(lines):
+            out_file.write(text + '\n')
+            if args.check:
+                listing.append(text)
+
+    if args.check:
+        if pack_bytecode(parse_listing(listing)) != pack_bytecode(lines):
+            print('The listing doesn\'t compile back to the same program.', file=sys.stderr)
+            sys.exit(1)
+        print('The listing compiles back to the same program.', file=sys.stderr)
@@ -0,0 +1,135 @@
+import bisect
+import time
+
+# An index over a program's lines, sorted by line number, so single lines can be found or added
+# without walking the whole program.
+class ProgramIndex:
+    def __init__(self, lines):
+        self.lines = lines
+        self.line_numbers = [line['line_number'] for line in lines]
+
+    def find(self, line_number):
+        index = bisect.bisect_left(self.line_numbers, line_number)
+        if index < len(self.line_numbers) and self.line_numbers[index] == line_number:
+            return self.lines[index]
+        return None
+
+    def insert(self, line):
+        index = bisect.bisect_left(self.line_numbers, line['line_number'])
+        if index < len(self.line_numbers) and self.line_numbers[index] == line['line_number']:
+            raise ValueError('Line {0} is already in the program.'.format(line['line_number']))
+        self.line_numbers.insert(index, line['line_number'])
+        self.lines.insert(index, line)
+
+# Fixups for a program, registered against the line numbers and phase they apply to. Phases that are
+# part of the pipeline can have a default handler that every line goes through; a line with handlers of
+# its own for that phase runs those instead.
+#
+# Every handler is called as handler(line, context). The context is whatever dict the caller passes in,
+# plus 'index', a ProgramIndex over the lines being run, for handlers that need to reach other lines.
+class PatchRegistry:
+    def __init__(self, pipeline):
+        self.pipeline = tuple(pipeline)
+        self.handlers = {}
+        self.defaults = {}
+
+        # Lines whose handlers read or write other lines, in both directions: if either line changes,
+        # both have to be redone.
+        self.dependencies = {}
+
+        # For each line that some other line's handler reaches into, which line that is and which
+        # pipeline position the handler runs at.
+        self.reached_by = {}
+
+    # Decorator. depends_on lists the other lines the handler reads or writes; those lines are held back
+    # in the pipeline until this one has been through the handler's phase.
+    def register(self, phase, *line_numbers, depends_on=()):
+        def decorator(handler):
+            for line_number in line_numbers:
+                self.handlers.setdefault((phase, line_number), []).append(handler)
+
+                for dependency in depends_on:
+                    self.dependencies.setdefault(line_number, set()).add(dependency)
+                    self.dependencies.setdefault(dependency, set()).add(line_number)
+                    if phase in self.pipeline:
+                        self.reached_by.setdefault(dependency, []).append((line_number, self.pipeline.index(phase)))
+            return handler
+        return decorator
+
+    def default(self, phase):
+        def decorator(handler):
+            self.defaults[phase] = handler
+            return handler
+        return decorator
+
+    def line_numbers(self, phase):
+        return sorted(line_number for handler_phase, line_number in self.handlers if handler_phase == phase)
+
+    # The given line numbers, plus every line that depends on them or that they depend on.
+    def related(self, line_numbers):
+        related = set(line_numbers)
+        pending = list(related)
+        while len(pending) > 0:
+            for dependency in self.dependencies.get(pending.pop(), ()):
+                if dependency not in related:
+                    related.add(dependency)
+                    pending.append(dependency)
+        return related
+
+    def _run(self, phase, line, context):
+        handlers = self.handlers.get((phase, line['line_number']))
+        if handlers is not None:
+            for handler in handlers:
+                handler(line, context)
+        elif phase in self.defaults:
+            self.defaults[phase](line, context)
+
+    # Runs one phase for just the lines that have handlers registered for it, looking each one up in the
+    # index rather than visiting every line.
+    def apply(self, phase, index, context):
+        context = dict(context, index=index)
+        for line_number in self.line_numbers(phase):
+            line = index.find(line_number)
+            if line is not None:
+                self._run(phase, line, context)
+
+    # Takes every line through all the pipeline phases in a single traversal. A line that another line's
+    # handler reaches into stops before its next phase until that line has caught up. If a timings dict
+    # is given, the time spent in each phase is added to it, keyed by phase.
+    def run_pipeline(self, lines, context, timings=None):
+        index = ProgramIndex(lines)
+        context = dict(context, index=index)
+
+        progress = {}
+        waiting = {}
+
+        def blocker(line_number, position):
+            for owner, owner_position in self.reached_by.get(line_number, ()):
+                if position > owner_position and progress.get(owner, 0) <= owner_position and index.find(owner) is not None:
+                    return owner
+            return None
+
+        def advance(line):
+            line_number = line['line_number']
+            position = progress.get(line_number, 0)
+            while position < len(self.pipeline):
+                owner = blocker(line_number, position)
+                if owner is not None:
+                    waiting.setdefault(owner, []).append(line)
+                    return
+
+                if timings is None:
+                    self._run(self.pipeline[position], line, context)
+                else:
+                    start = time.perf_counter()
+                    self._run(self.pipeline[position], line, context)
+                    phase = self.pipeline[position]
+                    timings[phase] = timings.get(phase, 0.0) + (time.perf_counter() - start)
+                position += 1
+                progress[line_number] = position
+
+                for waiting_line in waiting.pop(line_number, ()):
+                    advance(waiting_line)
+
+        for line in lines:
+            advance(line)
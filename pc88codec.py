@@ -0,0 +1,141 @@
+import codecs
+import re
+
+# The PC-8001/PC-8801 character set, as used by N-BASIC. It's JIS X 0201 (ASCII plus half-width
+# katakana) with the unused ranges filled in with semigraphics. Importing this module registers it with
+# the codecs machinery under these names:
+#
+#   pc8801               every one of the 256 byte values decodes to something
+#   pc8801-strict        control codes are an error, so stray binary data in a string gets caught
+#   pc8801-kanji         Shift-JIS double-byte kanji where a lead/trail pair is valid, semigraphics otherwise
+#   pc8801-kanji-strict  both of the above
+
+GRAPHICS_80 = '▁▂▃▄▅▆▇█▏▎▍▌▋▊▉┼┴┬┤├▔─│▕┌┐└┘╭╮╰╯'
+GRAPHICS_E0 = '═╞╪╡◢◣◥◤♠♥♦♣●○╱╲╳円年月日時分秒〒市区町村人▚▞'
+
+def _build_decoding_table(strict):
+    table = []
+    for code in range(0x100):
+        if code < 0x20 or code == 0x7f:
+            table.append('\ufffe' if strict else chr(code))
+        elif code < 0x7f:
+            table.append(chr(code))
+        elif code < 0xa0:
+            table.append(GRAPHICS_80[code - 0x80])
+        elif code == 0xa0:
+            table.append(' ')
+        elif code < 0xe0:
+            # Half-width katakana, in the same place Unicode puts them.
+            table.append(chr(0xff61 + code - 0xa1))
+        else:
+            table.append(GRAPHICS_E0[code - 0xe0])
+    return ''.join(table)
+
+DECODING_TABLE = _build_decoding_table(False)
+STRICT_DECODING_TABLE = _build_decoding_table(True)
+ENCODING_TABLE = codecs.charmap_build(DECODING_TABLE)
+STRICT_ENCODING_TABLE = codecs.charmap_build(STRICT_DECODING_TABLE)
+
+KANJI_PAIR = re.compile(rb'[\x81-\x9f\xe0-\xfc][\x40-\x7e\x80-\xfc]')
+
+_kanji_decoding = None
+_kanji_encoding = None
+
+# The double-byte table is big enough that it's only built the first time somebody asks for kanji.
+def _kanji_tables():
+    global _kanji_decoding, _kanji_encoding
+    if _kanji_decoding is None:
+        decoding = {}
+        for lead in list(range(0x81, 0xa0)) + list(range(0xe0, 0xfd)):
+            for trail in list(range(0x40, 0x7f)) + list(range(0x80, 0xfd)):
+                pair = bytes([lead, trail])
+                try:
+                    decoding[pair] = pair.decode('shift_jis')
+                except UnicodeDecodeError:
+                    pass
+        _kanji_decoding = decoding
+        _kanji_encoding = {text: pair for pair, text in decoding.items()}
+    return _kanji_decoding, _kanji_encoding
+
+def invalid_offsets(data, strict=True):
+    table = STRICT_DECODING_TABLE if strict else DECODING_TABLE
+    return [offset for offset, code in enumerate(bytes(data)) if table[code] == '\ufffe']
+
+def _decode_single(data, errors, strict):
+    table = STRICT_DECODING_TABLE if strict else DECODING_TABLE
+    return codecs.charmap_decode(data, errors, table)
+
+def _encode_single(text, errors, strict):
+    return codecs.charmap_encode(text, errors, STRICT_ENCODING_TABLE if strict else ENCODING_TABLE)
+
+def _decode_kanji(data, errors, strict):
+    data = bytes(data)
+    decoding, _ = _kanji_tables()
+
+    def decode_run(start, end):
+        try:
+            output.append(_decode_single(data[start:end], errors, strict)[0])
+        except UnicodeDecodeError as error:
+            # Report the offset in the whole input, not just this run of single-byte characters.
+            raise UnicodeDecodeError('pc8801-kanji', data, start + error.start, start + error.end, error.reason)
+
+    output = []
+    pos = 0
+    for match in KANJI_PAIR.finditer(data):
+        pair = match.group()
+        if pair not in decoding:
+            continue
+
+        if match.start() > pos:
+            decode_run(pos, match.start())
+        output.append(decoding[pair])
+        pos = match.end()
+
+    if pos < len(data):
+        decode_run(pos, len(data))
+
+    return ''.join(output), len(data)
+
+def _encode_kanji(text, errors, strict):
+    _, encoding = _kanji_tables()
+    encoding_table = STRICT_ENCODING_TABLE if strict else ENCODING_TABLE
+
+    output = bytearray()
+    for pos, char in enumerate(text):
+        if char in encoding:
+            output += encoding[char]
+            continue
+
+        try:
+            output += codecs.charmap_encode(char, 'strict', encoding_table)[0]
+        except UnicodeEncodeError:
+            # Redo the error against the whole string, so the offset in it is right.
+            if errors == 'strict':
+                raise UnicodeEncodeError('pc8801-kanji', text, pos, pos + 1, 'character maps to <undefined>')
+            output += codecs.charmap_encode(char, errors, encoding_table)[0]
+
+    return bytes(output), len(text)
+
+CODEC_NAMES = {
+    'pc8801': (False, False),
+    'pc8801_strict': (False, True),
+    'pc8801_kanji': (True, False),
+    'pc8801_kanji_strict': (True, True),
+}
+
+def _search(name):
+    name = name.replace('-', '_')
+    if name not in CODEC_NAMES:
+        return None
+
+    kanji, strict = CODEC_NAMES[name]
+    decode = _decode_kanji if kanji else _decode_single
+    encode = _encode_kanji if kanji else _encode_single
+
+    return codecs.CodecInfo(
+        name=name.replace('_', '-'),
+        encode=lambda text, errors='strict': encode(text, errors, strict),
+        decode=lambda data, errors='strict': decode(data, errors, strict),
+    )
+
+codecs.register(_search)